@@ -1,23 +1,35 @@
+import asyncio
+import math
 import pickle
+import re
 import sys
-from copy import deepcopy
+import traceback
 from io import BytesIO
-from time import gmtime, strftime, time
-from typing import Literal
+from time import gmtime, strftime
+from typing import Any, Coroutine, Literal
 
 import discord
 from discord import app_commands
-from osu import Beatmap, GameModeStr
+from osu import GameModeStr
 from requests import HTTPError
 from unopt import unwrap
 
 import database
 import graphics
+import lobby_tracking
+import map_pools
 import match_tracking as matches
+import matchmaking
+import predictions
 import ratings
-from misc.constants import OsuBeatmapId, RatingModelType
+import shadow
+import simulation
+import tournament
+from misc.constants import DiscordUserId, OsuUserId, RatingModelType
+from misc.users import CachedUser
 from osu_api import client as osu
 from osu_api import parse_beatmap_url
+from stats_tracking import MatchType
 
 SECRETS_DIR: str = "./secrets"
 
@@ -32,6 +44,15 @@ except FileNotFoundError:
 GUILD = discord.Object(id=1271199252667830363)  # my server shshshshshshshshsh
 OWO_BOT_ID: int = 289066747443675143
 
+# tasks running on their own, kept here so they aren't garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _run_in_background(coro: Coroutine[Any, Any, None]) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
 
 class MyClient(discord.Client):
     """Customized Discord client"""
@@ -46,6 +67,10 @@ class MyClient(discord.Client):
     async def setup_hook(self):
         self.tree.copy_global_to(guild=GUILD)
         await self.tree.sync(guild=GUILD)
+        shadow.runner.start()
+        _run_in_background(_matchmaking_loop())
+        _run_in_background(_lobby_loop())
+        _run_in_background(_resume_matches())
 
 
 client_intents = discord.Intents.default()
@@ -103,8 +128,83 @@ class Accept(discord.ui.View):
             )
 
 
+TEAM_NAMES: tuple[str, str] = ("Red", "Blue")
+
+
+class TeamLobby(discord.ui.View):
+    def __init__(self, host: discord.User | discord.Member, team_size: int):
+        super().__init__(timeout=600)
+        self.value = None
+        self.host = host
+        self.team_size = team_size
+        self.teams: list[list[discord.User | discord.Member]] = [[host], []]
+
+    def roster(self) -> str:
+        return "\n".join(
+            f"**{name}** ({len(team)}/{self.team_size}): "
+            + (", ".join(member.mention for member in team) or "nobody yet")
+            for name, team in zip(TEAM_NAMES, self.teams)
+        )
+
+    async def _join(self, interaction: discord.Interaction, team: int):
+        if interaction.user not in database.discord_links:
+            return await interaction.response.send_message(
+                "You have not linked your profile yet. Use `/link` to do so.",
+                ephemeral=True,
+            )
+        if len(self.teams[team]) >= self.team_size:
+            return await interaction.response.send_message(
+                "That team is full.", ephemeral=True
+            )
+        for members in self.teams:
+            if interaction.user in members:
+                members.remove(interaction.user)
+        self.teams[team].append(interaction.user)
+        await interaction.response.edit_message(content=self.roster())
+
+    @discord.ui.button(label="Join Red", emoji="🔴", style=discord.ButtonStyle.red)
+    async def join_red(self, interaction: discord.Interaction, _: discord.ui.Button):
+        await self._join(interaction, 0)
+
+    @discord.ui.button(label="Join Blue", emoji="🔵", style=discord.ButtonStyle.blurple)
+    async def join_blue(self, interaction: discord.Interaction, _: discord.ui.Button):
+        await self._join(interaction, 1)
+
+    @discord.ui.button(label="Start", emoji="🏁", style=discord.ButtonStyle.green)
+    async def start(self, interaction: discord.Interaction, _: discord.ui.Button):
+        if interaction.user != self.host:
+            return await interaction.response.send_message(
+                "Only the host can start the match.", ephemeral=True
+            )
+        # players can unlink their profile after joining
+        unlinked = [
+            member
+            for team in self.teams
+            for member in team
+            if member not in database.discord_links
+        ]
+        if unlinked:
+            self.teams = [
+                [member for member in team if member not in unlinked]
+                for team in self.teams
+            ]
+            await interaction.response.edit_message(content=self.roster())
+            return await interaction.followup.send(
+                ", ".join(member.mention for member in unlinked)
+                + " left the lobby, as their profile is no longer linked.",
+                allowed_mentions=discord.AllowedMentions.none(),
+            )
+        if not all(self.teams):
+            return await interaction.response.send_message(
+                "Both teams need at least one player.", ephemeral=True
+            )
+        self.value = True
+        await interaction.response.edit_message(content=self.roster(), view=None)
+        self.stop()
+
+
 class OsuBeatmapDownloads(discord.ui.View):
-    def __init__(self, beatmap: Beatmap):
+    def __init__(self, beatmap: map_pools.BeatmapMetadata):
         super().__init__(timeout=None)
         self.beatmap = beatmap
         self.add_item(
@@ -138,6 +238,227 @@ class OsuBeatmapDownloads(discord.ui.View):
         )
 
 
+_NO_POOLED_BEATMAPS: str = (
+    "There are no beatmaps to pick from. Please provide a beatmap URL."
+)
+
+
+def _beatmap_from_url(url: str) -> tuple[GameModeStr, map_pools.BeatmapMetadata]:
+    """The mode a beatmap URL is for and the beatmap. Raises ValueError with
+    a message for the user if it isn't a valid beatmap."""
+    try:
+        _, mode, diff_id = parse_beatmap_url(url)
+    except ValueError:
+        raise ValueError("Invalid beatmap URL. Please provide a valid beatmap URL.")
+    try:
+        return mode, map_pools.lookup(diff_id)
+    except HTTPError:
+        raise ValueError("Beatmap not found. Please provide a valid beatmap URL.")
+
+
+def _beatmap_link(beatmap: map_pools.BeatmapMetadata) -> str:
+    return (
+        "["
+        + f"**{beatmap.title}** - {beatmap.artist} "
+        + f"**[{beatmap.version}]**"
+        + f" by {beatmap.creator}"
+        + "]("
+        + beatmap.url
+        + ")"
+        + (f" +{map_pools.mod_acronyms(beatmap.mods)}" if beatmap.mods else "")
+    )
+
+
+def _beatmap_to_play(beatmap: map_pools.BeatmapMetadata) -> str:
+    return (
+        "Beatmap to play: "
+        + _beatmap_link(beatmap)
+        + (
+            f"\nOnly scores played with {map_pools.mod_acronyms(beatmap.mods)} count."
+            if beatmap.mods
+            else ""
+        )
+    )
+
+
+def _graphic_file(graphic: graphics.Graphic, name: str) -> discord.File:
+    buffer = BytesIO()
+    graphics.render_to(graphic, buffer)
+    buffer.seek(0)
+    return discord.File(buffer, filename=f"{name}.{graphic.encoding.extension}")
+
+
+_PrerenderedResults = dict[
+    Literal["player1", "player2"],
+    tuple[
+        tuple[ratings.RatingValue, ratings.RatingValue],
+        asyncio.Task[graphics.PreparedGraphic],
+    ],
+]
+
+
+def _prerender_1v1_results(
+    challenger: CachedUser,
+    opponent: CachedUser,
+    rating_model: ratings.RatingModel,
+) -> _PrerenderedResults:
+    """Start preparing the results banner for both possible winners while the
+    match is being played. Scores are filled in once it's over."""
+    prerendered: _PrerenderedResults = {}
+    outcomes: list[tuple[Literal["player1", "player2"], list[list[int | float]]]] = [
+        ("player1", [[0], [1]]),
+        ("player2", [[1], [0]]),
+    ]
+    for winner, placeholder_scores in outcomes:
+        changes = rating_model.preview(
+            [[challenger], [opponent]], scores=placeholder_scores
+        )
+        graphic = graphics.OneVOneAfterGraphic(
+            (opponent, changes[1][0], 1),
+            (challenger, changes[0][0], 1),
+            rating_model,
+            winner=winner,
+        )
+        prerendered[winner] = (
+            (changes[1][0].after, changes[0][0].after),
+            asyncio.create_task(
+                asyncio.to_thread(graphics.prepare, graphic, graphic.RESULT_VARIABLES)
+            ),
+        )
+    return prerendered
+
+
+def _same_rating(a: ratings.RatingValue, b: ratings.RatingValue) -> bool:
+    return math.isclose(a.mu, b.mu) and math.isclose(a.sigma, b.sigma)
+
+
+async def _render_1v1_results(
+    prerendered: _PrerenderedResults, graphic: graphics.OneVOneAfterGraphic
+) -> discord.File:
+    for _, task in prerendered.values():
+        if task is not prerendered[graphic.winner][1]:
+            task.cancel()
+    (player1_after, player2_after), task = prerendered[graphic.winner]
+    # ratings may have moved in the meantime (e.g. another match finished)
+    if _same_rating(graphic.player1[1][1], player1_after) and _same_rating(
+        graphic.player2[1][1], player2_after
+    ):
+        prepared = await task
+        buffer = BytesIO()
+        await asyncio.to_thread(prepared.finish, graphic, buffer)
+        buffer.seek(0)
+        return discord.File(
+            buffer, filename=f"match-banner.{graphic.encoding.extension}"
+        )
+    task.cancel()
+    return _graphic_file(graphic, "match-banner")
+
+
+async def _play_1v1(thread: discord.Thread, tracked: matches.TrackedMatch) -> None:
+    rating_model = ratings.rating_models[tracked.model_type]
+    [[challenger_osu], [opponent_osu]] = tracked.teams
+    prerendered = _prerender_1v1_results(challenger_osu, opponent_osu, rating_model)
+
+    try:
+        player_scores = await matches.do_match(tracked)
+    except matches.MatchVoidException:
+        for _, task in prerendered.values():
+            task.cancel()
+        await thread.send("No player set any valid scores.")
+        return
+
+    player_scores, changes = matches.rate(tracked, player_scores)
+    scores = [[player.score for player in team_scores] for team_scores in player_scores]
+    winner: Literal["challenger", "opponent"]
+    if scores[0][0] - scores[1][0] > 0:
+        winner = "challenger"
+    elif scores[0][0] - scores[1][0] < 0:
+        winner = "opponent"
+    else:
+        for _, task in prerendered.values():
+            task.cancel()
+        await thread.send("It's a draw. (how???)")
+        return
+
+    winner_b: Literal["player1", "player2"]
+    match winner:
+        case "opponent":
+            winner_b = "player1"
+        case "challenger":
+            winner_b = "player2"
+    graphic = await _render_1v1_results(
+        prerendered,
+        graphics.OneVOneAfterGraphic(
+            (opponent_osu, changes[1][0], int(scores[1][0])),
+            (challenger_osu, changes[0][0], int(scores[0][0])),
+            rating_model,
+            winner=winner_b,
+        ),
+    )
+
+    await thread.send("Match over! Here are the results:", file=graphic)
+
+
+async def _play_team_vs(thread: discord.Thread, tracked: matches.TrackedMatch) -> None:
+    try:
+        player_scores = await matches.do_match(tracked)
+    except matches.MatchVoidException:
+        await thread.send("No player set any valid scores.")
+        return
+
+    player_scores, changes = matches.rate(tracked, player_scores)
+
+    await thread.send(
+        "Match over! Here are the results:",
+        file=await asyncio.to_thread(
+            _graphic_file,
+            graphics.TeamVsGraphic(
+                # the ratings the match was rated from, which other matches
+                # may have changed since this one started
+                [
+                    [
+                        (player, change.before)
+                        for player, change in zip(team, team_changes)
+                    ]
+                    for team, team_changes in zip(tracked.teams, changes)
+                ],
+                ratings.rating_models[tracked.model_type],
+                ratings_after=[[change.after for change in team] for team in changes],
+                scores=[[player.score for player in team] for team in player_scores],
+            ),
+            "match-banner",
+        ),
+    )
+
+
+async def _resume_matches() -> None:
+    """Pick up every match that was still going when the bot stopped, after
+    looking for all of their scores at once."""
+    await client.wait_until_ready()
+    tracked = await matches.open_matches()
+    await matches.catch_up(tracked)
+    for match in tracked:
+        try:
+            thread = await client.fetch_channel(match.channel_id)
+        except discord.HTTPException:
+            match.set_state(matches.MatchState.void)
+            continue
+        assert isinstance(thread, discord.Thread)
+        # the buttons to accept it or start it are gone
+        if match.state is matches.MatchState.proposed:
+            match.set_state(matches.MatchState.void)
+            await thread.send(
+                "Sorry, this match was called off by a restart before it began. "
+                + "Please start a new one."
+            )
+            await thread.edit(locked=True)
+            continue
+        if match.match_type is MatchType.one_v_one:
+            _run_in_background(_play_1v1(thread, match))
+        else:
+            _run_in_background(_play_team_vs(thread, match))
+
+
 @app_commands.default_permissions(manage_guild=True)
 class AdminCommands(app_commands.Group):
     pass
@@ -148,6 +469,12 @@ admin_group = AdminCommands(
     description="Commands related to managing this bot on a server.",
 )
 simulate_group = app_commands.Group(name="simulate", description="Simulate matches.")
+pool_group = app_commands.Group(
+    name="pool", description="Commands related to managing map pools."
+)
+tournament_group = app_commands.Group(
+    name="tournament", description="Run tournament rounds."
+)
 link_admin_group = app_commands.Group(
     name="osu",
     description="Commands related to managing links between osu! usernames and Discord accounts.",
@@ -158,13 +485,31 @@ link_group = app_commands.Group(
     description="Commands related to linking your osu! username to your Discord account.",
 )
 
+queue_group = app_commands.Group(
+    name="queue", description="Commands related to finding an opponent."
+)
+
+lobby_group = app_commands.Group(
+    name="lobby",
+    description="Commands related to rating osu! multiplayer matches.",
+    default_permissions=discord.Permissions(manage_guild=True),
+)
+
 
 @client.tree.command()
+@app_commands.rename(model="mode")
 @app_commands.describe(
-    opponent="The person you want to challenge", beatmap="The beatmap you want to play"
+    opponent="The person you want to challenge",
+    beatmap="The beatmap you want to play",
+    pool="Map pool to pick a beatmap from if you don't give one",
+    model="Gamemode / Ruleset, if a beatmap is picked for you",
 )
 async def challenge(
-    interaction: discord.Interaction, opponent: discord.Member, beatmap: str
+    interaction: discord.Interaction,
+    opponent: discord.Member,
+    beatmap: str | None = None,
+    pool: str | None = None,
+    model: MODESTR = "osu",
 ) -> None:
     """Challenge someone to a game on one beatmap"""
 
@@ -174,20 +519,13 @@ async def challenge(
     await interaction.response.defer(ephemeral=True, thinking=True)
 
     # check beatmap
-    try:
-        _, mode, diff_id = parse_beatmap_url(beatmap)
-    except ValueError:
-        return await interaction.followup.send(
-            "Invalid beatmap URL. Please provide a valid beatmap URL.",
-            ephemeral=True,
-        )
-    try:
-        beatmap_info = osu.beatmaps[OsuBeatmapId(diff_id)]
-    except HTTPError:
-        return await interaction.followup.send(
-            "Beatmap not found. Please provide a valid beatmap URL.",
-            ephemeral=True,
-        )
+    beatmap_info: map_pools.BeatmapMetadata | None = None
+    mode = GameModeStr(model)
+    if beatmap is not None:
+        try:
+            mode, beatmap_info = _beatmap_from_url(beatmap)
+        except ValueError as e:
+            return await interaction.followup.send(str(e), ephemeral=True)
 
     # check players
     try:
@@ -212,21 +550,25 @@ async def challenge(
         )
 
     rating_model = ratings.rating_models[RatingModelType.from_gamemodestr(mode)]
+    if beatmap_info is None:
+        beatmap_info = map_pools.pick(
+            rating_model.model_type,
+            [OsuUserId(challenger_osu.id), OsuUserId(opponent_osu.id)],
+            pool,
+        )
+        if beatmap_info is None:
+            return await interaction.followup.send(_NO_POOLED_BEATMAPS, ephemeral=True)
 
     challenger_rating = rating_model[challenger_osu]
     opponent_rating = rating_model[opponent_osu]
 
-    graphic = discord.File(
-        BytesIO(
-            graphics.render(
-                graphics.OneVOneBeforeGraphic(
-                    (opponent_osu, opponent_rating),
-                    (challenger_osu, challenger_rating),
-                    rating_model,
-                )
-            )
+    graphic = _graphic_file(
+        graphics.OneVOneBeforeGraphic(
+            (opponent_osu, opponent_rating),
+            (challenger_osu, challenger_rating),
+            rating_model,
         ),
-        filename="match-banner.png",
+        "match-banner",
     )
     accept_view = Accept([opponent])
     downloads_view = OsuBeatmapDownloads(beatmap_info)
@@ -238,6 +580,13 @@ async def challenge(
         type=discord.ChannelType.private_thread,
     )
     await thread.add_user(unwrap(client.owo_bot))
+    tracked = matches.propose(
+        rating_model.model_type,
+        MatchType.one_v_one,
+        thread.id,
+        beatmap_info,
+        [[challenger_osu], [opponent_osu]],
+    )
     await thread.send(
         f"Watch out {opponent.mention}, "
         + f"{interaction.user.mention} wants to challenge you!",
@@ -246,13 +595,7 @@ async def challenge(
     )
     del graphic
     await thread.send(
-        "Beatmap to play: ["
-        + f"**{unwrap(beatmap_info.beatmapset).title}** - {unwrap(beatmap_info.beatmapset).artist} "
-        + f"**[{beatmap_info.version}]**"
-        + f" by {unwrap(beatmap_info.beatmapset).creator}"
-        + "]("
-        + beatmap_info.url
-        + ")",
+        _beatmap_to_play(beatmap_info),
         view=downloads_view,
     )
 
@@ -264,75 +607,134 @@ async def challenge(
     accept_view.clear_items()
     match accept_view.value:
         case False | None:
+            tracked.set_state(matches.MatchState.void)
             await thread.send(
                 f"Sorry {interaction.user.mention}, your opponent has declined your challenge."
             )
             await thread.edit(locked=True)
             return
         case True:
+            tracked.accept()
             await thread.send(
                 "Alright, bring it on! Match will end "
-                + f"<t:{int(time() + max(beatmap_info.total_length * 1.5, 60))}:R>"
+                + f"<t:{int(unwrap(tracked.deadline))}:R>"
                 + "."
             )
 
-    try:
-        scores: list[list[int | float]] = [
-            list(team_scores)
-            for team_scores in await matches.do_match(
-                [[challenger_osu], [opponent_osu]], beatmap_info
-            )
-        ]
-    except matches.MatchVoidException:
-        await thread.send("No player set any valid scores.")
-        return
-    teams = [[challenger_osu], [opponent_osu]]
+    await _play_1v1(thread, tracked)
+
+
+@client.tree.command()
+@app_commands.rename(model="mode")
+@app_commands.describe(
+    beatmap="The beatmap you want to play",
+    team_size="How many players each team can have",
+    pool="Map pool to pick a beatmap from if you don't give one",
+    model="Gamemode / Ruleset, if a beatmap is picked for you",
+)
+async def teamvs(
+    interaction: discord.Interaction,
+    beatmap: str | None = None,
+    team_size: app_commands.Range[int, 1, 4] = 4,
+    pool: str | None = None,
+    model: MODESTR = "osu",
+):
+    """Open a lobby for a team vs match on one beatmap"""
+
+    channel = unwrap(interaction.channel)
+    assert isinstance(channel, discord.TextChannel)
 
-    challenger_rating = deepcopy(challenger_rating)
-    opponent_rating = deepcopy(opponent_rating)
+    if interaction.user not in database.discord_links:
+        return await interaction.response.send_message(
+            "You have not linked your profile yet. Use `/link` to do so.",
+            ephemeral=True,
+        )
 
-    rating_model.rate_match(teams, scores=scores)
+    await interaction.response.defer(ephemeral=True, thinking=True)
 
-    challenger_rating_after = rating_model[challenger_osu]
-    opponent_rating_after = rating_model[opponent_osu]
-    winner: Literal["challenger", "opponent"]
-    if scores[0][0] - scores[1][0] > 0:
-        winner = "challenger"
-    elif scores[0][0] - scores[1][0] < 0:
-        winner = "opponent"
+    # check beatmap
+    mode = GameModeStr(model)
+    if beatmap is not None:
+        try:
+            mode, beatmap_info = _beatmap_from_url(beatmap)
+        except ValueError as e:
+            return await interaction.followup.send(str(e), ephemeral=True)
     else:
-        await thread.send("It's a draw. (how???)")
+        # the teams aren't known yet, so it's picked for the host
+        pooled = map_pools.pick(
+            RatingModelType.from_gamemodestr(mode),
+            [database.discord_links[interaction.user]],
+            pool,
+        )
+        if pooled is None:
+            return await interaction.followup.send(_NO_POOLED_BEATMAPS, ephemeral=True)
+        beatmap_info = pooled
+
+    lobby = TeamLobby(interaction.user, team_size)
+    thread = await channel.create_thread(
+        name=f"{interaction.user.display_name}'s team vs"
+        + " "
+        + f"({strftime('%A %B %d', gmtime())})",
+        type=discord.ChannelType.public_thread,
+    )
+    await interaction.followup.send(f"Lobby opened in {thread.mention}.")
+    await thread.send(
+        _beatmap_to_play(beatmap_info),
+        view=OsuBeatmapDownloads(beatmap_info),
+    )
+    await thread.send(lobby.roster(), view=lobby)
+
+    await lobby.wait()
+    if lobby.value is None:
+        await thread.send("The lobby timed out before the match was started.")
+        await thread.edit(locked=True)
         return
 
-    winner_b: Literal["player1", "player2"]
-    match winner:
-        case "opponent":
-            winner_b = "player1"
-        case "challenger":
-            winner_b = "player2"
-    graphic = discord.File(
-        BytesIO(
-            graphics.render(
-                graphics.OneVOneAfterGraphic(
-                    (
-                        opponent_osu,
-                        (opponent_rating, opponent_rating_after),
-                        int(scores[1][0]),
-                    ),
-                    (
-                        challenger_osu,
-                        (challenger_rating, challenger_rating_after),
-                        int(scores[0][0]),
-                    ),
-                    rating_model,
-                    winner=winner_b,
-                )
-            )
+    rating_model = ratings.rating_models[RatingModelType.from_gamemodestr(mode)]
+    linked = database.discord_links.osu_ids(
+        member for team in lobby.teams for member in team
+    )
+    if any(
+        DiscordUserId(member.id) not in linked
+        for team in lobby.teams
+        for member in team
+    ):
+        await thread.send(
+            "Someone unlinked their profile as the match was starting. "
+            + "Please start a new one."
+        )
+        await thread.edit(locked=True)
+        return
+    teams = [
+        [osu.users[(linked[DiscordUserId(member.id)], mode)] for member in team]
+        for team in lobby.teams
+    ]
+    ratings_before = [[rating_model[osu_user] for osu_user in team] for team in teams]
+    # players only join once the lobby is open, so the match is accepted as
+    # soon as it's proposed
+    tracked = matches.propose(
+        rating_model.model_type, MatchType.team_vs, thread.id, beatmap_info, teams
+    )
+    tracked.accept()
+
+    await thread.send(
+        "Alright, bring it on! Match will end "
+        + f"<t:{int(unwrap(tracked.deadline))}:R>"
+        + ".",
+        file=await asyncio.to_thread(
+            _graphic_file,
+            graphics.TeamVsGraphic(
+                [
+                    list(zip(team, team_ratings))
+                    for team, team_ratings in zip(teams, ratings_before)
+                ],
+                rating_model,
+            ),
+            "match-banner",
         ),
-        filename="match-banner.png",
     )
 
-    await thread.send("Match over! Here are the results:", file=graphic)
+    await _play_team_vs(thread, tracked)
 
 
 @client.tree.command()
@@ -364,18 +766,56 @@ async def profile(
 
     await interaction.followup.send(
         "",
-        file=discord.File(
-            BytesIO(
-                graphics.render(
-                    graphics.SmallProfileGraphic(
-                        osu_user,
-                        rating,
-                        rating_model.osu_ratings_links.index(osu_user.id) + 1,
-                        rating_model,
-                    )
-                )
+        file=_graphic_file(
+            graphics.SmallProfileGraphic(
+                osu_user,
+                rating,
+                rating_model.osu_ratings_links.index(osu_user.id) + 1,
+                rating_model,
             ),
-            filename="profile-small.png",
+            "profile-small",
+        ),
+    )
+
+
+LEADERBOARD_PAGE_SIZE: int = 10
+
+
+@client.tree.command()
+@app_commands.rename(model="mode")
+@app_commands.describe(model="Gamemode / Ruleset", page="Page of the leaderboard")
+async def leaderboard(
+    interaction: discord.Interaction,
+    model: MODESTR = "osu",
+    page: app_commands.Range[int, 1] = 1,
+):
+    """Check the elo leaderboard."""
+    rating_model = ratings.rating_models[RatingModelType(model)]
+    if (page - 1) * LEADERBOARD_PAGE_SIZE >= len(rating_model.osu_ratings_links):
+        return await interaction.response.send_message(
+            "There are not that many players on the leaderboard.", ephemeral=True
+        )
+
+    await interaction.response.defer(thinking=True)
+
+    leaderboard_page, image = graphics.leaderboard_page(
+        rating_model, page, LEADERBOARD_PAGE_SIZE
+    )
+    if image is None:
+        # fetching the players and drawing the page both block
+        image = await asyncio.to_thread(
+            graphics.render_leaderboard,
+            leaderboard_page,
+            rating_model,
+            osu.get_compact_users,
+        )
+        graphics.cache_leaderboard(leaderboard_page, image)
+
+    await interaction.followup.send(
+        "",
+        file=discord.File(
+            BytesIO(image),
+            filename=f"leaderboard.{graphics.LeaderboardGraphic.encoding.extension}",
         ),
     )
 
@@ -489,29 +929,21 @@ async def simulate_1v1(
 
     rating_model = ratings.rating_models[model]
 
-    player1_rating = deepcopy(rating_model[player1_osu])
-    player2_rating = deepcopy(rating_model[player2_osu])
-
-    ratings_after = rating_model.rate_match(
-        [[player1_osu], [player2_osu]], dry_run=dry_run
-    )
+    teams = [[player1_osu], [player2_osu]]
+    changes = rating_model.preview(teams) if dry_run else rating_model.rate_match(teams)
 
-    player1_rating_after = ratings_after[0][0]
-    player2_rating_after = ratings_after[1][0]
+    player1_rating_after = changes[0][0].after
+    player2_rating_after = changes[1][0].after
 
-    graphic = discord.File(
-        BytesIO(
-            graphics.render(
-                graphics.OneVOneAfterGraphic(
-                    (player1_osu, (player1_rating, player1_rating_after), 1_000_000),
-                    (player2_osu, (player2_rating, player2_rating_after), 0),
-                    rating_model,
-                    winner="player1",
-                    watermark="SIMULATION" if dry_run else "ARTIFICIAL RESULTS",
-                )
-            )
+    graphic = _graphic_file(
+        graphics.OneVOneAfterGraphic(
+            (player1_osu, changes[0][0], 1_000_000),
+            (player2_osu, changes[1][0], 0),
+            rating_model,
+            winner="player1",
+            watermark="SIMULATION" if dry_run else "ARTIFICIAL RESULTS",
         ),
-        filename="match-banner.png",
+        "match-banner",
     )
 
     await interaction.followup.send(
@@ -526,10 +958,562 @@ async def simulate_1v1(
     )
 
 
+MATCHMAKING_TICK: float = 5
+
+
+async def _messageable(channel_id: int) -> discord.abc.Messageable:
+    """A channel or thread to send to, fetched if it isn't cached."""
+    channel = client.get_channel(channel_id) or await client.fetch_channel(channel_id)
+    if not isinstance(channel, discord.abc.Messageable):
+        raise TypeError(f"Can't send messages to channel {channel_id}.")
+    return channel
+
+
+async def _announce_pairing(
+    queue: matchmaking.MatchmakingQueue,
+    player: matchmaking.QueuedPlayer,
+    opponent: matchmaking.QueuedPlayer,
+) -> None:
+    prediction = predictions.predictors[queue.model.model_type].predict(
+        OsuUserId(player.osu_user.id), OsuUserId(opponent.osu_user.id)
+    )
+    # straight from the pools, without asking the osu! API
+    suggested = map_pools.pick(
+        queue.model.model_type,
+        [OsuUserId(player.osu_user.id), OsuUserId(opponent.osu_user.id)],
+    )
+    channel = await _messageable(player.channel_id)
+    await channel.send(
+        f"<@{player.discord_id}> vs <@{opponent.discord_id}>: "
+        + f"you've been matched up! ({graphics.percentage(prediction.win)}% "
+        + f"- {graphics.percentage(prediction.loss)}%)"
+        + "\n"
+        + "Use `/challenge` with a beatmap of your choice to play"
+        + (f", or try {_beatmap_link(suggested)}." if suggested is not None else ".")
+    )
+
+
+async def _matchmaking_loop() -> None:
+    while True:
+        await asyncio.sleep(MATCHMAKING_TICK)
+        for queue in matchmaking.queues.values():
+            for player, opponent in queue.tick():
+                # one pairing that can't be announced mustn't lose the rest
+                try:
+                    await _announce_pairing(queue, player, opponent)
+                except Exception:
+                    print(
+                        "Couldn't announce the pairing of "
+                        + f"{player.discord_id} and {opponent.discord_id}"
+                    )
+                    traceback.print_exc()
+
+
+@queue_group.command()
+@app_commands.rename(model="mode")
+@app_commands.describe(model="Gamemode / Ruleset")
+async def join(interaction: discord.Interaction, model: MODESTR = "osu"):
+    """Wait for an opponent close to your skill level."""
+    try:
+        osu_user = osu.users[
+            (database.discord_links[interaction.user], GameModeStr(model))
+        ]
+    except KeyError:
+        return await interaction.response.send_message(
+            "You have not linked your profile yet. Use `/link` to do so.",
+            ephemeral=True,
+        )
+
+    discord_id = DiscordUserId(interaction.user.id)
+    for queue in matchmaking.queues.values():
+        queue.leave(discord_id)
+    queue = matchmaking.queues[RatingModelType(model)]
+    queue.join(discord_id, osu_user, unwrap(interaction.channel_id))
+
+    await interaction.response.send_message(
+        f"You are now queued for {model} with {len(queue) - 1} other player(s). "
+        + "The longer you wait, the wider the range of opponents you can be matched with.",
+        ephemeral=True,
+    )
+
+
+@queue_group.command()
+async def leave(interaction: discord.Interaction):
+    """Stop waiting for an opponent."""
+    discord_id = DiscordUserId(interaction.user.id)
+    model = matchmaking.queued_model(discord_id)
+    if model is None:
+        return await interaction.response.send_message(
+            "You are not in a queue.", ephemeral=True
+        )
+
+    matchmaking.queues[model].leave(discord_id)
+    await interaction.response.send_message(
+        f"You have left the {model.value} queue.", ephemeral=True
+    )
+
+
+def _lobby_results(game: lobby_tracking.RatedGame) -> str:
+    lines = [
+        f"**{game.lobby.name}**: game "
+        + (f"on <https://osu.ppy.sh/b/{game.beatmap_id}> " if game.beatmap_id else "")
+        + f"rated ({game.model_type.value})"
+    ]
+    linked = database.discord_links.discord_ids(
+        OsuUserId(user.id) for team in game.teams for user in team
+    )
+    for number, (team, scores, changes) in enumerate(
+        zip(game.teams, game.scores, game.changes), 1
+    ):
+        if len(team) > 1:
+            lines.append(f"Team {number}:")
+        for user, score, change in zip(team, scores, changes):
+            osu_id = OsuUserId(user.id)
+            lines.append(
+                f"- {user.username}"
+                + (f" (<@{linked[osu_id]}>)" if osu_id in linked else "")
+                + f": {graphics.long_integer(score)} "
+                + f"(μ {graphics.short_decimal(change.before.mu)} → "
+                + f"{graphics.short_decimal(change.after.mu)})"
+            )
+    return "\n".join(lines)
+
+
+async def _lobby_loop() -> None:
+    while True:
+        await asyncio.sleep(lobby_tracking.LOBBY_POLL_INTERVAL)
+        try:
+            rated = await lobby_tracking.tracker.poll()
+        except Exception:
+            print("Couldn't poll followed lobbies")
+            traceback.print_exc()
+            continue
+        for game in rated:
+            # the game is rated either way, only the announcement is lost
+            try:
+                channel = await _messageable(game.lobby.channel_id)
+                await channel.send(
+                    _lobby_results(game),
+                    allowed_mentions=discord.AllowedMentions.none(),
+                )
+            except Exception:
+                print(f"Couldn't announce a game of match {game.lobby.match_id}")
+                traceback.print_exc()
+
+
+_MULTIPLAYER_MATCH = re.compile(r"(?:/community/matches/|/mp/)?(\d+)/?$")
+
+
+@lobby_group.command()
+@app_commands.describe(
+    match="osu! multiplayer match link or id.",
+    include_past="Also rate the games played before now.",
+)
+async def follow(
+    interaction: discord.Interaction, match: str, include_past: bool = False
+):
+    """Rate every game of an osu! multiplayer match as it finishes."""
+    re_match = _MULTIPLAYER_MATCH.search(match.strip())
+    if not re_match:
+        return await interaction.response.send_message(
+            "Invalid match. Please provide a multiplayer match link or id.",
+            ephemeral=True,
+        )
+
+    await interaction.response.defer(thinking=True)
+    try:
+        lobby = await lobby_tracking.tracker.follow(
+            int(re_match.group(1)), unwrap(interaction.channel_id), include_past
+        )
+    except HTTPError:
+        return await interaction.followup.send("Match not found.", ephemeral=True)
+    await interaction.followup.send(
+        f"Following **{lobby.name}**. Games will be rated here as they finish."
+    )
+
+
+@lobby_group.command()
+@app_commands.describe(match="osu! multiplayer match link or id.")
+async def unfollow(interaction: discord.Interaction, match: str):
+    """Stop rating the games of an osu! multiplayer match."""
+    re_match = _MULTIPLAYER_MATCH.search(match.strip())
+    if not re_match or not lobby_tracking.tracker.unfollow(int(re_match.group(1))):
+        return await interaction.response.send_message(
+            "That match isn't being followed.", ephemeral=True
+        )
+    await interaction.response.send_message("No longer following that match.")
+
+
+_MENTION = re.compile(r"<@!?(\d+)>")
+SIMULATED_ROUNDS_SHOWN: int = 5
+SIMULATED_PLAYERS_SHOWN: int = 32
+
+
+@simulate_group.command(name="tournament")
+@app_commands.describe(
+    players="Mentions of the players taking part, seeded by rating.",
+    format="How the tournament is played.",
+    iterations="How many times to play the tournament out.",
+)
+async def simulate_tournament(
+    interaction: discord.Interaction,
+    players: str,
+    format: Literal["single elimination", "round robin"] = "single elimination",
+    model: RatingModelType = RatingModelType.OSU,
+    iterations: app_commands.Range[int, 100, 100_000] = 10_000,
+):
+    """Simulate a whole tournament between linked players many times over."""
+    discord_ids = list(dict.fromkeys(int(id) for id in _MENTION.findall(players)))
+    if len(discord_ids) < 2:
+        return await interaction.response.send_message(
+            "Mention at least two players.", ephemeral=True
+        )
+    linked = database.discord_links.osu_ids(DiscordUserId(id) for id in discord_ids)
+    if len(linked) < len(discord_ids):
+        return await interaction.response.send_message(
+            "Every player must have linked their profile.", ephemeral=True
+        )
+    osu_ids = list(linked.values())
+
+    await interaction.response.defer(thinking=True)
+
+    rating_model = ratings.rating_models[model]
+    rating_model.refresh_decay()
+    entrants = sorted(
+        zip(
+            discord_ids,
+            [
+                rating_model.osu_ratings_links.get(osu_id)
+                or rating_model.model.rating(name=str(osu_id))
+                for osu_id in osu_ids
+            ],
+        ),
+        key=lambda entrant: entrant[1].ordinal(),
+        reverse=True,
+    )
+    entrant_ratings = [rating for _, rating in entrants]
+    names = [
+        member.display_name if (member := client.guild.get_member(id)) else str(id)
+        for id, _ in entrants
+    ]
+
+    lines: list[str]
+    match format:
+        case "single elimination":
+            reached = await asyncio.to_thread(
+                simulation.single_elimination,
+                rating_model.model,
+                entrant_ratings,
+                iterations,
+            )
+            rounds = len(reached[0]) - 1
+            labels = [
+                {0: "win", 1: "F", 2: "SF", 3: "QF"}.get(
+                    rounds - column, f"R{2 ** (rounds - column)}"
+                )
+                for column in range(rounds + 1)
+            ][-SIMULATED_ROUNDS_SHOWN:]
+            lines = ["seed " + "".join(f"{label:>7}" for label in labels)] + [
+                f"{seed:>4} "
+                + "".join(f"{chance:>7.1%}" for chance in row[-SIMULATED_ROUNDS_SHOWN:])
+                + f"  {name}"
+                for seed, (name, row) in enumerate(zip(names, reached), 1)
+            ]
+        case "round robin":
+            wins, placements = await asyncio.to_thread(
+                simulation.round_robin,
+                rating_model.model,
+                entrant_ratings,
+                iterations,
+            )
+            lines = ["seed   wins    1st  top 3"] + [
+                f"{seed:>4} {average:>6.2f} {row[0]:>6.1%} {sum(row[:3]):>6.1%}"
+                + f"  {name}"
+                for seed, (name, average, row) in enumerate(
+                    zip(names, wins, placements), 1
+                )
+            ]
+
+    table = "\n".join(lines[: SIMULATED_PLAYERS_SHOWN + 1])
+
+    await interaction.followup.send(
+        f"## {format.capitalize()} of {len(entrants)} players, "
+        + f"simulated {iterations:,} times ({model.value})\n"
+        + f"```\n{table}\n```",
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
+@admin_group.command()
+async def shadows(
+    interaction: discord.Interaction, model: RatingModelType = RatingModelType.OSU
+):
+    """Compare how well the shadow rating models predict matches."""
+    metrics = shadow.runner.metrics(model)
+    if not metrics:
+        return await interaction.response.send_message(
+            "No matches have been compared yet.", ephemeral=True
+        )
+    table = "\n".join(
+        [f"{'model':<26}{'matches':>8}{'log-loss':>10}{'brier':>8}{'accuracy':>10}"]
+        + [
+            f"{variant:<26}{totals.matches:>8}"
+            + f"{totals.log_loss / totals.matches:>10.4f}"
+            + f"{totals.brier / totals.matches:>8.4f}"
+            + f"{totals.correct / totals.matches:>10.1%}"
+            for variant, totals in sorted(
+                metrics.items(),
+                key=lambda item: item[1].log_loss / item[1].matches,
+            )
+        ]
+    )
+    await interaction.response.send_message(
+        f"## Rating models ({model.value})\n```\n{table}\n```", ephemeral=True
+    )
+
+
+# Discord's limit on attachments per message
+FILES_PER_MESSAGE: int = 10
+
+
+@tournament_group.command(name="round")
+@app_commands.describe(
+    players="Mentions of the players taking part.",
+    beatmap="The beatmap every match is played on",
+    pairing="How players are paired up.",
+    round_number="Which round of the round robin to play.",
+)
+async def tournament_round(
+    interaction: discord.Interaction,
+    players: str,
+    beatmap: str,
+    pairing: Literal["as listed", "seeded", "round robin"] = "as listed",
+    round_number: app_commands.Range[int, 1] = 1,
+):
+    """Play a whole round of 1v1 matches at once."""
+    channel = unwrap(interaction.channel)
+    assert isinstance(channel, discord.TextChannel)
+
+    discord_ids = list(dict.fromkeys(int(id) for id in _MENTION.findall(players)))
+    if len(discord_ids) < 2:
+        return await interaction.response.send_message(
+            "Mention at least two players.", ephemeral=True
+        )
+    linked = database.discord_links.osu_ids(DiscordUserId(id) for id in discord_ids)
+    if len(linked) < len(discord_ids):
+        return await interaction.response.send_message(
+            "Every player must have linked their profile.", ephemeral=True
+        )
+    osu_ids = list(linked.values())
+
+    await interaction.response.defer(thinking=True)
+
+    try:
+        mode, beatmap_info = _beatmap_from_url(beatmap)
+    except ValueError as e:
+        return await interaction.followup.send(str(e), ephemeral=True)
+
+    rating_model = ratings.rating_models[RatingModelType.from_gamemodestr(mode)]
+    osu_users = await asyncio.gather(
+        *(asyncio.to_thread(osu.users.__getitem__, (id, mode)) for id in osu_ids)
+    )
+
+    pairs: list[tuple[int, int]]
+    match pairing:
+        case "as listed":
+            pairs = [(i, i + 1) for i in range(0, len(osu_ids) - 1, 2)]
+        case "seeded":
+            rating_model.refresh_decay()
+            seeds = sorted(
+                range(len(osu_ids)),
+                key=lambda i: (
+                    rating_model.osu_ratings_links.get(osu_ids[i])
+                    or rating_model.model.rating()
+                ).ordinal(),
+                reverse=True,
+            )
+            pairs = [
+                (seeds[a], seeds[b])
+                for a, b in tournament.seeded_pairings(len(osu_ids))
+            ]
+        case "round robin":
+            pairs = tournament.round_robin_pairings(len(osu_ids), round_number)
+    sitting_out = [
+        discord_ids[i] for i in range(len(osu_ids)) if not any(i in p for p in pairs)
+    ]
+
+    # before anything is started, so nothing is left half done if it fails
+    predicted = predictions.predictors[rating_model.model_type].predict_many(
+        [(OsuUserId(osu_users[a].id), OsuUserId(osu_users[b].id)) for a, b in pairs]
+    )
+
+    thread = await channel.create_thread(
+        name=f"Tournament round {round_number}"
+        + " "
+        + f"({strftime('%A %B %d', gmtime())})",
+        type=discord.ChannelType.public_thread,
+    )
+    tracked = tournament.start_round(
+        rating_model.model_type,
+        thread.id,
+        beatmap_info,
+        [(osu_users[a], osu_users[b]) for a, b in pairs],
+    )
+    await interaction.followup.send(f"Round started in {thread.mention}.")
+
+    lines = []
+    for (a, b), prediction in zip(pairs, predicted):
+        lines.append(
+            f"<@{discord_ids[a]}> vs <@{discord_ids[b]}> "
+            + f"({graphics.percentage(prediction.win)}% "
+            + f"- {graphics.percentage(prediction.loss)}%)"
+        )
+    if sitting_out:
+        lines.append("Sitting out: " + ", ".join(f"<@{id}>" for id in sitting_out))
+    await thread.send(
+        _beatmap_to_play(beatmap_info),
+        view=OsuBeatmapDownloads(beatmap_info),
+    )
+    await thread.send(
+        "\n".join(lines)
+        + "\n"
+        + f"Matches end <t:{int(unwrap(tracked[0].deadline))}:R>."
+    )
+
+    results = await tournament.finish_round(tracked)
+
+    lines = []
+    banners: list[graphics.OneVOneAfterGraphic] = []
+    for (a, b), result in zip(pairs, results):
+        versus = f"<@{discord_ids[a]}> vs <@{discord_ids[b]}>"
+        if result.scores is None or result.changes is None:
+            lines.append(f"{versus}: no scores")
+            continue
+        score_a, score_b = result.scores[0][0].score, result.scores[1][0].score
+        lines.append(f"{versus}: {score_a:,} - {score_b:,}")
+        if score_a == score_b:
+            continue
+        banners.append(
+            graphics.OneVOneAfterGraphic(
+                (osu_users[b], result.changes[1][0], score_b),
+                (osu_users[a], result.changes[0][0], score_a),
+                rating_model,
+                winner="player2" if score_a > score_b else "player1",
+            )
+        )
+    rendered = await asyncio.to_thread(graphics.render_many, banners)
+    files = [
+        discord.File(BytesIO(image), filename=f"match-{i}.{banner.encoding.extension}")
+        for i, (banner, image) in enumerate(zip(banners, rendered))
+    ]
+    await thread.send(
+        "Round over! Here are the results:\n" + "\n".join(lines),
+        allowed_mentions=discord.AllowedMentions.none(),
+        files=files[:FILES_PER_MESSAGE],
+    )
+    for start in range(FILES_PER_MESSAGE, len(files), FILES_PER_MESSAGE):
+        await thread.send(files=files[start : start + FILES_PER_MESSAGE])
+
+
+@pool_group.command(name="add")
+@app_commands.describe(
+    pool="Name of the map pool",
+    beatmap="The beatmap to add",
+    mods="Mods it's played with, e.g. HDDT",
+)
+async def pool_add(
+    interaction: discord.Interaction, pool: str, beatmap: str, mods: str = "NM"
+):
+    """Add a beatmap to a map pool."""
+    try:
+        _, _, diff_id = parse_beatmap_url(beatmap)
+        mods_bitmask = map_pools.parse_mods(mods)
+    except ValueError:
+        return await interaction.response.send_message(
+            "Invalid beatmap URL or mods.", ephemeral=True
+        )
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        added = await asyncio.to_thread(map_pools.fetch, diff_id, mods_bitmask)
+    except HTTPError:
+        return await interaction.followup.send(
+            "Beatmap not found. Please provide a valid beatmap URL.", ephemeral=True
+        )
+    # the database can only be used from the thread that opened it
+    map_pools.add(pool, added)
+    await interaction.followup.send(
+        f"Added {_beatmap_link(added)} ({added.star_rating:.2f}★) to **{pool}**.",
+        ephemeral=True,
+    )
+
+
+@pool_group.command(name="remove")
+@app_commands.describe(pool="Name of the map pool", beatmap="The beatmap to remove")
+async def pool_remove(interaction: discord.Interaction, pool: str, beatmap: str):
+    """Remove a beatmap from a map pool, with any mods."""
+    try:
+        _, _, diff_id = parse_beatmap_url(beatmap)
+    except ValueError:
+        return await interaction.response.send_message(
+            "Invalid beatmap URL. Please provide a valid beatmap URL.",
+            ephemeral=True,
+        )
+    if not database.map_pools.remove(pool, diff_id):
+        return await interaction.response.send_message(
+            f"That beatmap isn't in **{pool}**.", ephemeral=True
+        )
+    await interaction.response.send_message(
+        f"Removed the beatmap from **{pool}**.", ephemeral=True
+    )
+
+
+# keeps the list within Discord's message length limit
+POOL_BEATMAPS_SHOWN: int = 15
+
+
+@pool_group.command(name="show")
+@app_commands.describe(pool="Name of the map pool, or leave out to list all pools")
+async def pool_show(interaction: discord.Interaction, pool: str | None = None):
+    """Show the beatmaps of a map pool."""
+    if pool is None:
+        pools = database.map_pools.pools()
+        return await interaction.response.send_message(
+            "\n".join(f"**{name}**: {count} beatmaps" for name, count in pools.items())
+            or "There are no map pools yet.",
+            ephemeral=True,
+        )
+    beatmaps = map_pools.beatmaps(pool)
+    if not beatmaps:
+        return await interaction.response.send_message(
+            f"**{pool}** has no beatmaps.", ephemeral=True
+        )
+    await interaction.response.send_message(
+        f"## {pool}\n"
+        + "\n".join(
+            f"{beatmap.star_rating:.2f}★ "
+            + f"{int(beatmap.duration) // 60}:{int(beatmap.duration) % 60:02} "
+            + f"({beatmap.mode.value}) {_beatmap_link(beatmap)}"
+            for beatmap in beatmaps[:POOL_BEATMAPS_SHOWN]
+        )
+        + (
+            f"\n...and {len(beatmaps) - POOL_BEATMAPS_SHOWN} more"
+            if len(beatmaps) > POOL_BEATMAPS_SHOWN
+            else ""
+        ),
+        ephemeral=True,
+        suppress_embeds=True,
+    )
+
+
 client.tree.add_command(link_group)
+client.tree.add_command(queue_group)
+client.tree.add_command(lobby_group)
 
 admin_group.add_command(link_admin_group)
 admin_group.add_command(simulate_group)
+admin_group.add_command(tournament_group)
+admin_group.add_command(pool_group)
 client.tree.add_command(admin_group)
 
 
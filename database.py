@@ -1,8 +1,9 @@
+import json
 import sqlite3
-from typing import Never, override
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Never, override
 
 import discord
-import osu
 from openskill.models.weng_lin.plackett_luce import PlackettLuceRating
 
 from misc.constants import (
@@ -12,6 +13,8 @@ from misc.constants import (
     RatingDataType,
     RatingModelType,
 )
+from misc.decay import SECONDS_PER_DAY
+from misc.users import OsuUser
 
 DATABASE: str = "./osuvs.db"
 
@@ -24,52 +27,395 @@ OSU_ID_COLUMN: str = "osu_id"
 MU_COLUMN: str = "mu"
 SIGMA_COLUMN: str = "sigma"
 
+PLAYER_STATISTICS_TABLE: str = "player_statistics"
+
+MODEL_COLUMN: str = "model"
+MATCH_TYPE_COLUMN: str = "match_type"
+WINS_COLUMN: str = "wins"
+LOSSES_COLUMN: str = "losses"
+DRAWS_COLUMN: str = "draws"
+
+PLAYER_MOD_COMBOS_TABLE: str = "player_mod_combos"
+
+MODS_COLUMN: str = "mods"
+COUNT_COLUMN: str = "count"
+
+HEAD_TO_HEAD_TABLE: str = "head_to_head"
+
+# pairs are stored with the lower osu id as the player
+PLAYER_COLUMN: str = "player"
+OPPONENT_COLUMN: str = "opponent"
+MARGIN_COLUMN: str = "margin"
+LAST_MARGIN_COLUMN: str = "last_margin"
+LAST_PLAYED_COLUMN: str = "last_played"
+
+RATING_HISTORY_TABLE: str = "rating_history"
+RATING_HISTORY_DAILY_TABLE: str = "rating_history_daily"
+
+ENTRY_ID_COLUMN: str = "entry_id"
+
+TIMESTAMP_COLUMN: str = "timestamp"
+DAY_COLUMN: str = "day"
+
+LAST_PLAYED_TABLE: str = "last_played"
+
+MATCH_LOG_TABLE: str = "match_log"
+
+MATCH_ID_COLUMN: str = "match_id"
+TEAMS_COLUMN: str = "teams"
+SCORES_COLUMN: str = "scores"
+
+IMPORT_CHECKPOINTS_TABLE: str = "import_checkpoints"
+
+SOURCE_COLUMN: str = "source"
+POSITION_COLUMN: str = "position"
+
+PROCESSED_SCORES_TABLE: str = "processed_scores"
+
+SCORE_ID_COLUMN: str = "score_id"
+
+ACTIVE_MATCHES_TABLE: str = "active_matches"
+
+STATE_COLUMN: str = "state"
+CHANNEL_ID_COLUMN: str = "channel_id"
+BEATMAP_ID_COLUMN: str = "beatmap_id"
+DEADLINE_COLUMN: str = "deadline"
+
+MAP_POOLS_TABLE: str = "map_pools"
+
+POOL_COLUMN: str = "pool"
+BEATMAPSET_ID_COLUMN: str = "beatmapset_id"
+TITLE_COLUMN: str = "title"
+ARTIST_COLUMN: str = "artist"
+VERSION_COLUMN: str = "version"
+CREATOR_COLUMN: str = "creator"
+LENGTH_COLUMN: str = "length"
+DURATION_COLUMN: str = "duration"
+STAR_RATING_COLUMN: str = "star_rating"
+
+# shadow models are kept apart from the bot's own database, and only ever
+# written to from the shadow worker thread
+SHADOW_DATABASE: str = "./osuvs-shadow.db"
+
+SHADOW_RATINGS_TABLE: str = "shadow_ratings"
+SHADOW_METRICS_TABLE: str = "shadow_metrics"
+
+VARIANT_COLUMN: str = "variant"
+MATCHES_COLUMN: str = "matches"
+LOG_LOSS_COLUMN: str = "log_loss"
+BRIER_COLUMN: str = "brier"
+CORRECT_COLUMN: str = "correct"
+
+# tables added after the initial schema are created here, so existing
+# databases pick them up without having to run init_db.py again
+PLAYER_STATISTICS_SPEC: str = f"""
+    {OSU_ID_COLUMN} UNSIGNED INT,
+    {MODEL_COLUMN} TEXT,
+    {MATCH_TYPE_COLUMN} UNSIGNED INT,
+    {WINS_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {LOSSES_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {DRAWS_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    PRIMARY KEY ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN})
+"""
+PLAYER_MOD_COMBOS_SPEC: str = f"""
+    {OSU_ID_COLUMN} UNSIGNED INT,
+    {MODEL_COLUMN} TEXT,
+    {MATCH_TYPE_COLUMN} UNSIGNED INT,
+    {MODS_COLUMN} UNSIGNED INT,
+    {COUNT_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    PRIMARY KEY ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN}, {MODS_COLUMN})
+"""
+HEAD_TO_HEAD_SPEC: str = f"""
+    {PLAYER_COLUMN} UNSIGNED INT,
+    {OPPONENT_COLUMN} UNSIGNED INT,
+    {MODEL_COLUMN} TEXT,
+    {WINS_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {LOSSES_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {DRAWS_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {MARGIN_COLUMN} REAL NOT NULL DEFAULT 0,
+    {LAST_MARGIN_COLUMN} REAL,
+    {LAST_PLAYED_COLUMN} UNSIGNED INT,
+    PRIMARY KEY ({PLAYER_COLUMN}, {OPPONENT_COLUMN}, {MODEL_COLUMN})
+"""
+# every rating change, in the order it was made, so changes within the same
+# second are all kept
+RATING_HISTORY_SPEC: str = f"""
+    {ENTRY_ID_COLUMN} INTEGER PRIMARY KEY,
+    {OSU_ID_COLUMN} UNSIGNED INT NOT NULL,
+    {MODEL_COLUMN} TEXT NOT NULL,
+    {TIMESTAMP_COLUMN} UNSIGNED INT NOT NULL,
+    {MU_COLUMN} REAL NOT NULL,
+    {SIGMA_COLUMN} REAL NOT NULL
+"""
+LAST_PLAYED_SPEC: str = f"""
+    {OSU_ID_COLUMN} UNSIGNED INT,
+    {MODEL_COLUMN} TEXT,
+    {LAST_PLAYED_COLUMN} UNSIGNED INT NOT NULL,
+    PRIMARY KEY ({OSU_ID_COLUMN}, {MODEL_COLUMN})
+"""
+# every rated match, in the order it was rated, so ratings can be replayed
+MATCH_LOG_SPEC: str = f"""
+    {MATCH_ID_COLUMN} INTEGER PRIMARY KEY,
+    {MODEL_COLUMN} TEXT NOT NULL,
+    {MATCH_TYPE_COLUMN} UNSIGNED INT NOT NULL,
+    {TIMESTAMP_COLUMN} UNSIGNED INT NOT NULL,
+    {TEAMS_COLUMN} TEXT NOT NULL,
+    {SCORES_COLUMN} TEXT
+"""
+# the last rating of every day a player's rating changed
+RATING_HISTORY_DAILY_SPEC: str = f"""
+    {OSU_ID_COLUMN} UNSIGNED INT,
+    {MODEL_COLUMN} TEXT,
+    {DAY_COLUMN} UNSIGNED INT,
+    {MU_COLUMN} REAL NOT NULL,
+    {SIGMA_COLUMN} REAL NOT NULL,
+    PRIMARY KEY ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {DAY_COLUMN})
+"""
+# how many matches of every imported file have been imported so far, so an
+# interrupted import can pick up where it stopped
+IMPORT_CHECKPOINTS_SPEC: str = f"""
+    {SOURCE_COLUMN} TEXT PRIMARY KEY,
+    {POSITION_COLUMN} UNSIGNED INT NOT NULL,
+    {TIMESTAMP_COLUMN} UNSIGNED INT NOT NULL
+"""
+# osu! scores already counted towards a match, so no play is counted twice
+PROCESSED_SCORES_SPEC: str = f"""
+    {SCORE_ID_COLUMN} INTEGER PRIMARY KEY,
+    {TIMESTAMP_COLUMN} UNSIGNED INT NOT NULL
+"""
+# every match started from Discord and how far along it is, so matches still
+# being played can be picked up again after a restart; scores holds the scores
+# found so far by osu id, and mods and duration are those of the beatmap as
+# picked, since the same beatmap can be pooled with different mods
+ACTIVE_MATCHES_SPEC: str = f"""
+    {MATCH_ID_COLUMN} INTEGER PRIMARY KEY,
+    {STATE_COLUMN} UNSIGNED INT NOT NULL,
+    {MODEL_COLUMN} TEXT NOT NULL,
+    {MATCH_TYPE_COLUMN} UNSIGNED INT NOT NULL,
+    {CHANNEL_ID_COLUMN} UNSIGNED INT NOT NULL,
+    {BEATMAP_ID_COLUMN} UNSIGNED INT NOT NULL,
+    {MODS_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {DURATION_COLUMN} REAL NOT NULL,
+    {TEAMS_COLUMN} TEXT NOT NULL,
+    {SCORES_COLUMN} TEXT NOT NULL DEFAULT '{{}}',
+    {DEADLINE_COLUMN} REAL,
+    {TIMESTAMP_COLUMN} UNSIGNED INT NOT NULL
+"""
+# beatmaps picked for matches, with everything needed to play them looked up
+# when they're added; a beatmap can be in a pool more than once with different
+# mods, which duration and star rating are adjusted for
+MAP_POOLS_SPEC: str = f"""
+    {POOL_COLUMN} TEXT,
+    {BEATMAP_ID_COLUMN} UNSIGNED INT,
+    {MODS_COLUMN} UNSIGNED INT,
+    {MODEL_COLUMN} TEXT NOT NULL,
+    {BEATMAPSET_ID_COLUMN} UNSIGNED INT NOT NULL,
+    {TITLE_COLUMN} TEXT NOT NULL,
+    {ARTIST_COLUMN} TEXT NOT NULL,
+    {VERSION_COLUMN} TEXT NOT NULL,
+    {CREATOR_COLUMN} TEXT NOT NULL,
+    {LENGTH_COLUMN} UNSIGNED INT NOT NULL,
+    {DURATION_COLUMN} REAL NOT NULL,
+    {STAR_RATING_COLUMN} REAL NOT NULL,
+    PRIMARY KEY ({POOL_COLUMN}, {BEATMAP_ID_COLUMN}, {MODS_COLUMN})
+"""
+SHADOW_RATINGS_SPEC: str = f"""
+    {VARIANT_COLUMN} TEXT,
+    {MODEL_COLUMN} TEXT,
+    {OSU_ID_COLUMN} UNSIGNED INT,
+    {MU_COLUMN} REAL NOT NULL,
+    {SIGMA_COLUMN} REAL NOT NULL,
+    {LAST_PLAYED_COLUMN} UNSIGNED INT NOT NULL,
+    PRIMARY KEY ({VARIANT_COLUMN}, {MODEL_COLUMN}, {OSU_ID_COLUMN})
+"""
+# running totals of how well every variant, production included, predicted
+# the matches it has seen
+SHADOW_METRICS_SPEC: str = f"""
+    {VARIANT_COLUMN} TEXT,
+    {MODEL_COLUMN} TEXT,
+    {MATCHES_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    {LOG_LOSS_COLUMN} REAL NOT NULL DEFAULT 0,
+    {BRIER_COLUMN} REAL NOT NULL DEFAULT 0,
+    {CORRECT_COLUMN} UNSIGNED INT NOT NULL DEFAULT 0,
+    PRIMARY KEY ({VARIANT_COLUMN}, {MODEL_COLUMN})
+"""
+
 
 con = sqlite3.connect(DATABASE)
 cur = con.cursor()
 
+cur.execute(
+    f"CREATE TABLE IF NOT EXISTS {PLAYER_STATISTICS_TABLE}({PLAYER_STATISTICS_SPEC})"
+)
+cur.execute(
+    f"CREATE TABLE IF NOT EXISTS {PLAYER_MOD_COMBOS_TABLE}({PLAYER_MOD_COMBOS_SPEC})"
+)
+cur.execute(f"CREATE TABLE IF NOT EXISTS {HEAD_TO_HEAD_TABLE}({HEAD_TO_HEAD_SPEC})")
+cur.execute(f"CREATE TABLE IF NOT EXISTS {LAST_PLAYED_TABLE}({LAST_PLAYED_SPEC})")
+cur.execute(f"CREATE TABLE IF NOT EXISTS {MATCH_LOG_TABLE}({MATCH_LOG_SPEC})")
+cur.execute(
+    f"CREATE TABLE IF NOT EXISTS {IMPORT_CHECKPOINTS_TABLE}({IMPORT_CHECKPOINTS_SPEC})"
+)
+cur.execute(
+    f"CREATE TABLE IF NOT EXISTS {PROCESSED_SCORES_TABLE}({PROCESSED_SCORES_SPEC})"
+)
+cur.execute(f"CREATE TABLE IF NOT EXISTS {ACTIVE_MATCHES_TABLE}({ACTIVE_MATCHES_SPEC})")
+cur.execute(
+    f"""CREATE INDEX IF NOT EXISTS {ACTIVE_MATCHES_TABLE}_{STATE_COLUMN}
+        ON {ACTIVE_MATCHES_TABLE}({STATE_COLUMN})"""
+)
+cur.execute(f"CREATE TABLE IF NOT EXISTS {MAP_POOLS_TABLE}({MAP_POOLS_SPEC})")
+cur.execute(
+    f"""CREATE INDEX IF NOT EXISTS {DISCORD_OSU_TABLE}_{OSU_ID_COLUMN}
+        ON {DISCORD_OSU_TABLE}({OSU_ID_COLUMN})"""
+)
+# maps are picked by their place in a pool ordered by star rating
+cur.execute(
+    f"""CREATE INDEX IF NOT EXISTS {MAP_POOLS_TABLE}_{STAR_RATING_COLUMN}
+        ON {MAP_POOLS_TABLE}({MODEL_COLUMN}, {POOL_COLUMN}, {STAR_RATING_COLUMN})"""
+)
+cur.execute(
+    f"""CREATE INDEX IF NOT EXISTS {MAP_POOLS_TABLE}_{MODEL_COLUMN}
+        ON {MAP_POOLS_TABLE}({MODEL_COLUMN}, {STAR_RATING_COLUMN})"""
+)
+cur.execute(
+    f"""CREATE INDEX IF NOT EXISTS {MATCH_LOG_TABLE}_{MODEL_COLUMN}
+        ON {MATCH_LOG_TABLE}({MODEL_COLUMN}, {MATCH_ID_COLUMN})"""
+)
+cur.execute(f"CREATE TABLE IF NOT EXISTS {RATING_HISTORY_TABLE}({RATING_HISTORY_SPEC})")
+cur.execute(
+    f"""CREATE INDEX IF NOT EXISTS {RATING_HISTORY_TABLE}_{OSU_ID_COLUMN}
+        ON {RATING_HISTORY_TABLE}({OSU_ID_COLUMN}, {MODEL_COLUMN}, {TIMESTAMP_COLUMN})"""
+)
+cur.execute(
+    f"""CREATE TABLE IF NOT EXISTS
+        {RATING_HISTORY_DAILY_TABLE}({RATING_HISTORY_DAILY_SPEC})
+        WITHOUT ROWID"""
+)
+con.commit()
+
+_transaction_depth: int = 0
+# called after a transaction is rolled back, by anything that keeps a copy of
+# the database in memory
+_rollback_hooks: list[Callable[[], None]] = []
+# waiting for the transaction they were registered in to be committed
+_after_commit: list[Callable[[], None]] = []
+
+
+@contextmanager
+def transaction() -> Iterator[None]:
+    """Group every write made inside the block into a single commit."""
+    global _transaction_depth
+    _transaction_depth += 1
+    try:
+        yield
+    except BaseException:
+        if _transaction_depth == 1:
+            con.rollback()
+            _after_commit.clear()
+            for hook in _rollback_hooks:
+                hook()
+        raise
+    else:
+        if _transaction_depth == 1:
+            con.commit()
+    finally:
+        _transaction_depth -= 1
+    if _transaction_depth == 0:
+        callbacks = _after_commit.copy()
+        _after_commit.clear()
+        for callback in callbacks:
+            callback()
+
+
+def _commit() -> None:
+    if _transaction_depth == 0:
+        con.commit()
+
+
+def on_rollback(hook: Callable[[], None]) -> None:
+    """Have hook called whenever a transaction is rolled back, to bring a copy
+    of the database kept in memory back in line with it."""
+    _rollback_hooks.append(hook)
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """Call callback once everything written so far is committed: right away
+    outside of a transaction, otherwise when the outermost one commits. It's
+    dropped if the transaction is rolled back instead."""
+    if _transaction_depth == 0:
+        callback()
+    else:
+        _after_commit.append(callback)
+
+
+def _discord_id(
+    discord_user: discord.Member | discord.User | DiscordUserId,
+) -> DiscordUserId:
+    return (
+        DiscordUserId(discord_user.id)
+        if isinstance(discord_user, discord.Member | discord.User)
+        else discord_user
+    )
+
 
 class DiscordLinksDatabase:
+    """Links between Discord users and osu! users, kept in memory both ways
+    and written through to the database. An osu! user can be linked to more
+    than one Discord user."""
+
     table: str
     columns: dict[IdType, str]
+    _osu_ids: dict[DiscordUserId, OsuUserId]
+    # in the order they were linked
+    _discord_ids: dict[OsuUserId, list[DiscordUserId]]
 
     def __init__(self, table: str, columns: dict[IdType, str]) -> None:
         super().__init__()
         self.table = table
         self.columns = columns
+        self.reload()
 
-    def __getitem__(
-        self, discord_user: discord.Member | discord.User | DiscordUserId
-    ) -> OsuUserId:
+    def reload(self) -> None:
         cur.execute(
-            f"""SELECT {self.columns[IdType.OSU_ID]}
+            f"""SELECT {self.columns[IdType.DISCORD_ID]}, {self.columns[IdType.OSU_ID]}
                 FROM {self.table}
-                WHERE {self.columns[IdType.DISCORD_ID]} = ?""",
-            (
-                (
-                    discord_user.id
-                    if isinstance(discord_user, discord.Member | discord.User)
-                    else discord_user
-                ),
-            ),
+                ORDER BY rowid"""
         )
-        result = cur.fetchone()
-        if result is None:
+        self._osu_ids = {}
+        self._discord_ids = {}
+        for discord_id, osu_id in cur.fetchall():
+            self._link(DiscordUserId(discord_id), OsuUserId(osu_id))
+
+    def _link(self, discord_id: DiscordUserId, osu_id: OsuUserId) -> None:
+        self._unlink(discord_id)
+        self._osu_ids[discord_id] = osu_id
+        self._discord_ids.setdefault(osu_id, []).append(discord_id)
+
+    def _unlink(self, discord_id: DiscordUserId) -> None:
+        osu_id = self._osu_ids.pop(discord_id, None)
+        if osu_id is None:
+            return
+        self._discord_ids[osu_id].remove(discord_id)
+        if not self._discord_ids[osu_id]:
+            del self._discord_ids[osu_id]
+
+    def __getitem__(
+        self, discord_user: discord.Member | discord.User | DiscordUserId
+    ) -> OsuUserId:
+        try:
+            return self._osu_ids[_discord_id(discord_user)]
+        except KeyError:
             raise KeyError(f"No osu user linked to Discord user {discord_user}")
-        return result[0]
 
     def __setitem__(
         self,
         discord_user: discord.Member | discord.User | DiscordUserId,
-        osu_user: osu.User | OsuUserId,
+        osu_user: OsuUser | OsuUserId,
     ) -> None:
         data: dict[str, int] = {
-            "discord_id": (
-                discord_user.id
-                if isinstance(discord_user, discord.Member | discord.User)
-                else discord_user
-            ),
-            "osu_id": osu_user.id if isinstance(osu_user, osu.User) else osu_user,
+            "discord_id": _discord_id(discord_user),
+            "osu_id": osu_user if isinstance(osu_user, int) else osu_user.id,
         }
         cur.execute(
             f"""INSERT OR REPLACE INTO {self.table}
@@ -77,40 +423,52 @@ class DiscordLinksDatabase:
                 VALUES (:discord_id, :osu_id)""",
             data,
         )
-        con.commit()
+        _commit()
+        self._link(DiscordUserId(data["discord_id"]), OsuUserId(data["osu_id"]))
 
     def __delitem__(
         self, discord_user: discord.Member | discord.User | DiscordUserId
     ) -> None:
+        discord_id = _discord_id(discord_user)
         cur.execute(
             f"""DELETE FROM {self.table}
                 WHERE {self.columns[IdType.DISCORD_ID]} =?""",
-            (
-                (
-                    discord_user.id
-                    if isinstance(discord_user, discord.Member | discord.User)
-                    else discord_user
-                ),
-            ),
+            (discord_id,),
         )
-        con.commit()
+        _commit()
+        self._unlink(discord_id)
 
     def __contains__(
         self, discord_user: discord.Member | discord.User | DiscordUserId
     ) -> bool:
-        cur.execute(
-            f"""SELECT 1
-                FROM {self.table}
-                WHERE {self.columns[IdType.DISCORD_ID]} =?""",
-            (
-                (
-                    discord_user.id
-                    if isinstance(discord_user, discord.Member | discord.User)
-                    else discord_user
-                ),
-            ),
-        )
-        return cur.fetchone() is not None
+        return _discord_id(discord_user) in self._osu_ids
+
+    def discord_id(self, osu_id: OsuUserId) -> DiscordUserId:
+        """The Discord user who first linked an osu! user."""
+        try:
+            return self._discord_ids[osu_id][0]
+        except KeyError:
+            raise KeyError(f"No Discord user linked to osu user {osu_id}")
+
+    def osu_ids(
+        self, discord_users: Iterable[discord.Member | discord.User | DiscordUserId]
+    ) -> dict[DiscordUserId, OsuUserId]:
+        """The osu! users linked to each of the Discord users that has one."""
+        return {
+            discord_id: self._osu_ids[discord_id]
+            for discord_id in map(_discord_id, discord_users)
+            if discord_id in self._osu_ids
+        }
+
+    def discord_ids(
+        self, osu_ids: Iterable[OsuUserId]
+    ) -> dict[OsuUserId, DiscordUserId]:
+        """The Discord user linked to each of the osu! users that has one."""
+        return {
+            osu_id: self._discord_ids[osu_id][0]
+            for osu_id in osu_ids
+            if osu_id in self._discord_ids
+        }
 
 
 class AbstractOsuRatingsDatabase:
@@ -127,31 +485,31 @@ class AbstractOsuRatingsDatabase:
     def __setitem__(self, key, value) -> Never:
         raise NotImplementedError("Subclass must implement __setitem__ method")
 
-    def __delitem__(self, osu_user: osu.User | OsuUserId) -> None:
+    def __delitem__(self, osu_user: OsuUser | OsuUserId) -> None:
         cur.execute(
             f"""DELETE FROM {self.table}
                 WHERE {self.columns[IdType.OSU_ID]} =?""",
-            (osu_user.id if isinstance(osu_user, osu.User) else osu_user,),
+            (osu_user if isinstance(osu_user, int) else osu_user.id,),
         )
-        con.commit()
+        _commit()
 
-    def __contains__(self, osu_user: osu.User | OsuUserId) -> bool:
+    def __contains__(self, osu_user: OsuUser | OsuUserId) -> bool:
         cur.execute(
             f"""SELECT 1
                 FROM {self.table}
                 WHERE {self.columns[IdType.OSU_ID]} =?""",
-            (osu_user.id if isinstance(osu_user, osu.User) else osu_user,),
+            (osu_user if isinstance(osu_user, int) else osu_user.id,),
         )
         return cur.fetchone() is not None
 
-    def init_blank_ratings(self, osu_user: osu.User | OsuUserId) -> None:
+    def init_blank_ratings(self, osu_user: OsuUser | OsuUserId) -> None:
         cur.execute(
             f"""INSERT INTO {self.table}
                 ({self.columns[IdType.OSU_ID]})
                 VALUES (?)""",
-            (osu_user.id if isinstance(osu_user, osu.User) else osu_user,),
+            (osu_user if isinstance(osu_user, int) else osu_user.id,),
         )
-        con.commit()
+        _commit()
 
 
 class OsuRatingsDatabase(AbstractOsuRatingsDatabase):
@@ -170,13 +528,13 @@ class OsuRatingsDatabase(AbstractOsuRatingsDatabase):
 
     @override
     def __getitem__(
-        self, osu_user: osu.User | OsuUserId
+        self, osu_user: OsuUser | OsuUserId
     ) -> dict[RatingDataType, float] | PlackettLuceRating:
         cur.execute(
             f"""SELECT {self.columns[RatingDataType.MU]}, {self.columns[RatingDataType.SIGMA]}
                 FROM {self.table}
                 WHERE {self.columns[IdType.OSU_ID]} =?""",
-            (osu_user.id if isinstance(osu_user, osu.User) else osu_user,),
+            (osu_user if isinstance(osu_user, int) else osu_user.id,),
         )
         result = cur.fetchone()
         if result is None:
@@ -189,12 +547,12 @@ class OsuRatingsDatabase(AbstractOsuRatingsDatabase):
     @override
     def __setitem__(
         self,
-        osu_user: osu.User | OsuUserId,
+        osu_user: OsuUser | OsuUserId,
         value: PlackettLuceRating | dict[RatingDataType, float],
     ) -> None:
         data: dict[str, float | int | OsuUserId] = {
             self.columns[IdType.OSU_ID]: (
-                osu_user.id if isinstance(osu_user, osu.User) else osu_user
+                osu_user if isinstance(osu_user, int) else osu_user.id
             ),
             self.columns[RatingDataType.MU]: (
                 value.mu
@@ -227,49 +585,68 @@ class OsuRatingsDatabase(AbstractOsuRatingsDatabase):
                             :{self.columns[RatingDataType.SIGMA]})""",
                 data,
             )
-        con.commit()
+        _commit()
 
     @override
-    def __delitem__(self, osu_user: osu.User | OsuUserId) -> None:
+    def __delitem__(self, osu_user: OsuUser | OsuUserId) -> None:
         cur.execute(
             f"""UPDATE {self.table}
                 SET
                     {self.columns[RatingDataType.MU]} = NULL,
                     {self.columns[RatingDataType.SIGMA]} = NULL
                 WHERE {self.columns[IdType.OSU_ID]} =?""",
-            (osu_user.id if isinstance(osu_user, osu.User) else osu_user,),
+            (osu_user if isinstance(osu_user, int) else osu_user.id,),
         )
 
     def update(
         self,
         values: (
-            dict[osu.User, PlackettLuceRating] | dict[OsuUserId, PlackettLuceRating]
+            dict[OsuUser, PlackettLuceRating]
+            | dict[OsuUserId, PlackettLuceRating]
+            | dict[OsuUserId, dict[RatingDataType, float]]
         ),
     ) -> None:
         cur.executemany(
-            f"""UPDATE {self.table}
-                SET
-                    {self.columns[RatingDataType.MU]} = :{self.columns[RatingDataType.MU]},
-                    {self.columns[RatingDataType.SIGMA]} = :{self.columns[RatingDataType.SIGMA]}
-                WHERE {self.columns[IdType.OSU_ID]} = :{self.columns[IdType.OSU_ID]}""",
+            f"""INSERT INTO {self.table}
+                ({self.columns[IdType.OSU_ID]},
+                 {self.columns[RatingDataType.MU]},
+                 {self.columns[RatingDataType.SIGMA]})
+                VALUES (:{self.columns[IdType.OSU_ID]},
+                        :{self.columns[RatingDataType.MU]},
+                        :{self.columns[RatingDataType.SIGMA]})
+                ON CONFLICT ({self.columns[IdType.OSU_ID]}) DO UPDATE SET
+                    {self.columns[RatingDataType.MU]} = excluded.{self.columns[RatingDataType.MU]},
+                    {self.columns[RatingDataType.SIGMA]} = excluded.{self.columns[RatingDataType.SIGMA]}""",
             [
-                (
-                    osu_user.id if isinstance(osu_user, osu.User) else osu_user,
-                    (
+                {
+                    self.columns[IdType.OSU_ID]: (
+                        osu_user if isinstance(osu_user, int) else osu_user.id
+                    ),
+                    self.columns[RatingDataType.MU]: (
                         value.mu
                         if isinstance(value, PlackettLuceRating)
                         else value[RatingDataType.MU]
                     ),
-                    (
+                    self.columns[RatingDataType.SIGMA]: (
                         value.sigma
                         if isinstance(value, PlackettLuceRating)
                         else value[RatingDataType.SIGMA]
                     ),
-                )
+                }
                 for osu_user, value in values.items()
             ],
         )
-        con.commit()
+        _commit()
+
+    def clear(self) -> None:
+        """Reset every player's rating in this model back to blank."""
+        cur.execute(
+            f"""UPDATE {self.table}
+                SET
+                    {self.columns[RatingDataType.MU]} = NULL,
+                    {self.columns[RatingDataType.SIGMA]} = NULL"""
+        )
+        _commit()
 
     def dict(self) -> dict[OsuUserId, dict[RatingDataType, float]]:
         cur.execute(
@@ -289,10 +666,712 @@ class OsuRatingsDatabase(AbstractOsuRatingsDatabase):
         }
 
 
+class PlayerStatisticsDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def increment(
+        self, values: list[tuple[OsuUserId, str, int, int, int, int]]
+    ) -> None:
+        """Add (osu_id, model, match_type, wins, losses, draws) to the stored
+        counters."""
+        cur.executemany(
+            f"""INSERT INTO {self.table}
+                ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN},
+                 {WINS_COLUMN}, {LOSSES_COLUMN}, {DRAWS_COLUMN})
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN})
+                DO UPDATE SET
+                    {WINS_COLUMN} = {WINS_COLUMN} + excluded.{WINS_COLUMN},
+                    {LOSSES_COLUMN} = {LOSSES_COLUMN} + excluded.{LOSSES_COLUMN},
+                    {DRAWS_COLUMN} = {DRAWS_COLUMN} + excluded.{DRAWS_COLUMN}""",
+            values,
+        )
+        _commit()
+
+    def all(self) -> list[tuple[OsuUserId, str, int, int, int, int]]:
+        cur.execute(
+            f"""SELECT
+                    {OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN},
+                    {WINS_COLUMN}, {LOSSES_COLUMN}, {DRAWS_COLUMN}
+                FROM {self.table}"""
+        )
+        return cur.fetchall()
+
+
+class PlayerModCombosDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def increment(self, values: list[tuple[OsuUserId, str, int, int, int]]) -> None:
+        """Add (osu_id, model, match_type, mods, count) to the stored counters.
+        mods is a legacy mod bitmask."""
+        cur.executemany(
+            f"""INSERT INTO {self.table}
+                ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN},
+                 {MODS_COLUMN}, {COUNT_COLUMN})
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT
+                    ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN}, {MODS_COLUMN})
+                DO UPDATE SET
+                    {COUNT_COLUMN} = {COUNT_COLUMN} + excluded.{COUNT_COLUMN}""",
+            values,
+        )
+        _commit()
+
+    def all(self) -> list[tuple[OsuUserId, str, int, int, int]]:
+        cur.execute(
+            f"""SELECT
+                    {OSU_ID_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN},
+                    {MODS_COLUMN}, {COUNT_COLUMN}
+                FROM {self.table}"""
+        )
+        return cur.fetchall()
+
+
+class HeadToHeadDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def record(
+        self,
+        values: list[tuple[OsuUserId, OsuUserId, str, int, int, int, int | float, int]],
+    ) -> None:
+        """Add (player, opponent, model, wins, losses, draws, margin, last_played)
+        to the stored record, seen from the player's side. The margin also
+        replaces the last margin, unless the record already has a later match,
+        as imported matches can be older than ones already recorded."""
+        cur.executemany(
+            f"""INSERT INTO {self.table}
+                ({PLAYER_COLUMN}, {OPPONENT_COLUMN}, {MODEL_COLUMN},
+                 {WINS_COLUMN}, {LOSSES_COLUMN}, {DRAWS_COLUMN},
+                 {MARGIN_COLUMN}, {LAST_MARGIN_COLUMN}, {LAST_PLAYED_COLUMN})
+                VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?7, ?8)
+                ON CONFLICT ({PLAYER_COLUMN}, {OPPONENT_COLUMN}, {MODEL_COLUMN})
+                DO UPDATE SET
+                    {WINS_COLUMN} = {WINS_COLUMN} + excluded.{WINS_COLUMN},
+                    {LOSSES_COLUMN} = {LOSSES_COLUMN} + excluded.{LOSSES_COLUMN},
+                    {DRAWS_COLUMN} = {DRAWS_COLUMN} + excluded.{DRAWS_COLUMN},
+                    {MARGIN_COLUMN} = {MARGIN_COLUMN} + excluded.{MARGIN_COLUMN},
+                    {LAST_MARGIN_COLUMN} = CASE
+                        WHEN {LAST_PLAYED_COLUMN} IS NULL
+                            OR excluded.{LAST_PLAYED_COLUMN} >= {LAST_PLAYED_COLUMN}
+                        THEN excluded.{LAST_MARGIN_COLUMN}
+                        ELSE {LAST_MARGIN_COLUMN} END,
+                    {LAST_PLAYED_COLUMN} = MAX(
+                        COALESCE({LAST_PLAYED_COLUMN}, excluded.{LAST_PLAYED_COLUMN}),
+                        excluded.{LAST_PLAYED_COLUMN}
+                    )""",
+            values,
+        )
+        _commit()
+
+    def all(
+        self,
+    ) -> list[
+        tuple[OsuUserId, OsuUserId, str, int, int, int, float, float | None, int | None]
+    ]:
+        cur.execute(
+            f"""SELECT
+                    {PLAYER_COLUMN}, {OPPONENT_COLUMN}, {MODEL_COLUMN},
+                    {WINS_COLUMN}, {LOSSES_COLUMN}, {DRAWS_COLUMN},
+                    {MARGIN_COLUMN}, {LAST_MARGIN_COLUMN}, {LAST_PLAYED_COLUMN}
+                FROM {self.table}"""
+        )
+        return cur.fetchall()
+
+
+class RatingHistoryDatabase:
+    table: str
+    daily_table: str
+
+    def __init__(self, table: str, daily_table: str) -> None:
+        self.table = table
+        self.daily_table = daily_table
+
+    def append(
+        self, model: str, entries: list[tuple[OsuUserId, int, float, float]]
+    ) -> None:
+        """Record (osu_id, timestamp, mu, sigma) for every entry, and roll them
+        up into the daily table."""
+        values = [
+            (osu_id, model, timestamp, mu, sigma)
+            for osu_id, timestamp, mu, sigma in entries
+        ]
+        cur.executemany(
+            f"""INSERT INTO {self.table}
+                ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {TIMESTAMP_COLUMN},
+                 {MU_COLUMN}, {SIGMA_COLUMN})
+                VALUES (?, ?, ?, ?, ?)""",
+            values,
+        )
+        cur.executemany(
+            f"""INSERT INTO {self.daily_table}
+                ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {DAY_COLUMN},
+                 {MU_COLUMN}, {SIGMA_COLUMN})
+                VALUES (?1, ?2, ?3 / {SECONDS_PER_DAY}, ?4, ?5)
+                ON CONFLICT ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {DAY_COLUMN})
+                DO UPDATE SET
+                    {MU_COLUMN} = excluded.{MU_COLUMN},
+                    {SIGMA_COLUMN} = excluded.{SIGMA_COLUMN}""",
+            values,
+        )
+        _commit()
+
+    def range(
+        self, osu_id: OsuUserId, model: str, start: int, end: int | None = None
+    ) -> list[tuple[int, float, float]]:
+        """Every (timestamp, mu, sigma) from start up to, but not including, end."""
+        cur.execute(
+            f"""SELECT {TIMESTAMP_COLUMN}, {MU_COLUMN}, {SIGMA_COLUMN}
+                FROM {self.table}
+                WHERE {OSU_ID_COLUMN} = ? AND {MODEL_COLUMN} = ?
+                    AND {TIMESTAMP_COLUMN} >= ? AND {TIMESTAMP_COLUMN} < ?
+                ORDER BY {TIMESTAMP_COLUMN}, {ENTRY_ID_COLUMN}""",
+            (osu_id, model, start, end if end is not None else 2**63 - 1),
+        )
+        return cur.fetchall()
+
+    def latest_before(
+        self, osu_id: OsuUserId, model: str, end: int
+    ) -> tuple[int, float, float] | None:
+        """The last (timestamp, mu, sigma) recorded before end, if any."""
+        cur.execute(
+            f"""SELECT {TIMESTAMP_COLUMN}, {MU_COLUMN}, {SIGMA_COLUMN}
+                FROM {self.table}
+                WHERE {OSU_ID_COLUMN} = ? AND {MODEL_COLUMN} = ?
+                    AND {TIMESTAMP_COLUMN} < ?
+                ORDER BY {TIMESTAMP_COLUMN} DESC, {ENTRY_ID_COLUMN} DESC
+                LIMIT 1""",
+            (osu_id, model, end),
+        )
+        return cur.fetchone()
+
+    def daily(
+        self, osu_id: OsuUserId, model: str, start: int
+    ) -> list[tuple[int, float, float]]:
+        """The closing (timestamp, mu, sigma) of every day since start, with the
+        timestamp at the start of the day."""
+        cur.execute(
+            f"""SELECT {DAY_COLUMN} * {SECONDS_PER_DAY}, {MU_COLUMN}, {SIGMA_COLUMN}
+                FROM {self.daily_table}
+                WHERE {OSU_ID_COLUMN} = ? AND {MODEL_COLUMN} = ?
+                    AND {DAY_COLUMN} >= ?
+                ORDER BY {DAY_COLUMN}""",
+            (osu_id, model, start // SECONDS_PER_DAY),
+        )
+        return cur.fetchall()
+
+
+class LastPlayedDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def set(self, model: str, values: dict[OsuUserId, int]) -> None:
+        cur.executemany(
+            f"""INSERT INTO {self.table}
+                ({OSU_ID_COLUMN}, {MODEL_COLUMN}, {LAST_PLAYED_COLUMN})
+                VALUES (?, ?, ?)
+                ON CONFLICT ({OSU_ID_COLUMN}, {MODEL_COLUMN}) DO UPDATE SET
+                    {LAST_PLAYED_COLUMN} = excluded.{LAST_PLAYED_COLUMN}""",
+            [(osu_id, model, timestamp) for osu_id, timestamp in values.items()],
+        )
+        _commit()
+
+    def dict(self, model: str) -> dict[OsuUserId, int]:
+        cur.execute(
+            f"""SELECT {OSU_ID_COLUMN}, {LAST_PLAYED_COLUMN}
+                FROM {self.table}
+                WHERE {MODEL_COLUMN} = ?""",
+            (model,),
+        )
+        return {OsuUserId(osu_id): timestamp for osu_id, timestamp in cur.fetchall()}
+
+    def clear(self, model: str) -> None:
+        cur.execute(f"""DELETE FROM {self.table} WHERE {MODEL_COLUMN} = ?""", (model,))
+        _commit()
+
+
+class MatchLogDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def append(
+        self,
+        model: str,
+        match_type: int,
+        timestamp: int,
+        teams: list[list[OsuUserId]],
+        scores: list[list[int | float]] | None,
+    ) -> int:
+        cur.execute(
+            f"""INSERT INTO {self.table}
+                ({MODEL_COLUMN}, {MATCH_TYPE_COLUMN}, {TIMESTAMP_COLUMN},
+                 {TEAMS_COLUMN}, {SCORES_COLUMN})
+                VALUES (?, ?, ?, ?, ?)""",
+            (
+                model,
+                match_type,
+                timestamp,
+                json.dumps(teams),
+                json.dumps(scores) if scores is not None else None,
+            ),
+        )
+        match_id = cur.lastrowid
+        assert match_id is not None
+        _commit()
+        return match_id
+
+    def matches(
+        self,
+        model: str,
+        before: int | None = None,
+        cursor: sqlite3.Cursor | None = None,
+    ) -> list[tuple[int, list[list[OsuUserId]], list[list[int | float]] | None]]:
+        """(timestamp, teams, scores) of every match rated in a model, oldest
+        first, or only those logged before the match with id before. Imported
+        matches can be older than ones rated before them, so they're ordered
+        by when they were played rather than rated. Other threads pass a
+        cursor of their own to read through."""
+        cursor = cursor or cur
+        cursor.execute(
+            f"""SELECT {TIMESTAMP_COLUMN}, {TEAMS_COLUMN}, {SCORES_COLUMN}
+                FROM {self.table}
+                WHERE {MODEL_COLUMN} = ? AND (? IS NULL OR {MATCH_ID_COLUMN} < ?)
+                ORDER BY {TIMESTAMP_COLUMN}, {MATCH_ID_COLUMN}""",
+            (model, before, before),
+        )
+        return [
+            (
+                timestamp,
+                [[OsuUserId(osu_id) for osu_id in team] for team in json.loads(teams)],
+                json.loads(scores) if scores is not None else None,
+            )
+            for timestamp, teams, scores in cursor.fetchall()
+        ]
+
+
+class ImportCheckpointsDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def get(self, source: str) -> int:
+        """How many matches of a source have been imported."""
+        cur.execute(
+            f"SELECT {POSITION_COLUMN} FROM {self.table} WHERE {SOURCE_COLUMN} = ?",
+            (source,),
+        )
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+    def set(self, source: str, position: int, timestamp: int) -> None:
+        cur.execute(
+            f"""INSERT INTO {self.table}
+                ({SOURCE_COLUMN}, {POSITION_COLUMN}, {TIMESTAMP_COLUMN})
+                VALUES (?, ?, ?)
+                ON CONFLICT ({SOURCE_COLUMN}) DO UPDATE SET
+                    {POSITION_COLUMN} = excluded.{POSITION_COLUMN},
+                    {TIMESTAMP_COLUMN} = excluded.{TIMESTAMP_COLUMN}""",
+            (source, position, timestamp),
+        )
+        _commit()
+
+
+class ProcessedScoresDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def add(self, score_ids: list[int], timestamp: int) -> None:
+        cur.executemany(
+            f"""INSERT OR IGNORE INTO {self.table}
+                ({SCORE_ID_COLUMN}, {TIMESTAMP_COLUMN})
+                VALUES (?, ?)""",
+            [(score_id, timestamp) for score_id in score_ids],
+        )
+        _commit()
+
+    def __contains__(self, score_id: int) -> bool:
+        cur.execute(
+            f"SELECT 1 FROM {self.table} WHERE {SCORE_ID_COLUMN} = ?", (score_id,)
+        )
+        return cur.fetchone() is not None
+
+    def since(self, timestamp: int) -> list[tuple[int, int]]:
+        """(timestamp, score id) of the scores processed since a timestamp,
+        oldest first."""
+        cur.execute(
+            f"""SELECT {TIMESTAMP_COLUMN}, {SCORE_ID_COLUMN}
+                FROM {self.table}
+                WHERE {TIMESTAMP_COLUMN} >= ?
+                ORDER BY {TIMESTAMP_COLUMN}""",
+            (timestamp,),
+        )
+        return cur.fetchall()
+
+    def latest_before(self, timestamp: int) -> int:
+        """Highest score id processed before a timestamp, or 0."""
+        cur.execute(
+            f"""SELECT MAX({SCORE_ID_COLUMN}) FROM {self.table}
+                WHERE {TIMESTAMP_COLUMN} < ?""",
+            (timestamp,),
+        )
+        return cur.fetchone()[0] or 0
+
+
+# (match id, state, model, match type, channel id, beatmap id, mods,
+# duration, teams, scores found so far as osu id -> (score, mods, score id),
+# deadline)
+ActiveMatch = tuple[
+    int,
+    int,
+    str,
+    int,
+    int,
+    int,
+    int,
+    float,
+    list[list[OsuUserId]],
+    dict[OsuUserId, tuple[int, int | None, int | None]],
+    float | None,
+]
+
+
+class ActiveMatchesDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def create(
+        self,
+        state: int,
+        model: str,
+        match_type: int,
+        channel_id: int,
+        beatmap_id: int,
+        mods: int,
+        duration: float,
+        teams: list[list[OsuUserId]],
+        timestamp: int,
+    ) -> int:
+        cur.execute(
+            f"""INSERT INTO {self.table}
+                ({STATE_COLUMN}, {MODEL_COLUMN}, {MATCH_TYPE_COLUMN},
+                 {CHANNEL_ID_COLUMN}, {BEATMAP_ID_COLUMN}, {MODS_COLUMN},
+                 {DURATION_COLUMN}, {TEAMS_COLUMN}, {TIMESTAMP_COLUMN})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                state,
+                model,
+                match_type,
+                channel_id,
+                beatmap_id,
+                mods,
+                duration,
+                json.dumps(teams),
+                timestamp,
+            ),
+        )
+        match_id = cur.lastrowid
+        assert match_id is not None
+        _commit()
+        return match_id
+
+    def set_state(
+        self, match_id: int, state: int, deadline: float | None = None
+    ) -> None:
+        """Move a match on to another state, also setting its deadline if
+        given."""
+        cur.execute(
+            f"""UPDATE {self.table} SET
+                    {STATE_COLUMN} = ?,
+                    {DEADLINE_COLUMN} = COALESCE(?, {DEADLINE_COLUMN})
+                WHERE {MATCH_ID_COLUMN} = ?""",
+            (state, deadline, match_id),
+        )
+        _commit()
+
+    def set_scores(
+        self, match_id: int, scores: dict[OsuUserId, tuple[int, int | None, int | None]]
+    ) -> None:
+        cur.execute(
+            f"""UPDATE {self.table} SET {SCORES_COLUMN} = ?
+                WHERE {MATCH_ID_COLUMN} = ?""",
+            (json.dumps(scores), match_id),
+        )
+        _commit()
+
+    def in_states(self, states: list[int]) -> list[ActiveMatch]:
+        """Every match currently in one of the given states, oldest first."""
+        cur.execute(
+            f"""SELECT {MATCH_ID_COLUMN}, {STATE_COLUMN}, {MODEL_COLUMN},
+                    {MATCH_TYPE_COLUMN}, {CHANNEL_ID_COLUMN}, {BEATMAP_ID_COLUMN},
+                    {MODS_COLUMN}, {DURATION_COLUMN}, {TEAMS_COLUMN},
+                    {SCORES_COLUMN}, {DEADLINE_COLUMN}
+                FROM {self.table}
+                WHERE {STATE_COLUMN} IN ({", ".join("?" * len(states))})
+                ORDER BY {MATCH_ID_COLUMN}""",
+            states,
+        )
+        return [
+            (
+                match_id,
+                state,
+                model,
+                match_type,
+                channel_id,
+                beatmap_id,
+                mods,
+                duration,
+                [[OsuUserId(osu_id) for osu_id in team] for team in json.loads(teams)],
+                {
+                    OsuUserId(int(osu_id)): (score, score_mods, score_id)
+                    for osu_id, (score, score_mods, score_id) in json.loads(
+                        scores
+                    ).items()
+                },
+                deadline,
+            )
+            for (
+                match_id,
+                state,
+                model,
+                match_type,
+                channel_id,
+                beatmap_id,
+                mods,
+                duration,
+                teams,
+                scores,
+                deadline,
+            ) in cur.fetchall()
+        ]
+
+
+# (beatmap id, beatmapset id, model, title, artist, version, creator, length,
+# mods, duration, star rating)
+PooledBeatmap = tuple[int, int, str, str, str, str, str, int, int, float, float]
+
+_POOLED_BEATMAP_COLUMNS: str = f"""{BEATMAP_ID_COLUMN}, {BEATMAPSET_ID_COLUMN},
+    {MODEL_COLUMN}, {TITLE_COLUMN}, {ARTIST_COLUMN}, {VERSION_COLUMN},
+    {CREATOR_COLUMN}, {LENGTH_COLUMN}, {MODS_COLUMN}, {DURATION_COLUMN},
+    {STAR_RATING_COLUMN}"""
+
+
+class MapPoolsDatabase:
+    table: str
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+
+    def add(self, pool: str, beatmap: PooledBeatmap) -> None:
+        cur.execute(
+            f"""INSERT OR REPLACE INTO {self.table}
+                ({POOL_COLUMN}, {_POOLED_BEATMAP_COLUMNS})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (pool, *beatmap),
+        )
+        _commit()
+
+    def remove(self, pool: str, beatmap_id: int) -> bool:
+        cur.execute(
+            f"""DELETE FROM {self.table}
+                WHERE {POOL_COLUMN} = ? AND {BEATMAP_ID_COLUMN} = ?""",
+            (pool, beatmap_id),
+        )
+        _commit()
+        return cur.rowcount > 0
+
+    def pools(self) -> dict[str, int]:
+        """How many beatmaps every pool has."""
+        cur.execute(
+            f"""SELECT {POOL_COLUMN}, COUNT(*) FROM {self.table}
+                GROUP BY {POOL_COLUMN} ORDER BY {POOL_COLUMN}"""
+        )
+        return dict(cur.fetchall())
+
+    def beatmaps(self, pool: str) -> list[PooledBeatmap]:
+        cur.execute(
+            f"""SELECT {_POOLED_BEATMAP_COLUMNS} FROM {self.table}
+                WHERE {POOL_COLUMN} = ?
+                ORDER BY {MODEL_COLUMN}, {STAR_RATING_COLUMN}""",
+            (pool,),
+        )
+        return cur.fetchall()
+
+    def get(self, beatmap_id: int, mods: int = 0) -> PooledBeatmap | None:
+        """A beatmap as stored in any pool with the given mods."""
+        cur.execute(
+            f"""SELECT {_POOLED_BEATMAP_COLUMNS} FROM {self.table}
+                WHERE {BEATMAP_ID_COLUMN} = ? AND {MODS_COLUMN} = ?
+                LIMIT 1""",
+            (beatmap_id, mods),
+        )
+        return cur.fetchone()
+
+    def _where(self, pool: str | None) -> str:
+        return f"{MODEL_COLUMN} = ?" + (f" AND {POOL_COLUMN} = ?" if pool else "")
+
+    def count(self, model: str, pool: str | None = None) -> int:
+        """How many beatmaps of a model a pool has, or all pools if none is
+        given."""
+        cur.execute(
+            f"SELECT COUNT(*) FROM {self.table} WHERE {self._where(pool)}",
+            (model, pool) if pool else (model,),
+        )
+        return cur.fetchone()[0]
+
+    def nth(self, model: str, index: int, pool: str | None = None) -> PooledBeatmap:
+        """The beatmap at an index of a pool (or all pools) ordered by star
+        rating, easiest first."""
+        cur.execute(
+            f"""SELECT {_POOLED_BEATMAP_COLUMNS} FROM {self.table}
+                WHERE {self._where(pool)}
+                ORDER BY {STAR_RATING_COLUMN}
+                LIMIT 1 OFFSET ?""",
+            (model, pool, index) if pool else (model, index),
+        )
+        return cur.fetchone()
+
+
+ShadowMetrics = tuple[int, float, float, int]
+
+
+class ShadowDatabase:
+    """Ratings and prediction metrics of the shadow models. Has a connection
+    of its own, so it must be created on the thread that uses it."""
+
+    con: sqlite3.Connection
+    cur: sqlite3.Cursor
+    # to read the match log with
+    log_cur: sqlite3.Cursor
+
+    def __init__(self, path: str = SHADOW_DATABASE, log_path: str = DATABASE) -> None:
+        self.con = sqlite3.connect(path)
+        self.cur = self.con.cursor()
+        self.log_cur = sqlite3.connect(log_path).cursor()
+        self.cur.execute(
+            f"""CREATE TABLE IF NOT EXISTS
+                {SHADOW_RATINGS_TABLE}({SHADOW_RATINGS_SPEC})
+                WITHOUT ROWID"""
+        )
+        self.cur.execute(
+            f"""CREATE TABLE IF NOT EXISTS
+                {SHADOW_METRICS_TABLE}({SHADOW_METRICS_SPEC})"""
+        )
+        self.con.commit()
+
+    def ratings(
+        self, variant: str, model: str
+    ) -> dict[OsuUserId, tuple[float, float, int]]:
+        """(mu, sigma, last played) of every player rated by a variant."""
+        self.cur.execute(
+            f"""SELECT {OSU_ID_COLUMN}, {MU_COLUMN}, {SIGMA_COLUMN},
+                    {LAST_PLAYED_COLUMN}
+                FROM {SHADOW_RATINGS_TABLE}
+                WHERE {VARIANT_COLUMN} = ? AND {MODEL_COLUMN} = ?""",
+            (variant, model),
+        )
+        return {
+            OsuUserId(osu_id): (mu, sigma, last_played)
+            for osu_id, mu, sigma, last_played in self.cur.fetchall()
+        }
+
+    def seed(
+        self,
+        variant: str,
+        model: str,
+        ratings: dict[OsuUserId, tuple[float, float, int]],
+    ) -> None:
+        """Store a variant's first (mu, sigma, last played) of players rated
+        before it was. Nothing is committed until commit()."""
+        self.cur.executemany(
+            f"""INSERT INTO {SHADOW_RATINGS_TABLE}
+                ({VARIANT_COLUMN}, {MODEL_COLUMN}, {OSU_ID_COLUMN}, {MU_COLUMN},
+                    {SIGMA_COLUMN}, {LAST_PLAYED_COLUMN})
+                VALUES (?, ?, ?, ?, ?, ?)""",
+            [
+                (variant, model, osu_id, mu, sigma, last_played)
+                for osu_id, (mu, sigma, last_played) in ratings.items()
+            ],
+        )
+
+    def metrics(self) -> dict[tuple[str, str], ShadowMetrics]:
+        """(matches, log-loss, Brier score, correct) totals by variant and
+        model."""
+        self.cur.execute(
+            f"""SELECT {VARIANT_COLUMN}, {MODEL_COLUMN}, {MATCHES_COLUMN},
+                    {LOG_LOSS_COLUMN}, {BRIER_COLUMN}, {CORRECT_COLUMN}
+                FROM {SHADOW_METRICS_TABLE}"""
+        )
+        return {
+            (variant, model): (matches, log_loss, brier, correct)
+            for variant, model, matches, log_loss, brier, correct in self.cur
+        }
+
+    def record(
+        self,
+        variant: str,
+        model: str,
+        ratings: dict[OsuUserId, tuple[float, float]],
+        timestamp: int,
+        errors: tuple[float, float, bool],
+    ) -> None:
+        """Store a variant's new ratings after a match and add how well it
+        predicted it to its totals. Nothing is committed until commit()."""
+        if ratings:
+            self.cur.executemany(
+                f"""INSERT INTO {SHADOW_RATINGS_TABLE}
+                    ({VARIANT_COLUMN}, {MODEL_COLUMN}, {OSU_ID_COLUMN}, {MU_COLUMN},
+                        {SIGMA_COLUMN}, {LAST_PLAYED_COLUMN})
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT ({VARIANT_COLUMN}, {MODEL_COLUMN}, {OSU_ID_COLUMN})
+                    DO UPDATE SET
+                        {MU_COLUMN} = excluded.{MU_COLUMN},
+                        {SIGMA_COLUMN} = excluded.{SIGMA_COLUMN},
+                        {LAST_PLAYED_COLUMN} = excluded.{LAST_PLAYED_COLUMN}""",
+                [
+                    (variant, model, osu_id, mu, sigma, timestamp)
+                    for osu_id, (mu, sigma) in ratings.items()
+                ],
+            )
+        log_loss, brier, correct = errors
+        self.cur.execute(
+            f"""INSERT INTO {SHADOW_METRICS_TABLE}
+                ({VARIANT_COLUMN}, {MODEL_COLUMN}, {MATCHES_COLUMN}, {LOG_LOSS_COLUMN},
+                    {BRIER_COLUMN}, {CORRECT_COLUMN})
+                VALUES (?, ?, 1, ?, ?, ?)
+                ON CONFLICT ({VARIANT_COLUMN}, {MODEL_COLUMN}) DO UPDATE SET
+                    {MATCHES_COLUMN} = {MATCHES_COLUMN} + 1,
+                    {LOG_LOSS_COLUMN} = {LOG_LOSS_COLUMN} + excluded.{LOG_LOSS_COLUMN},
+                    {BRIER_COLUMN} = {BRIER_COLUMN} + excluded.{BRIER_COLUMN},
+                    {CORRECT_COLUMN} = {CORRECT_COLUMN} + excluded.{CORRECT_COLUMN}""",
+            (variant, model, log_loss, brier, int(correct)),
+        )
+
+    def commit(self) -> None:
+        self.con.commit()
+
+
 discord_links = DiscordLinksDatabase(
     DISCORD_OSU_TABLE,
     {IdType.DISCORD_ID: DISCORD_ID_COLUMN, IdType.OSU_ID: OSU_ID_COLUMN},
 )
+on_rollback(discord_links.reload)
 
 ratings = AbstractOsuRatingsDatabase(OSU_RATINGS_TABLE, {IdType.OSU_ID: OSU_ID_COLUMN})
 models = {
@@ -307,3 +1386,14 @@ models = {
     )
     for model in RatingModelType
 }
+
+player_statistics = PlayerStatisticsDatabase(PLAYER_STATISTICS_TABLE)
+player_mod_combos = PlayerModCombosDatabase(PLAYER_MOD_COMBOS_TABLE)
+head_to_head = HeadToHeadDatabase(HEAD_TO_HEAD_TABLE)
+last_played = LastPlayedDatabase(LAST_PLAYED_TABLE)
+match_log = MatchLogDatabase(MATCH_LOG_TABLE)
+import_checkpoints = ImportCheckpointsDatabase(IMPORT_CHECKPOINTS_TABLE)
+processed_scores = ProcessedScoresDatabase(PROCESSED_SCORES_TABLE)
+active_matches = ActiveMatchesDatabase(ACTIVE_MATCHES_TABLE)
+map_pools = MapPoolsDatabase(MAP_POOLS_TABLE)
+rating_history = RatingHistoryDatabase(RATING_HISTORY_TABLE, RATING_HISTORY_DAILY_TABLE)
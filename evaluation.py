@@ -0,0 +1,155 @@
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import NamedTuple
+
+from openskill.models import (
+    BradleyTerryFull,
+    BradleyTerryPart,
+    PlackettLuce,
+    ThurstoneMostellerFull,
+    ThurstoneMostellerPart,
+)
+
+from misc.constants import LoggedMatch, OsuUserId
+from misc.decay import OpenSkillModel, Replay
+
+MODELS: dict[str, type[OpenSkillModel]] = {
+    model.__name__: model
+    for model in (
+        PlackettLuce,
+        BradleyTerryFull,
+        BradleyTerryPart,
+        ThurstoneMostellerFull,
+        ThurstoneMostellerPart,
+    )
+}
+
+# keeps log-loss finite when a model is certain and wrong
+_EPSILON: float = 1e-15
+
+
+class Evaluation(NamedTuple):
+    # matches the metrics are averaged over, i.e. not part of the warmup
+    matches: int
+    log_loss: float
+    brier: float
+    accuracy: float
+    # rating alone, without predicting
+    matches_per_second: float
+
+
+def _outcome(teams: int, scores: list[list[int | float]] | None) -> list[float]:
+    # without scores, teams are ordered from first to last place; a tie for
+    # first splits the win between the tied teams
+    if scores is None:
+        return [1.0] + [0.0] * (teams - 1)
+    team_scores = [sum(team_scores) for team_scores in scores]
+    best = max(team_scores)
+    winners = team_scores.count(best)
+    return [1 / winners if score == best else 0.0 for score in team_scores]
+
+
+def prediction_errors(
+    predicted: list[float], scores: list[list[int | float]] | None
+) -> tuple[float, float, bool]:
+    """Log-loss and Brier score of predicted win chances for each team, and
+    whether the favourite won, given how the match actually went."""
+    outcome = _outcome(len(predicted), scores)
+    return (
+        -sum(
+            actual * math.log(max(chance, _EPSILON))
+            for chance, actual in zip(predicted, outcome)
+        ),
+        sum((chance - actual) ** 2 for chance, actual in zip(predicted, outcome)),
+        outcome[predicted.index(max(predicted))] > 0,
+    )
+
+
+def evaluate(
+    model: OpenSkillModel, matches: list[LoggedMatch], warmup: int = 0
+) -> Evaluation:
+    """Replay matches the way RatingModel.rate_match rates them, inactivity
+    decay included, predicting every match's winner from the ratings just
+    before it. The first `warmup` matches are rated but not scored."""
+    replay = Replay(model)
+    log_loss = brier = correct = 0.0
+    rating_time = 0.0
+    for index, match in enumerate(matches):
+        timestamp, teams, scores = match
+        teams_ratings = replay.current_ratings(teams, timestamp)
+
+        if index >= warmup:
+            match_log_loss, match_brier, favourite_won = prediction_errors(
+                model.predict_win(teams_ratings), scores
+            )
+            log_loss += match_log_loss
+            brier += match_brier
+            correct += favourite_won
+
+        start = time.perf_counter()
+        replay.rate(match, teams_ratings)
+        rating_time += time.perf_counter() - start
+
+    scored = max(len(matches) - warmup, 0)
+    return Evaluation(
+        scored,
+        log_loss / scored if scored else math.nan,
+        brier / scored if scored else math.nan,
+        correct / scored if scored else math.nan,
+        len(matches) / rating_time if rating_time else math.nan,
+    )
+
+
+def evaluate_many(
+    models: list[OpenSkillModel],
+    matches: list[LoggedMatch],
+    warmup: int = 0,
+    workers: int | None = None,
+) -> list[Evaluation]:
+    """Evaluate several models, such as one model with every set of parameters
+    in a sweep, each in its own process."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(evaluate, models, repeat(matches), repeat(warmup)))
+
+
+def _score(performance: float, mu: float, sigma: float) -> int:
+    return int(1_000_000 / (1 + math.exp(-(performance - mu) / sigma)))
+
+
+def synthetic_matches(
+    count: int,
+    players: int,
+    team_size: int = 1,
+    seed: int | None = None,
+    mu: float = 25.0,
+    sigma: float = 25 / 3,
+    noise: float = 25 / 6,
+) -> list[LoggedMatch]:
+    """Matches between two teams of random players, each with a hidden skill
+    drawn from N(mu, sigma) and a performance that varies by `noise` from one
+    match to the next. Scores follow performance on an osu!-like scale."""
+    rng = random.Random(seed)
+    skills = [rng.gauss(mu, sigma) for _ in range(players)]
+    timestamp = int(time.time()) - count * 3600
+    matches: list[LoggedMatch] = []
+    for _ in range(count):
+        timestamp += rng.randrange(3600 * 2)
+        picked = rng.sample(range(players), team_size * 2)
+        teams = [picked[:team_size], picked[team_size:]]
+        matches.append(
+            (
+                timestamp,
+                [[OsuUserId(player + 1) for player in team] for team in teams],
+                [
+                    [
+                        _score(rng.gauss(skills[player], noise), mu, sigma)
+                        for player in team
+                    ]
+                    for team in teams
+                ],
+            )
+        )
+    return matches
@@ -0,0 +1,239 @@
+import argparse
+import base64
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable
+
+REPO: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(
+    description="Measure how long graphics take to render, without any network access."
+)
+parser.add_argument("-n", "--iterations", type=int, default=20)
+parser.add_argument("-c", "--concurrency", type=int, default=8)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--inkscape", help="path to the Inkscape executable")
+args = parser.parse_args()
+# percentiles are taken with statistics.quantiles, which needs two samples
+if args.iterations < 2:
+    parser.error("--iterations must be at least 2")
+if args.concurrency < 1:
+    parser.error("--concurrency must be at least 1")
+
+# the bot modules open ./osuvs.db and read ./graphics on import, so run them
+# against a throwaway database instead of the real one
+workdir = tempfile.mkdtemp(prefix="osuvs-bench-")
+os.symlink(os.path.join(REPO, "graphics"), os.path.join(workdir, "graphics"))
+os.chdir(workdir)
+sys.path.insert(0, REPO)
+
+con = sqlite3.connect("osuvs.db")
+con.execute(
+    "CREATE TABLE discord_osu(discord_id UNSIGNED BIGINT PRIMARY KEY, osu_id UNSIGNED INT)"
+)
+con.execute(
+    "CREATE TABLE osu_ratings(osu_id UNSIGNED INT PRIMARY KEY, "
+    + ", ".join(
+        f"{model}_mu REAL, {model}_sigma REAL"
+        for model in ["osu", "taiko", "fruits", "mania"]
+    )
+    + ")"
+)
+con.commit()
+con.close()
+
+import osu  # noqa: E402
+from openskill.models import PlackettLuceRating  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import graphics  # noqa: E402
+import ratings  # noqa: E402
+from misc.constants import OsuUserId, RatingModelType  # noqa: E402
+from misc.users import CachedUser  # noqa: E402
+
+random.seed(args.seed)
+if args.inkscape:
+    graphics.INKSCAPE = args.inkscape
+
+_image = BytesIO()
+Image.new("RGB", (256, 256), (51, 204, 204)).save(_image, "PNG")
+_LOCAL_IMAGE: str = (
+    "data:image/png;base64," + base64.b64encode(_image.getvalue()).decode()
+)
+
+# covers, avatars and flags all resolve to the same local image
+graphics._fetch_image = lambda url: _LOCAL_IMAGE
+
+
+def fake_user(user_id: int) -> CachedUser:
+    # the whole profile, cut down the way the osu! API client caches it
+    full = osu.User(
+        {
+            "id": user_id,
+            "username": f"player{user_id}",
+            "avatar_url": f"https://a.ppy.sh/{user_id}",
+            "cover_url": f"https://assets.ppy.sh/user-profile-covers/{user_id}.jpg",
+            "country_code": "PL",
+            "country": {"code": "PL", "name": "Poland"},
+            "default_group": "default",
+            "is_active": True,
+            "is_bot": False,
+            "is_deleted": False,
+            "is_online": False,
+            "is_supporter": False,
+            "pm_friends_only": False,
+            "profile_colour": None,
+            "discord": None,
+            "has_supported": False,
+            "interests": None,
+            "join_date": "2015-01-01T00:00:00+00:00",
+            "kudosu": {"total": 0, "available": 0},
+            "location": None,
+            "max_blocks": 100,
+            "max_friends": 250,
+            "occupation": None,
+            "playmode": "osu",
+            "playstyle": [],
+            "post_count": 0,
+            "profile_hue": None,
+            "profile_order": [],
+            "title": None,
+            "title_url": None,
+            "twitter": None,
+            "website": None,
+            "statistics": {
+                "accuracy": 98.0,
+                "count_100": 0,
+                "count_300": 0,
+                "count_50": 0,
+                "count_miss": 0,
+                "global_rank": random.randint(1, 1_000_000),
+                "grade_counts": {"ssh": 0, "ss": 0, "sh": 0, "s": 0, "a": 0},
+                "level": {"current": 100, "progress": 0},
+                "hit_accuracy": 98.0,
+                "is_ranked": True,
+                "maximum_combo": 0,
+                "play_count": 0,
+                "play_time": 0,
+                "pp": random.uniform(0, 20_000),
+                "ranked_score": 0,
+                "replays_watched_by_others": 0,
+                "total_hits": 0,
+                "total_score": 0,
+            },
+        }
+    )
+    return CachedUser.from_user(full)
+
+
+def fake_rating(name: str | None = None) -> PlackettLuceRating:
+    return PlackettLuceRating(random.gauss(25, 5), random.uniform(1, 25 / 3), name=name)
+
+
+def fake_value() -> ratings.RatingValue:
+    return ratings.RatingValue(random.gauss(25, 5), random.uniform(1, 25 / 3))
+
+
+def fake_change() -> ratings.RatingChange:
+    return ratings.RatingChange(fake_value(), fake_value())
+
+
+model = ratings.rating_models[RatingModelType.OSU]
+users = [fake_user(user_id) for user_id in range(1, 51)]
+# predictions on the pre-match banner look players up by their stored rating
+model.update([fake_rating(str(user.id)) for user in users])
+# the bot renders profiles on the thread that owns the database, so read the
+# sparkline's history up front rather than from the concurrent renders
+_history = model.history(OsuUserId(users[0].id), 0)
+model.history = lambda user_id, since: _history
+
+GRAPHICS: dict[str, Callable[[], graphics.Graphic]] = {
+    "OneVOneBeforeGraphic": lambda: graphics.OneVOneBeforeGraphic(
+        (users[0], fake_rating()), (users[1], fake_rating()), model
+    ),
+    "OneVOneAfterGraphic": lambda: graphics.OneVOneAfterGraphic(
+        (users[0], fake_change(), 912_345),
+        (users[1], fake_change(), 834_567),
+        model,
+        winner="player1",
+    ),
+    "SmallProfileGraphic": lambda: graphics.SmallProfileGraphic(
+        users[0], fake_rating(), 1, model
+    ),
+    "TeamVsGraphic (4v4)": lambda: graphics.TeamVsGraphic(
+        [
+            [(user, fake_rating()) for user in users[team * 4 : team * 4 + 4]]
+            for team in (0, 1)
+        ],
+        model,
+        [[fake_value() for _ in range(4)] for _ in (0, 1)],
+        [[random.randint(0, 1_000_000) for _ in range(4)] for _ in (0, 1)],
+    ),
+    "LeaderboardGraphic (50 rows)": lambda: graphics.LeaderboardGraphic(
+        [(rank, user, fake_rating()) for rank, user in enumerate(users, 1)],
+        1,
+        1,
+        model,
+    ),
+}
+
+
+def render_once(make_graphic: Callable[[], graphics.Graphic]) -> float:
+    graphic = make_graphic()
+    start = time.perf_counter()
+    graphics.render_to(graphic, BytesIO())
+    return time.perf_counter() - start
+
+
+def percentile(samples: list[float], p: float) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(p) - 1]
+
+
+print(f"{args.iterations} iterations, {args.concurrency} concurrent renders")
+print(
+    f"{'graphic':<30}{'p50 ms':>10}{'p99 ms':>10}{'renders/s':>12}"
+    + f"{'py peak KiB':>14}{'inkscape peak MiB':>20}"
+)
+for name, make_graphic in GRAPHICS.items():
+    render_once(make_graphic)  # warm up template and font caches
+
+    latencies = [render_once(make_graphic) for _ in range(args.iterations)]
+
+    tracemalloc.start()
+    render_once(make_graphic)
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(
+            executor.map(
+                lambda _: render_once(make_graphic),
+                range(args.iterations * args.concurrency),
+            )
+        )
+    throughput = args.iterations * args.concurrency / (time.perf_counter() - start)
+
+    # ru_maxrss is in KiB on Linux and covers every Inkscape run so far
+    inkscape_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    print(
+        f"{name:<30}"
+        + f"{percentile(latencies, 50) * 1000:>10.1f}"
+        + f"{percentile(latencies, 99) * 1000:>10.1f}"
+        + f"{throughput:>12.2f}"
+        + f"{python_peak / 1024:>14.1f}"
+        + f"{inkscape_peak:>20.1f}"
+    )
+
+shutil.rmtree(workdir)
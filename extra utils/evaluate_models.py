@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+from itertools import product
+
+REPO: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import evaluation  # noqa: E402
+from misc.constants import LoggedMatch, RatingModelType  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare how well rating models predict matches, and how fast "
+        + "they rate them."
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        action="append",
+        choices=list(evaluation.MODELS),
+        help="rating model to evaluate, can be repeated (default: all)",
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "--log",
+        choices=[model.value for model in RatingModelType],
+        default="osu",
+        help="replay the match log of this mode (default: osu)",
+    )
+    source.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="MATCHES",
+        help="replay this many generated matches instead of the match log",
+    )
+    parser.add_argument(
+        "--players", type=int, default=500, help="players in generated matches"
+    )
+    parser.add_argument(
+        "--team-size", type=int, default=1, help="team size of generated matches"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=0,
+        help="matches rated before predictions start being scored",
+    )
+    # every combination of the values given is evaluated
+    for option in ("mu", "sigma", "beta", "tau"):
+        parser.add_argument(f"--{option}", type=float, nargs="+")
+    parser.add_argument("-j", "--workers", type=int, help="number of processes")
+    args = parser.parse_args()
+
+    matches: list[LoggedMatch]
+    if args.synthetic is not None:
+        matches = evaluation.synthetic_matches(
+            args.synthetic, args.players, args.team_size, args.seed
+        )
+    else:
+        # imported here so generated matches don't need a database
+        import database
+
+        matches = database.match_log.matches(args.log)
+    options = [
+        option
+        for option in ("mu", "sigma", "beta", "tau")
+        if getattr(args, option) is not None
+    ]
+    candidates = [
+        (name, dict(zip(options, values)))
+        for name in args.model or evaluation.MODELS
+        for values in product(*(getattr(args, option) for option in options))
+    ]
+    results = evaluation.evaluate_many(
+        [
+            evaluation.MODELS[name](**model_options)
+            for name, model_options in candidates
+        ],
+        matches,
+        args.warmup,
+        args.workers,
+    )
+
+    print(f"{len(matches)} matches, {args.warmup} of them warmup")
+    print(
+        f"{'model':<40}{'log-loss':>10}{'brier':>10}{'accuracy':>10}"
+        + f"{'matches/s':>12}"
+    )
+    for (name, model_options), result in zip(candidates, results):
+        label = " ".join(
+            [name] + [f"{option}={value:g}" for option, value in model_options.items()]
+        )
+        print(
+            f"{label:<40}"
+            + f"{result.log_loss:>10.4f}"
+            + f"{result.brier:>10.4f}"
+            + f"{result.accuracy:>10.1%}"
+            + f"{result.matches_per_second:>12.0f}"
+        )
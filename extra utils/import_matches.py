@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+REPO: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import importer  # noqa: E402
+import rebuild  # noqa: E402
+from misc.constants import OsuUserId, RatingModelType  # noqa: E402
+
+
+def lookup_username(username: str) -> OsuUserId | None:
+    # imported here so dumps that only have osu ids don't need API details
+    from requests import HTTPError
+
+    from osu_api import client as osu
+
+    try:
+        return OsuUserId(osu.users[(username, None)].id)
+    except HTTPError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import historical matches into the match log, then rebuild "
+        + "ratings from it. Stop the bot first."
+    )
+    parser.add_argument("files", nargs="+", help="match dumps to import")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["ndjson", "csv", "multiplayer"],
+        help="format of the files (default: guessed from their extension)",
+    )
+    parser.add_argument("--batch-size", type=int, default=importer.IMPORT_BATCH_SIZE)
+    parser.add_argument(
+        "--no-lookup",
+        action="store_true",
+        help="skip matches with usernames instead of looking them up",
+    )
+    parser.add_argument(
+        "--no-rebuild",
+        action="store_true",
+        help="leave rebuilding ratings for later",
+    )
+    args = parser.parse_args()
+
+    resolve = importer.PlayerResolver(None if args.no_lookup else lookup_username)
+    start = time.perf_counter()
+    for path in args.files:
+        format = args.format or {".csv": "csv", ".json": "multiplayer"}.get(
+            os.path.splitext(path)[1], "ndjson"
+        )
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            match format:
+                case "ndjson":
+                    matches = importer.read_ndjson(f)
+                case "csv":
+                    matches = importer.read_csv(f)
+                case "multiplayer":
+                    matches = importer.read_multiplayer_match(json.load(f))
+                case _:
+                    raise ValueError(f"Unknown format {format!r}.")
+            summary = importer.import_matches(
+                os.path.abspath(path), matches, resolve, args.batch_size
+            )
+        print(f"{path}: {summary.imported} imported, {summary.skipped} skipped")
+
+    if not args.no_rebuild:
+        try:
+            results = rebuild.rebuild(list(RatingModelType))
+        except rebuild.UnloggedHistoryException as e:
+            sys.exit(
+                f"{e}. The matches were imported, but the ratings weren't "
+                + "rebuilt; see rebuild_ratings.py --force."
+            )
+        for model, result in results.items():
+            print(
+                f"{model.value}: {len(result.ratings)} players rated, "
+                + f"{result.seeded} of them from before the match log, "
+                + f"{result.kept} without logged matches kept"
+            )
+    print(f"Done in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import time
+
+REPO: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from openskill.models import PlackettLuce  # noqa: E402
+
+import rebuild  # noqa: E402
+from misc.constants import RatingModelType  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recalculate every rating from the match log. Stop the bot first."
+    )
+    parser.add_argument(
+        "models",
+        nargs="*",
+        choices=[model.value for model in RatingModelType],
+        help="rating models to rebuild (default: all)",
+    )
+    parser.add_argument("-j", "--workers", type=int, help="number of processes")
+    parser.add_argument("--mu", type=float)
+    parser.add_argument("--sigma", type=float)
+    parser.add_argument("--beta", type=float)
+    parser.add_argument("--tau", type=float)
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="don't save the results"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="replay players who played matches missing from the log from scratch "
+        + "if their rating from before it isn't known",
+    )
+    args = parser.parse_args()
+
+    models = [RatingModelType(model) for model in args.models] or list(RatingModelType)
+    model_options = {
+        option: getattr(args, option)
+        for option in ("mu", "sigma", "beta", "tau")
+        if getattr(args, option) is not None
+    }
+
+    start = time.perf_counter()
+    try:
+        results = rebuild.rebuild(
+            models,
+            args.workers,
+            PlackettLuce(**model_options),
+            args.dry_run,
+            args.force,
+        )
+    except rebuild.UnloggedHistoryException as e:
+        sys.exit(f"{e}. Nothing was changed; pass --force to rebuild anyway.")
+    elapsed = time.perf_counter() - start
+
+    for model, result in results.items():
+        print(
+            f"{model.value}: {len(result.ratings)} players rated, "
+            + f"{result.seeded} of them from before the match log, "
+            + f"{result.kept} without logged matches kept"
+        )
+    print(
+        f"{'Replayed' if args.dry_run else 'Rebuilt'} {len(results)} model(s) "
+        + f"in {elapsed:.2f}s"
+    )
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+REPO: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(
+    description="Play recorded osu! multiplayer matches through the lobby tracker, "
+    + "without any network access, and show how every game would be rated."
+)
+parser.add_argument(
+    "directory",
+    help="directory of recorded GET /matches/{match} responses, as {match id}.json",
+)
+parser.add_argument(
+    "matches",
+    nargs="*",
+    type=int,
+    help="match ids to play (default: every recorded match)",
+)
+args = parser.parse_args()
+directory = os.path.abspath(args.directory)
+match_ids: list[int] = args.matches or sorted(
+    int(name.removesuffix(".json"))
+    for name in os.listdir(directory)
+    if name.endswith(".json") and name.removesuffix(".json").isdigit()
+)
+
+# the bot modules open ./osuvs.db on import, so run them against a throwaway
+# database instead of the real one
+os.chdir(tempfile.mkdtemp(prefix="osuvs-lobby-"))
+sys.path.insert(0, REPO)
+
+con = sqlite3.connect("osuvs.db")
+con.execute(
+    "CREATE TABLE discord_osu(discord_id UNSIGNED BIGINT PRIMARY KEY, osu_id UNSIGNED INT)"
+)
+con.execute(
+    "CREATE TABLE osu_ratings(osu_id UNSIGNED INT PRIMARY KEY, "
+    + ", ".join(
+        f"{model}_mu REAL, {model}_sigma REAL"
+        for model in ["osu", "taiko", "fruits", "mania"]
+    )
+    + ")"
+)
+con.commit()
+con.close()
+
+import lobby_tracking  # noqa: E402
+
+
+async def main() -> None:
+    tracker = lobby_tracking.LobbyTracker(lobby_tracking.RecordedFeed(directory))
+    for match_id in match_ids:
+        await tracker.follow(match_id, 0, include_past=True)
+
+    rated = 0
+    # recordings don't change, so once a poll gets no further it's done
+    while tracker.lobbies:
+        cursors = {id: lobby.cursor for id, lobby in tracker.lobbies.items()}
+        for game in await tracker.poll():
+            rated += 1
+            print(
+                f"{game.lobby.name}: beatmap {game.beatmap_id} ({game.model_type.value})"
+            )
+            for team, scores, changes in zip(game.teams, game.scores, game.changes):
+                print(
+                    "  "
+                    + ", ".join(
+                        f"{user.username} {score:,} "
+                        + f"(μ {change.before.mu:.2f} → {change.after.mu:.2f})"
+                        for user, score, change in zip(team, scores, changes)
+                    )
+                )
+        if cursors == {id: lobby.cursor for id, lobby in tracker.lobbies.items()}:
+            break
+
+    for lobby in tracker.lobbies.values():
+        print(f"{lobby.name}: still open after event {lobby.cursor}")
+    print(f"{rated} game(s) rated from {len(match_ids)} match(es)")
+
+
+asyncio.run(main())
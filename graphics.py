@@ -1,18 +1,35 @@
+import base64
 import dataclasses
+import html
+import math
+import re
+import shutil
 import subprocess
-from datetime import datetime
-from typing import Callable, Literal
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import BinaryIO, Callable, Collection, Literal, NamedTuple
 
 import pytz
+from cachetools import LRUCache, TTLCache, cached
 from openskill.models.weng_lin.plackett_luce import PlackettLuceRating
-from osu import User
+from PIL import Image
 from unopt import unwrap
 
+import predictions
 import ratings
+import stats_tracking
+from misc.constants import OsuUserId, RatingModelType
+from misc.users import CachedUser
 
 
-def _elo_function(player: PlackettLuceRating):
-    return player.ordinal(alpha=200 / player.sigma, target=1500)
+def _elo_function(player: PlackettLuceRating | ratings.RatingValue) -> float:
+    # PlackettLuceRating.ordinal(alpha=200 / sigma, target=1500), which plain
+    # rating values don't have
+    return 200 / player.sigma * (player.mu - 3 * player.sigma) + 1500
 
 
 def _change(
@@ -62,6 +79,36 @@ def percentage(x):
     return integer(x * 100)
 
 
+def signed_long_integer(x):
+    return "{:+,}".format(int(round(x, 0)))
+
+
+def sparkline(
+    values: list[float], x: float, y: float, width: float, height: float
+) -> str:
+    """SVG path data plotting the values left to right inside the given box."""
+    if len(values) < 2:
+        return "M 0,0"
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    step = width / (len(values) - 1)
+    return "M " + " L ".join(
+        f"{x + i * step:.1f},{y + height - (value - low) / span * height:.1f}"
+        for i, value in enumerate(values)
+    )
+
+
+def head_to_head(rivalry: stats_tracking.Rivalry) -> str:
+    if rivalry.matches_played == 0:
+        return "First meeting"
+    return (
+        f"Head to head {rivalry.wins}W {rivalry.losses}L"
+        + (f" {rivalry.draws}D" if rivalry.draws else "")
+        + f" · avg margin {signed_long_integer(rivalry.average_margin)}"
+        + f" · last met {datetime.fromtimestamp(unwrap(rivalry.last_played), _UTC):%d %b %Y}"
+    )
+
+
 @dataclasses.dataclass
 class _Rectangle:
     def __init__(self, width, height):
@@ -69,28 +116,63 @@ class _Rectangle:
         self.height = height
 
 
+@dataclasses.dataclass(frozen=True)
+class Encoding:
+    format: Literal["png", "webp"]
+    quality: int = 100
+    colors: int | None = None
+    max_bytes: int | None = None
+
+    @property
+    def extension(self) -> str:
+        return self.format
+
+
+PNG: Encoding = Encoding("png")
+WEBP: Encoding = Encoding("webp", quality=85, max_bytes=400_000)
+QUANTIZED_PNG: Encoding = Encoding("png", colors=256, max_bytes=2_000_000)
+
+_MIN_WEBP_QUALITY: int = 50
+_MIN_PNG_COLORS: int = 32
+
+
 GRAPHICS = "./graphics"
 INKSCAPE = "/usr/bin/inkscape"
 
 BANNER_SIZE: _Rectangle = _Rectangle(1100, 650)
 SMALL_PROFILE_SIZE: _Rectangle = _Rectangle(1100, 405)
+LEADERBOARD_WIDTH: int = 1100
+LEADERBOARD_ROW_HEIGHT: int = 64
+LEADERBOARD_HEADER_HEIGHT: int = 130
+LEADERBOARD_FOOTER_HEIGHT: int = 70
+TEAM_VS_ROW_HEIGHT: int = 72
+TEAM_VS_COLUMNS: tuple[int, int] = (0, 560)
+TEAM_VS_HEADER_HEIGHT: int = 150
+TEAM_VS_FOOTER_HEIGHT: int = 70
+# x, y, width and height of the rating history on the small profile
+SPARKLINE_BOX: tuple[float, float, float, float] = (420, 338, 480, 46)
+SPARKLINE_DAYS: int = 365
 
 _UTC = pytz.timezone("UTC")
 
 
 class Graphic:
+    encoding: Encoding = PNG
+
     def render(self) -> tuple[dict[str, str], str, _Rectangle]: ...
 
 
 class OneVOneBeforeGraphic(Graphic):
-    player1: tuple[User, PlackettLuceRating]
-    player2: tuple[User, PlackettLuceRating]
+    encoding = WEBP
+
+    player1: tuple[CachedUser, PlackettLuceRating]
+    player2: tuple[CachedUser, PlackettLuceRating]
     model: ratings.RatingModel
 
     def __init__(
         self,
-        player1: tuple[User, PlackettLuceRating],
-        player2: tuple[User, PlackettLuceRating],
+        player1: tuple[CachedUser, PlackettLuceRating],
+        player2: tuple[CachedUser, PlackettLuceRating],
         model: ratings.RatingModel,
     ):
         self.player1 = player1
@@ -98,7 +180,15 @@ class OneVOneBeforeGraphic(Graphic):
         self.model = model
 
     def render(self) -> tuple[dict[str, str], str, _Rectangle]:
-        chances = self.model.model.predict_win([[self.player1[1]], [self.player2[1]]])
+        prediction = predictions.predictors[self.model.model_type].predict(
+            OsuUserId(self.player1[0].id), OsuUserId(self.player2[0].id)
+        )
+        chances = (prediction.win, prediction.loss)
+        rivalry = stats_tracking.head_to_head.between(
+            self.model.model_type,
+            OsuUserId(self.player1[0].id),
+            OsuUserId(self.player2[0].id),
+        )
         return (
             {
                 "PREDICTION_METER_STOP_1": str(chances[0] - 0.005),
@@ -111,14 +201,10 @@ class OneVOneBeforeGraphic(Graphic):
                 "PLAYER2_AVATAR_URL": self.player2[0].avatar_url,
                 "PLAYER1_NAME": self.player1[0].username,
                 "PLAYER2_NAME": self.player2[0].username,
-                "PLAYER1_RANK": long_integer(
-                    unwrap(unwrap(self.player1[0].statistics).global_rank)
-                ),
-                "PLAYER2_RANK": long_integer(
-                    unwrap(unwrap(self.player2[0].statistics).global_rank)
-                ),
-                "PLAYER1_PP": integer(unwrap(unwrap(self.player1[0].statistics).pp)),
-                "PLAYER2_PP": integer(unwrap(unwrap(self.player2[0].statistics).pp)),
+                "PLAYER1_RANK": long_integer(unwrap(self.player1[0].global_rank)),
+                "PLAYER2_RANK": long_integer(unwrap(self.player2[0].global_rank)),
+                "PLAYER1_PP": integer(unwrap(self.player1[0].pp)),
+                "PLAYER2_PP": integer(unwrap(self.player2[0].pp)),
                 "PLAYER1_COUNTRY": self.player1[0].country_code,
                 "PLAYER2_COUNTRY": self.player2[0].country_code,
                 "PLAYER1_CHANCE": percentage(chances[0]),
@@ -129,6 +215,7 @@ class OneVOneBeforeGraphic(Graphic):
                 "PLAYER2_MU": short_decimal(self.player2[1].mu),
                 "PLAYER1_SIGMA": short_decimal(self.player1[1].sigma),
                 "PLAYER2_SIGMA": short_decimal(self.player2[1].sigma),
+                "HEAD_TO_HEAD": head_to_head(rivalry),
                 "MATCH_DATE": datetime.now(_UTC).strftime("%A %d %B %Y %H:%M %Z"),
                 "RATING_MODEL": self.model.model_type.value,
             },
@@ -138,16 +225,31 @@ class OneVOneBeforeGraphic(Graphic):
 
 
 class OneVOneAfterGraphic(Graphic):
-    player1: tuple[User, tuple[PlackettLuceRating, PlackettLuceRating], int]
-    player2: tuple[User, tuple[PlackettLuceRating, PlackettLuceRating], int]
+    encoding = WEBP
+
+    # variables that are only known once the match is over
+    RESULT_VARIABLES: frozenset[str] = frozenset(
+        {
+            "PLAYER1_SCORE_BAR_OFFSET",
+            "PLAYER2_SCORE_BAR_OFFSET",
+            "PLAYER1_SCORE_WINNER",
+            "PLAYER2_SCORE_WINNER",
+            "PLAYER1_SCORE_LOSER",
+            "PLAYER2_SCORE_LOSER",
+            "MATCH_DATE",
+        }
+    )
+
+    player1: tuple[CachedUser, ratings.RatingChange, int]
+    player2: tuple[CachedUser, ratings.RatingChange, int]
     model: ratings.RatingModel
     winner: Literal["player1", "player2"]
     watermark: str
 
     def __init__(
         self,
-        player1: tuple[User, tuple[PlackettLuceRating, PlackettLuceRating], int],
-        player2: tuple[User, tuple[PlackettLuceRating, PlackettLuceRating], int],
+        player1: tuple[CachedUser, ratings.RatingChange, int],
+        player2: tuple[CachedUser, ratings.RatingChange, int],
         model: ratings.RatingModel,
         winner: Literal["player1", "player2"] = "player1",
         watermark: str = "",
@@ -177,14 +279,10 @@ class OneVOneAfterGraphic(Graphic):
                 "PLAYER2_NAME_LOSER": (
                     self.player2[0].username if self.winner == "player1" else ""
                 ),
-                "PLAYER1_RANK": long_integer(
-                    unwrap(unwrap(self.player1[0].statistics).global_rank)
-                ),
-                "PLAYER2_RANK": long_integer(
-                    unwrap(unwrap(self.player2[0].statistics).global_rank)
-                ),
-                "PLAYER1_PP": integer(unwrap(unwrap(self.player1[0].statistics).pp)),
-                "PLAYER2_PP": integer(unwrap(unwrap(self.player2[0].statistics).pp)),
+                "PLAYER1_RANK": long_integer(unwrap(self.player1[0].global_rank)),
+                "PLAYER2_RANK": long_integer(unwrap(self.player2[0].global_rank)),
+                "PLAYER1_PP": integer(unwrap(self.player1[0].pp)),
+                "PLAYER2_PP": integer(unwrap(self.player2[0].pp)),
                 "PLAYER1_COUNTRY": self.player1[0].country_code,
                 "PLAYER2_COUNTRY": self.player2[0].country_code,
                 "PLAYER1_ELO_INCREASE": _change(
@@ -299,14 +397,16 @@ class OneVOneAfterGraphic(Graphic):
 
 
 class SmallProfileGraphic(Graphic):
-    osu_user: User
+    encoding = WEBP
+
+    osu_user: CachedUser
     rating: PlackettLuceRating
     rank: int
     model: ratings.RatingModel
 
     def __init__(
         self,
-        osu_user: User,
+        osu_user: CachedUser,
         rating: PlackettLuceRating,
         rank: int,
         model: ratings.RatingModel,
@@ -317,6 +417,15 @@ class SmallProfileGraphic(Graphic):
         self.model = model
 
     def render(self) -> tuple[dict[str, str], str, _Rectangle]:
+        now = datetime.now(_UTC)
+        history = self.model.history(
+            OsuUserId(self.osu_user.id),
+            int((now - timedelta(days=SPARKLINE_DAYS)).timestamp()),
+        )
+        elo_history = [
+            _elo_function(self.model.model.create_rating([mu, sigma]))
+            for _, mu, sigma in history
+        ] + [_elo_function(self.rating)]
         return (
             {
                 "PLAYER_ELO_RANK": str(self.rank),
@@ -326,20 +435,19 @@ class SmallProfileGraphic(Graphic):
                     self.osu_user.username[: min(9, len(self.osu_user.username))]
                     + ("…" if len(self.osu_user.username) > 9 else "")
                 ),
-                "PLAYER_RANK": long_integer(
-                    unwrap(unwrap(self.osu_user.statistics).global_rank)
-                ),
-                "PLAYER_PP": integer(unwrap(unwrap(self.osu_user.statistics).pp)),
+                "PLAYER_RANK": long_integer(unwrap(self.osu_user.global_rank)),
+                "PLAYER_PP": integer(unwrap(self.osu_user.pp)),
                 "PLAYER_COUNTRY_CODE": self.osu_user.country_code,
                 "PLAYER_COUNTRY": (
-                    unwrap(self.osu_user.country).name[
-                        : min(10, len(unwrap(self.osu_user.country).name))
+                    unwrap(self.osu_user.country_name)[
+                        : min(10, len(unwrap(self.osu_user.country_name)))
                     ]
-                    + ("…" if len(unwrap(self.osu_user.country).name) > 10 else "")
+                    + ("…" if len(unwrap(self.osu_user.country_name)) > 10 else "")
                 ),
                 "PLAYER_ELO": integer(_elo_function(self.rating)),
                 "PLAYER_MU": short_decimal(self.rating.mu),
                 "PLAYER_SIGMA": short_decimal(self.rating.sigma),
+                "RATING_SPARKLINE": sparkline(elo_history, *SPARKLINE_BOX),
                 "RATING_MODEL": self.model.model_type.value,
             },
             f"{GRAPHICS}/profile-small.svg",
@@ -347,15 +455,248 @@ class SmallProfileGraphic(Graphic):
         )
 
 
-def render(graphic: Graphic) -> bytes:
-    variable_mappings, filename, size = graphic.render()
-    svg: str = ""
-    with open(filename, "r", encoding="utf-8") as f:
-        svg = f.read()
+class LeaderboardGraphic(Graphic):
+    # mostly flat colours and text, which palette PNGs handle better than WebP
+    encoding = QUANTIZED_PNG
+
+    players: list[tuple[int, CachedUser, PlackettLuceRating]]
+    page: int
+    total_pages: int
+    model: ratings.RatingModel
+
+    def __init__(
+        self,
+        players: list[tuple[int, CachedUser, PlackettLuceRating]],
+        page: int,
+        total_pages: int,
+        model: ratings.RatingModel,
+    ):
+        self.players = players
+        self.page = page
+        self.total_pages = total_pages
+        self.model = model
+
+    def render(self) -> tuple[dict[str, str], str, _Rectangle]:
+        row_template: str = ""
+        with open(f"{GRAPHICS}/leaderboard-row.svg", "r", encoding="utf-8") as f:
+            row_template = f.read()
+        # all rows go into one document so the page is rasterized in one pass
+        rows = "".join(
+            _substitute(
+                row_template,
+                {
+                    "ROW_OFFSET": str(index * LEADERBOARD_ROW_HEIGHT),
+                    "ROW_TINT": "0.05" if index % 2 == 0 else "0",
+                    "ROW_RANK": str(rank),
+                    "ROW_AVATAR_URL": osu_user.avatar_url,
+                    "ROW_COUNTRY_CODE": osu_user.country_code,
+                    "ROW_NAME": osu_user.username,
+                    "ROW_ELO": integer(_elo_function(rating)),
+                    "ROW_MU": short_decimal(rating.mu),
+                    "ROW_SIGMA": short_decimal(rating.sigma),
+                },
+            )
+            for index, (rank, osu_user, rating) in enumerate(self.players)
+        )
+        rows_height = len(self.players) * LEADERBOARD_ROW_HEIGHT
+        height = LEADERBOARD_HEADER_HEIGHT + rows_height + LEADERBOARD_FOOTER_HEIGHT
+        return (
+            {
+                "LEADERBOARD_HEIGHT": str(height),
+                "LEADERBOARD_FOOTER_OFFSET": str(height - 24),
+                "LEADERBOARD_TOTAL_PAGES": str(self.total_pages),
+                "LEADERBOARD_PAGE": str(self.page),
+                "LEADERBOARD_DATE": datetime.now(_UTC).strftime("%A %d %B %Y %H:%M %Z"),
+                "RATING_MODEL": self.model.model_type.value,
+                "LEADERBOARD_ROWS": rows,
+            },
+            f"{GRAPHICS}/leaderboard.svg",
+            _Rectangle(LEADERBOARD_WIDTH, height),
+        )
+
+
+class TeamVsGraphic(Graphic):
+    """Both teams of a team vs match, either before it is played or, given the
+    ratings after and scores, with its results."""
+
+    encoding = WEBP
+
+    teams: list[list[tuple[CachedUser, PlackettLuceRating | ratings.RatingValue]]]
+    model: ratings.RatingModel
+    ratings_after: list[list[ratings.RatingValue]] | None
+    scores: list[list[int]] | None
+
+    def __init__(
+        self,
+        teams: list[list[tuple[CachedUser, PlackettLuceRating | ratings.RatingValue]]],
+        model: ratings.RatingModel,
+        ratings_after: list[list[ratings.RatingValue]] | None = None,
+        scores: list[list[int]] | None = None,
+    ):
+        assert len(teams) == len(TEAM_VS_COLUMNS)
+        self.teams = teams
+        self.model = model
+        self.ratings_after = ratings_after
+        self.scores = scores
+
+    def _row(
+        self,
+        template: str,
+        team: int,
+        index: int,
+        player: tuple[CachedUser, PlackettLuceRating | ratings.RatingValue],
+    ) -> str:
+        osu_user, rating = player
+        rating_after = self.ratings_after[team][index] if self.ratings_after else None
+        increase, decrease = (
+            _change(
+                lambda: _elo_function(rating),
+                lambda: _elo_function(rating_after),
+                integer,
+                "after",
+            )
+            if rating_after is not None
+            else ("", "")
+        )
+        return _substitute(
+            template,
+            {
+                "ROW_X": str(TEAM_VS_COLUMNS[team]),
+                "ROW_OFFSET": str(index * TEAM_VS_ROW_HEIGHT),
+                "ROW_TINT": "0.05" if index % 2 == 0 else "0",
+                "ROW_AVATAR_URL": osu_user.avatar_url,
+                "ROW_COUNTRY_CODE": osu_user.country_code,
+                "ROW_NAME": osu_user.username,
+                "ROW_DETAIL": (
+                    long_integer(self.scores[team][index])
+                    if self.scores
+                    else f"μ {short_decimal(rating.mu)} σ {short_decimal(rating.sigma)}"
+                ),
+                "ROW_ELO": integer(_elo_function(rating_after or rating)),
+                "ROW_RATING_INCREASE": increase,
+                "ROW_RATING_DECREASE": decrease,
+            },
+        )
+
+    def render(self) -> tuple[dict[str, str], str, _Rectangle]:
+        row_template: str = ""
+        with open(f"{GRAPHICS}/team-vs-row.svg", "r", encoding="utf-8") as f:
+            row_template = f.read()
+        # every player goes into one document so the banner is rasterized in
+        # one pass, however many players there are
+        rows = "".join(
+            self._row(row_template, team, index, player)
+            for team, players in enumerate(self.teams)
+            for index, player in enumerate(players)
+        )
+
+        if self.scores:
+            totals = [sum(team_scores) for team_scores in self.scores]
+            headlines = [f"{long_integer(total)} points" for total in totals]
+            results = [
+                "wins" if total == max(totals) and totals.count(total) == 1 else ""
+                for total in totals
+            ]
+        else:
+            chances = self.model.model.predict_win(
+                [
+                    [
+                        self.model.model.create_rating([rating.mu, rating.sigma])
+                        for _, rating in team
+                    ]
+                    for team in self.teams
+                ]
+            )
+            headlines = [f"{percentage(chance)}% to win" for chance in chances]
+            results = ["", ""]
+
+        rows_height = max(len(team) for team in self.teams) * TEAM_VS_ROW_HEIGHT
+        height = TEAM_VS_HEADER_HEIGHT + rows_height + TEAM_VS_FOOTER_HEIGHT
+        return (
+            {
+                "TEAM_VS_HEIGHT": str(height),
+                "TEAM_VS_FOOTER_OFFSET": str(height - 24),
+                "TEAM1_RESULT": results[0],
+                "TEAM2_RESULT": results[1],
+                "TEAM1_HEADLINE": headlines[0],
+                "TEAM2_HEADLINE": headlines[1],
+                "MATCH_DATE": datetime.now(_UTC).strftime("%A %d %B %Y %H:%M %Z"),
+                "RATING_MODEL": self.model.model_type.value,
+                "TEAM_VS_ROWS": rows,
+            },
+            f"{GRAPHICS}/team-vs.svg",
+            _Rectangle(BANNER_SIZE.width, height),
+        )
+
+
+_REMOTE_IMAGE = re.compile(r'xlink:href="(https?://[^"]+)"')
+
+
+@cached(TTLCache(maxsize=256, ttl=60 * 60), lock=threading.Lock())
+def _fetch_image(url: str) -> str:
+    with urllib.request.urlopen(url, timeout=10) as response:
+        content_type = response.headers.get_content_type()
+        data = base64.b64encode(response.read()).decode()
+    return f"data:{content_type};base64,{data}"
+
+
+def _try_fetch_image(url: str) -> str | None:
+    try:
+        return _fetch_image(html.unescape(url))
+    except OSError:
+        return None
+
+
+def _embed_images(svg: str) -> str:
+    urls = list(set(_REMOTE_IMAGE.findall(svg)))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        images = dict(zip(urls, executor.map(_try_fetch_image, urls)))
+
+    def embed(re_match: re.Match[str]) -> str:
+        image = images[re_match.group(1)]
+        if image is None:
+            # leave it to Inkscape to try again at render time
+            return re_match.group(0)
+        return f'xlink:href="{image}"'
+
+    return _REMOTE_IMAGE.sub(embed, svg)
+
+
+def _substitute(svg: str, variable_mappings: dict[str, str]) -> str:
     for string in variable_mappings:
         svg = svg.replace(string, variable_mappings[string])
-
-    result = subprocess.run(
+    return svg
+
+
+def _encode(image: Image.Image, fp: BinaryIO, encoding: Encoding) -> None:
+    start = fp.tell()
+    quality = encoding.quality
+    colors = encoding.colors
+    while True:
+        match encoding.format:
+            case "webp":
+                image.save(fp, "WEBP", quality=quality, method=4)
+            case "png":
+                (
+                    image.quantize(colors, method=Image.Quantize.FASTOCTREE)
+                    if colors
+                    else image
+                ).save(fp, "PNG", optimize=True)
+        if encoding.max_bytes is None or fp.tell() - start <= encoding.max_bytes:
+            return
+        # over budget, try again with a lossier setting
+        if encoding.format == "webp" and quality > _MIN_WEBP_QUALITY:
+            quality -= 10
+        elif encoding.format == "png" and colors and colors > _MIN_PNG_COLORS:
+            colors //= 2
+        else:
+            return
+        fp.seek(start)
+        fp.truncate()
+
+
+def _rasterize(svg: str, size: _Rectangle, fp: BinaryIO, encoding: Encoding) -> None:
+    with subprocess.Popen(
         [
             INKSCAPE,
             "--export-type=png",
@@ -364,8 +705,211 @@ def render(graphic: Graphic) -> bytes:
             f"--export-height={size.height}",
             "--pipe",
         ],
-        input=svg.encode(),
-        capture_output=True,
-        check=True,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ) as process:
+        # Inkscape reads the whole document before it writes anything out
+        assert process.stdin is not None and process.stdout is not None
+        process.stdin.write(svg.encode())
+        process.stdin.close()
+        if encoding == PNG:
+            shutil.copyfileobj(process.stdout, fp)
+        else:
+            with Image.open(process.stdout) as image:
+                image.load()
+                _encode(image, fp, encoding)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def _rasterize_many(
+    svgs: list[str], size: _Rectangle, encoding: Encoding
+) -> list[bytes]:
+    # one Inkscape process for all of them, as starting it up is most of the
+    # cost of rendering a single graphic
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [f"{directory}/{index}.svg" for index in range(len(svgs))]
+        for path, svg in zip(paths, svgs):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(svg)
+        subprocess.run(
+            [
+                INKSCAPE,
+                "--export-type=png",
+                f"--export-width={size.width}",
+                f"--export-height={size.height}",
+                *paths,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        rendered: list[bytes] = []
+        for path in paths:
+            png = path.removesuffix(".svg") + ".png"
+            if encoding == PNG:
+                with open(png, "rb") as f:
+                    rendered.append(f.read())
+                continue
+            buffer = BytesIO()
+            with Image.open(png) as image:
+                image.load()
+                _encode(image, buffer, encoding)
+            rendered.append(buffer.getvalue())
+        return rendered
+
+
+class PreparedGraphic:
+    """SVG with everything but the deferred variables filled in and all remote
+    images embedded, so finishing it only takes a local rasterization."""
+
+    svg: str
+    size: _Rectangle
+    encoding: Encoding
+    deferred: frozenset[str]
+
+    def __init__(
+        self,
+        svg: str,
+        size: _Rectangle,
+        encoding: Encoding,
+        deferred: frozenset[str],
+    ):
+        self.svg = svg
+        self.size = size
+        self.encoding = encoding
+        self.deferred = deferred
+
+    def finish(self, graphic: Graphic, fp: BinaryIO) -> None:
+        variable_mappings, _, _ = graphic.render()
+        _rasterize(
+            _substitute(
+                self.svg,
+                {string: variable_mappings[string] for string in self.deferred},
+            ),
+            self.size,
+            fp,
+            self.encoding,
+        )
+
+
+def prepare(graphic: Graphic, deferred: Collection[str] = ()) -> PreparedGraphic:
+    variable_mappings, filename, size = graphic.render()
+    svg: str = ""
+    with open(filename, "r", encoding="utf-8") as f:
+        svg = f.read()
+    svg = _substitute(
+        svg,
+        {
+            string: value
+            for string, value in variable_mappings.items()
+            if string not in deferred
+        },
+    )
+    return PreparedGraphic(
+        _embed_images(svg), size, graphic.encoding, frozenset(deferred)
+    )
+
+
+def render_to(graphic: Graphic, fp: BinaryIO) -> None:
+    variable_mappings, filename, size = graphic.render()
+    svg: str = ""
+    with open(filename, "r", encoding="utf-8") as f:
+        svg = f.read()
+    _rasterize(
+        _embed_images(_substitute(svg, variable_mappings)), size, fp, graphic.encoding
     )
-    return result.stdout
+
+
+def render(graphic: Graphic) -> bytes:
+    buffer = BytesIO()
+    render_to(graphic, buffer)
+    return buffer.getvalue()
+
+
+def render_many(graphics: Collection[Graphic]) -> list[bytes]:
+    """Render several graphics at once, in the order given, with a single
+    Inkscape process for all of those of the same size and encoding."""
+    groups: dict[tuple[int, int, Encoding], list[tuple[int, str]]] = {}
+    for index, graphic in enumerate(graphics):
+        variable_mappings, filename, size = graphic.render()
+        with open(filename, "r", encoding="utf-8") as f:
+            svg = _embed_images(_substitute(f.read(), variable_mappings))
+        key = (size.width, size.height, graphic.encoding)
+        groups.setdefault(key, []).append((index, svg))
+    rendered: list[bytes] = [b""] * len(graphics)
+    for (width, height, encoding), group in groups.items():
+        for (index, _), image in zip(
+            group,
+            _rasterize_many(
+                [svg for _, svg in group], _Rectangle(width, height), encoding
+            ),
+        ):
+            rendered[index] = image
+    return rendered
+
+
+_leaderboard_pages: LRUCache[tuple[RatingModelType, int, int, int], bytes] = LRUCache(
+    maxsize=64
+)
+
+
+class LeaderboardPage(NamedTuple):
+    # identifies the page in the cache
+    key: tuple[RatingModelType, int, int, int]
+    page: int
+    pages: int
+    # rank, osu id and rating of everyone on the page
+    entries: list[tuple[int, OsuUserId, PlackettLuceRating]]
+
+
+def leaderboard_page(
+    model: ratings.RatingModel, page: int, per_page: int
+) -> tuple[LeaderboardPage, bytes | None]:
+    """Who is on a page of the leaderboard, and its image if it's cached. Call
+    it from the thread matches are rated on, as it reads the ratings."""
+    model.refresh_decay()
+    # the epoch changes with every rating update, so stale pages are never hit
+    key = (model.model_type, page, per_page, model.epoch)
+    start = (page - 1) * per_page
+    return (
+        LeaderboardPage(
+            key,
+            page,
+            max(1, math.ceil(len(model.osu_ratings_links) / per_page)),
+            [
+                (start + index + 1, OsuUserId(osu_id), rating)
+                for index, (osu_id, rating) in enumerate(
+                    model.osu_ratings_links.items()[start : start + per_page]
+                )
+            ],
+        ),
+        _leaderboard_pages.get(key),
+    )
+
+
+def render_leaderboard(
+    page: LeaderboardPage,
+    model: ratings.RatingModel,
+    get_users: Callable[[list[OsuUserId]], dict[OsuUserId, CachedUser]],
+) -> bytes:
+    """Look up everyone on a page and draw it. Leaves the ratings and the
+    cache alone, so it can be called from another thread."""
+    users = get_users([osu_id for _, osu_id, _ in page.entries])
+    return render(
+        LeaderboardGraphic(
+            [
+                (rank, users[osu_id], rating)
+                for rank, osu_id, rating in page.entries
+                if osu_id in users
+            ],
+            page.page,
+            page.pages,
+            model,
+        )
+    )
+
+
+def cache_leaderboard(page: LeaderboardPage, image: bytes) -> None:
+    _leaderboard_pages[page.key] = image
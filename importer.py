@@ -0,0 +1,227 @@
+import csv
+import json
+from datetime import datetime
+from functools import reduce
+from itertools import batched, groupby, islice
+from operator import or_
+from time import time
+from typing import Callable, Iterable, Iterator, NamedTuple, cast
+
+from osu import Mod, Mods
+
+import database
+import stats_tracking
+from misc.constants import OsuUserId, RatingModelType
+
+# matches imported per transaction, and between checkpoints
+IMPORT_BATCH_SIZE: int = 500
+
+
+class ImportedMatch(NamedTuple):
+    timestamp: int
+    model: RatingModelType
+    # osu ids, or usernames that still have to be looked up
+    teams: list[list[OsuUserId | str]]
+    scores: list[list[int | float]] | None
+    # legacy mod bitmasks, if known
+    mods: list[list[int]] | None = None
+
+
+class ImportSummary(NamedTuple):
+    imported: int
+    skipped: int
+
+
+def _timestamp(value: int | float | str) -> int:
+    if isinstance(value, str) and not value.isdigit():
+        return int(datetime.fromisoformat(value).timestamp())
+    return int(value)
+
+
+def _score(value: str) -> int | float:
+    return int(value) if value.isdigit() else float(value)
+
+
+def _player(value: int | str) -> OsuUserId | str:
+    if isinstance(value, int) or value.isdigit():
+        return OsuUserId(int(value))
+    return value
+
+
+def read_ndjson(lines: Iterable[str]) -> Iterator[ImportedMatch]:
+    """One match per line, as
+    {"timestamp": ..., "mode": "osu", "teams": [[player, ...], ...],
+     "scores": [[score, ...], ...]}, where scores are optional (teams are then
+    ordered from first to last place) and players are osu ids or usernames."""
+    for line in lines:
+        if not line.strip():
+            continue
+        match = json.loads(line)
+        yield ImportedMatch(
+            _timestamp(match["timestamp"]),
+            RatingModelType(match.get("mode", "osu")),
+            [[_player(player) for player in team] for team in match["teams"]],
+            match.get("scores"),
+        )
+
+
+def read_csv(lines: Iterable[str]) -> Iterator[ImportedMatch]:
+    """One player per row, with columns match, timestamp, mode, team, player
+    and score. The rows of a match have to be next to each other. Teams are
+    ordered by when they first appear, which is their placement if there are
+    no scores."""
+    for _, rows in groupby(csv.DictReader(lines), key=lambda row: row["match"]):
+        rows = list(rows)
+        teams: dict[str, list[tuple[OsuUserId | str, str]]] = {}
+        for row in rows:
+            teams.setdefault(row["team"], []).append(
+                (_player(row["player"]), row.get("score") or "")
+            )
+        scored = all(score for team in teams.values() for _, score in team)
+        yield ImportedMatch(
+            _timestamp(rows[0]["timestamp"]),
+            RatingModelType(rows[0].get("mode") or "osu"),
+            [[player for player, _ in team] for team in teams.values()],
+            (
+                [[_score(score) for _, score in team] for team in teams.values()]
+                if scored
+                else None
+            ),
+        )
+
+
+def _mods_bitmask(acronyms: list[str]) -> int:
+    # multiplayer scores list their mods by acronym
+    return reduce(
+        or_,
+        (
+            Mods[mod.name].value
+            for mod in Mod
+            if mod.value in acronyms and mod.name in Mods.__members__
+        ),
+        0,
+    )
+
+
+def read_game(game: dict) -> ImportedMatch | None:
+    """A game of an osu! multiplayer match, as found in the events of the
+    osu! API's match endpoint, or None if it hasn't finished. Team vs games are
+    rated by team, any other game as a free for all."""
+    if not game.get("end_time") or not game.get("scores"):
+        return None
+    teams: dict[str | OsuUserId, list[tuple[OsuUserId, int, int]]] = {}
+    for score in game["scores"]:
+        osu_id = OsuUserId(score["user_id"])
+        team = (
+            score["match"]["team"]
+            if game["team_type"] in ("team-vs", "tag-team-vs")
+            else osu_id
+        )
+        teams.setdefault(team, []).append(
+            (
+                osu_id,
+                score["score"],
+                _mods_bitmask([*game.get("mods", []), *score.get("mods", [])]),
+            )
+        )
+    return ImportedMatch(
+        _timestamp(game["end_time"]),
+        RatingModelType(game["mode"]),
+        [[osu_id for osu_id, _, _ in team] for team in teams.values()],
+        [[score for _, score, _ in team] for team in teams.values()],
+        [[mods for _, _, mods in team] for team in teams.values()],
+    )
+
+
+def read_multiplayer_match(match: dict) -> Iterator[ImportedMatch]:
+    """Every finished game of an osu! multiplayer match, as returned by the
+    osu! API (GET /matches/{match})."""
+    for event in match["events"]:
+        if event.get("game") and (imported := read_game(event["game"])):
+            yield imported
+
+
+class PlayerResolver:
+    """Turns usernames into osu ids, looking every name up only once."""
+
+    lookup: Callable[[str], OsuUserId | None] | None
+    _known: dict[str, OsuUserId | None]
+
+    def __init__(self, lookup: Callable[[str], OsuUserId | None] | None) -> None:
+        self.lookup = lookup
+        self._known = {}
+
+    def __call__(self, player: OsuUserId | str) -> OsuUserId | None:
+        if isinstance(player, OsuUserId):
+            return player
+        if player not in self._known:
+            self._known[player] = self.lookup(player) if self.lookup else None
+        return self._known[player]
+
+
+def _record(match: ImportedMatch, teams: list[list[OsuUserId]]) -> None:
+    team_scores = (
+        [sum(team_scores) for team_scores in match.scores] if match.scores else None
+    )
+    match_type = stats_tracking.match_type(teams)
+    stats_tracking.global_stats.record_match(
+        match.model,
+        match_type,
+        {
+            osu_id: result
+            for team, result in zip(
+                teams, stats_tracking.team_results(len(teams), team_scores)
+            )
+            for osu_id in team
+        },
+        (
+            {
+                osu_id: combo
+                for team, team_mods in zip(teams, match.mods)
+                for osu_id, combo in zip(team, team_mods)
+            }
+            if match.mods is not None
+            else None
+        ),
+    )
+    stats_tracking.head_to_head.record_match(
+        match.model, teams, team_scores, match.timestamp
+    )
+    database.match_log.append(
+        match.model.value, match_type.value, match.timestamp, teams, match.scores
+    )
+
+
+def import_matches(
+    source: str,
+    matches: Iterable[ImportedMatch],
+    resolve: PlayerResolver,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> ImportSummary:
+    """Add matches to the match log and everyone's statistics, a batch at a
+    time in order of when they were played, each batch in one transaction
+    along with a checkpoint. Importing the same source again skips as many
+    matches as were imported last time. Matches with players that can't be
+    found, that appear twice or with fewer than two teams are skipped.
+    Nobody is rated; rebuild.rebuild does that from the match log afterwards."""
+    position = database.import_checkpoints.get(source)
+    imported = skipped = 0
+    for batch in batched(islice(matches, position, None), batch_size):
+        resolved: list[tuple[ImportedMatch, list[list[OsuUserId]]]] = []
+        for match in batch:
+            teams = [[resolve(player) for player in team] for team in match.teams]
+            players = [osu_id for team in teams for osu_id in team]
+            if len(teams) < 2 or None in players or len(set(players)) < len(players):
+                skipped += 1
+                continue
+            # every player was found
+            resolved.append((match, cast(list[list[OsuUserId]], teams)))
+        resolved.sort(key=lambda item: item[0].timestamp)
+
+        position += len(batch)
+        with database.transaction():
+            for match, teams in resolved:
+                _record(match, teams)
+            database.import_checkpoints.set(source, position, int(time()))
+        imported += len(resolved)
+    return ImportSummary(imported, skipped)
@@ -0,0 +1,211 @@
+import json
+import os
+import traceback
+from asyncio import gather, to_thread
+from typing import Callable, NamedTuple
+
+import osu
+
+import importer
+import ratings
+import stats_tracking
+from misc.constants import OsuUserId, RatingModelType
+
+# how often every followed lobby is asked for new events
+LOBBY_POLL_INTERVAL: float = 15
+# the most events the API returns at once
+EVENTS_PER_REQUEST: int = 100
+
+# (match id, id of the last event already seen) -> the osu! API's response for
+# GET /matches/{match}, with only the events after it
+MatchFeed = Callable[[int, int | None], dict]
+
+
+def api_feed(match_id: int, after: int | None) -> dict:
+    # imported here so recorded feeds don't need API details
+    from osu_api import client
+
+    return client._client.http.make_request(
+        osu.Path.get_match(match_id), after=after, limit=EVENTS_PER_REQUEST
+    )
+
+
+class RecordedFeed:
+    """Stands in for the osu! API with responses recorded to a directory, one
+    {match id}.json per match holding all of its events. Files are read again
+    on every request, so a match can be played out by rewriting them."""
+
+    directory: str
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def __call__(self, match_id: int, after: int | None) -> dict:
+        with open(
+            os.path.join(self.directory, f"{match_id}.json"), "r", encoding="utf-8"
+        ) as f:
+            response = json.load(f)
+        events = [
+            event
+            for event in response["events"]
+            if after is None or event["id"] > after
+        ]
+        return response | {"events": events[:EVENTS_PER_REQUEST]}
+
+
+class TrackedLobby:
+    match_id: int
+    name: str
+    channel_id: int
+    # every event up to this one has been dealt with; a game that hasn't
+    # finished holds it back, as games are updated in place when they end
+    cursor: int | None
+    finished: bool
+
+    def __init__(
+        self, match_id: int, name: str, channel_id: int, cursor: int | None
+    ) -> None:
+        self.match_id = match_id
+        self.name = name
+        self.channel_id = channel_id
+        self.cursor = cursor
+        self.finished = False
+
+
+class RatedGame(NamedTuple):
+    lobby: TrackedLobby
+    beatmap_id: int | None
+    model_type: RatingModelType
+    teams: list[list[osu.UserCompact]]
+    scores: list[list[int | float]]
+    changes: list[list[ratings.RatingChange]]
+
+
+class LobbyTracker:
+    """Multiplayer matches being followed, all polled together. Only events
+    past each lobby's cursor are fetched, and every game is rated once, when
+    it finishes."""
+
+    feed: MatchFeed
+    lobbies: dict[int, TrackedLobby]
+
+    def __init__(self, feed: MatchFeed) -> None:
+        self.feed = feed
+        self.lobbies = {}
+
+    async def follow(
+        self, match_id: int, channel_id: int, include_past: bool = False
+    ) -> TrackedLobby:
+        """Start following a match. Games played before it was followed are
+        only rated if asked to."""
+        response = await to_thread(self.feed, match_id, None)
+        lobby = TrackedLobby(
+            match_id,
+            response["match"]["name"],
+            channel_id,
+            # without a cursor the API only returns the latest events, so
+            # games from the start are asked for as the events after 0
+            0 if include_past else response.get("latest_event_id"),
+        )
+        self.lobbies[match_id] = lobby
+        return lobby
+
+    def unfollow(self, match_id: int) -> bool:
+        return self.lobbies.pop(match_id, None) is not None
+
+    def _fetch(self, lobby: TrackedLobby) -> tuple[list[dict], dict[int, dict]]:
+        events: list[dict] = []
+        users: dict[int, dict] = {}
+        after = lobby.cursor
+        while True:
+            response = self.feed(lobby.match_id, after)
+            events += response["events"]
+            users |= {user["id"]: user for user in response.get("users", [])}
+            if len(response["events"]) < EVENTS_PER_REQUEST:
+                return events, users
+            after = response["events"][-1]["id"]
+
+    def _settle(
+        self, lobby: TrackedLobby, events: list[dict], users: dict[int, dict]
+    ) -> list[RatedGame]:
+        rated: list[RatedGame] = []
+        for event in sorted(events, key=lambda event: event["id"]):
+            game = event.get("game")
+            if game is not None and not game.get("end_time"):
+                break
+            if event["detail"]["type"] == "match-disbanded":
+                lobby.finished = True
+            # a game that fails to be rated holds the lobby back, so it's
+            # tried again next time instead of being lost
+            try:
+                if game is not None and (match := importer.read_game(game)) is not None:
+                    rated_game = self._rate(lobby, game, match, users)
+                    if rated_game is not None:
+                        rated.append(rated_game)
+            except Exception:
+                print(f"Couldn't rate event {event['id']} of match {lobby.match_id}")
+                traceback.print_exc()
+                break
+            lobby.cursor = event["id"]
+        return rated
+
+    def _rate(
+        self,
+        lobby: TrackedLobby,
+        game: dict,
+        match: importer.ImportedMatch,
+        users: dict[int, dict],
+    ) -> RatedGame | None:
+        # games read from the API only ever have osu ids, never usernames
+        osu_ids = [[OsuUserId(int(osu_id)) for osu_id in team] for team in match.teams]
+        # games played alone, or by players the response left out, can't be
+        # rated
+        if len(osu_ids) < 2 or any(
+            osu_id not in users for team in osu_ids for osu_id in team
+        ):
+            return None
+        teams = [
+            [osu.UserCompact(users[osu_id]) for osu_id in team] for team in osu_ids
+        ]
+        scores = match.scores or []
+        changes = ratings.rating_models[match.model].rate_match(
+            teams,
+            scores=scores,
+            match_type=stats_tracking.match_type(osu_ids),
+            mods=match.mods,
+        )
+        return RatedGame(
+            lobby, game.get("beatmap_id"), match.model, teams, scores, changes
+        )
+
+    async def poll(self) -> list[RatedGame]:
+        """Fetch the new events of every lobby at once, then rate the games
+        that have finished. Lobbies that have been disbanded are dropped."""
+        lobbies = list(self.lobbies.values())
+        fetched = await gather(
+            *(to_thread(self._fetch, lobby) for lobby in lobbies),
+            return_exceptions=True,
+        )
+        rated: list[RatedGame] = []
+        for lobby, result in zip(lobbies, fetched):
+            # a lobby that couldn't be fetched is tried again next time, and
+            # one unfollowed in the meantime not at all
+            if isinstance(result, BaseException):
+                print(f"Couldn't fetch match {lobby.match_id}")
+                traceback.print_exception(result)
+                continue
+            if self.lobbies.get(lobby.match_id) is not lobby:
+                continue
+            # ratings are only ever changed from the event loop's thread
+            try:
+                rated += self._settle(lobby, *result)
+            except Exception:
+                print(f"Couldn't read the events of match {lobby.match_id}")
+                traceback.print_exc()
+                continue
+            if lobby.finished:
+                self.unfollow(lobby.match_id)
+        return rated
+
+
+tracker = LobbyTracker(api_feed)
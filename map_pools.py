@@ -0,0 +1,228 @@
+import random
+from typing import NamedTuple
+
+from osu import Beatmap, GameModeStr, Mod, Mods
+
+import database
+import ratings
+from misc.constants import OsuBeatmapId, OsuUserId, RatingModelType
+
+# how far from the players' standing a skill-appropriate pick can be, as a
+# share of the pool
+SKILL_WINDOW: float = 0.1
+
+# how fast each mod plays a beatmap
+_SPEED_MODS: tuple[tuple[Mods, float], ...] = (
+    (Mods.DoubleTime, 1.5),
+    (Mods.Nightcore, 1.5),
+    (Mods.HalfTime, 0.75),
+)
+
+# legacy mods by acronym, in bit order
+_ACRONYMS: dict[str, Mods] = dict(
+    sorted(
+        ((mod.value, Mods[mod.name]) for mod in Mod if mod.name in Mods.__members__),
+        key=lambda item: item[1].value,
+    )
+)
+
+
+class BeatmapMetadata(NamedTuple):
+    """Everything a match needs to know about a beatmap, so that beatmaps in
+    a pool can be played without asking the osu! API."""
+
+    id: int
+    beatmapset_id: int
+    mode: GameModeStr
+    title: str
+    artist: str
+    version: str
+    creator: str
+    # in seconds, at normal speed
+    total_length: int
+    # legacy mod bitmask the beatmap is meant to be played with
+    mods: int
+    # in seconds, at the speed the mods play it at
+    duration: float
+    star_rating: float
+
+    @property
+    def url(self) -> str:
+        return f"https://osu.ppy.sh/beatmaps/{self.id}"
+
+
+def parse_mods(acronyms: str) -> int:
+    """Legacy mod bitmask of mods written like HDDT. NM is no mods."""
+    acronyms = acronyms.upper().removeprefix("NM")
+    mods = 0
+    for i in range(0, len(acronyms), 2):
+        try:
+            mods |= _ACRONYMS[acronyms[i : i + 2]].value
+        except KeyError:
+            raise ValueError(f"Unknown mod: {acronyms[i : i + 2]}")
+    return mods
+
+
+def mod_acronyms(mods: int) -> str:
+    return "".join(acronym for acronym, mod in _ACRONYMS.items() if mods & mod.value)
+
+
+def played_with(score_mods: int, required: int) -> bool:
+    """Whether a score was played with every mod a beatmap was picked with.
+    Other mods can be added on top, and Nightcore counts as Double Time."""
+    if score_mods & Mods.Nightcore.value:
+        score_mods |= Mods.DoubleTime.value
+    return score_mods & required == required
+
+
+def adjusted_duration(length: float, mods: int) -> float:
+    for mod, speed in _SPEED_MODS:
+        if mods & mod.value:
+            return length / speed
+    return length
+
+
+def from_beatmap(
+    beatmap: Beatmap, mods: int = 0, star_rating: float | None = None
+) -> BeatmapMetadata:
+    beatmapset = beatmap.beatmapset
+    assert beatmapset is not None
+    return BeatmapMetadata(
+        beatmap.id,
+        beatmap.beatmapset_id,
+        GameModeStr(beatmap.mode),
+        beatmapset.title,
+        beatmapset.artist,
+        beatmap.version,
+        beatmapset.creator,
+        beatmap.total_length,
+        mods,
+        adjusted_duration(beatmap.total_length, mods),
+        star_rating if star_rating is not None else beatmap.difficulty_rating,
+    )
+
+
+def _from_row(row: database.PooledBeatmap) -> BeatmapMetadata:
+    (
+        beatmap_id,
+        beatmapset_id,
+        model,
+        title,
+        artist,
+        version,
+        creator,
+        total_length,
+        mods,
+        duration,
+        star_rating,
+    ) = row
+    return BeatmapMetadata(
+        beatmap_id,
+        beatmapset_id,
+        GameModeStr(model),
+        title,
+        artist,
+        version,
+        creator,
+        total_length,
+        mods,
+        duration,
+        star_rating,
+    )
+
+
+def pooled(beatmap_id: int, mods: int = 0) -> BeatmapMetadata | None:
+    """A beatmap as it's pooled with the given mods, if it is."""
+    row = database.map_pools.get(beatmap_id, mods)
+    return _from_row(row) if row is not None else None
+
+
+def fetch(beatmap_id: int, mods: int = 0) -> BeatmapMetadata:
+    """A beatmap from the osu! API, with its star rating adjusted for the mods
+    it's played with. Doesn't touch the database, so it can be called from
+    another thread. Raises HTTPError if it doesn't exist."""
+    # imported here so picking from pools doesn't need API details
+    from osu_api import client as osu
+
+    beatmap = osu.beatmaps[OsuBeatmapId(beatmap_id)]
+    star_rating = (
+        osu._client.get_beatmap_attributes(
+            beatmap.id, mods=mods, ruleset=beatmap.mode
+        ).star_rating
+        if mods
+        else None
+    )
+    return from_beatmap(beatmap, mods, star_rating)
+
+
+def lookup(beatmap_id: int, mods: int = 0) -> BeatmapMetadata:
+    """A beatmap played with the given mods, from the pools if it's pooled
+    with them, otherwise from the osu! API. Raises HTTPError if it doesn't
+    exist."""
+    return pooled(beatmap_id, mods) or fetch(beatmap_id, mods)
+
+
+def add(pool: str, beatmap: BeatmapMetadata) -> None:
+    """Add a beatmap, as returned by fetch, to a pool."""
+    database.map_pools.add(
+        pool,
+        (
+            beatmap.id,
+            beatmap.beatmapset_id,
+            beatmap.mode.value,
+            beatmap.title,
+            beatmap.artist,
+            beatmap.version,
+            beatmap.creator,
+            beatmap.total_length,
+            beatmap.mods,
+            beatmap.duration,
+            beatmap.star_rating,
+        ),
+    )
+
+
+def beatmaps(pool: str) -> list[BeatmapMetadata]:
+    return [_from_row(row) for row in database.map_pools.beatmaps(pool)]
+
+
+def skill_percentile(model: ratings.RatingModel, osu_ids: list[OsuUserId]) -> float:
+    """Where players stand on the leaderboard on average, from 0 for the
+    bottom to 1 for the top. Players without a rating count as the middle."""
+    links = model.osu_ratings_links
+    standings = [
+        (
+            1 - links.index(osu_id) / (len(links) - 1)
+            if osu_id in links and len(links) > 1
+            else 0.5
+        )
+        for osu_id in osu_ids
+    ]
+    return sum(standings) / len(standings)
+
+
+def pick(
+    model_type: RatingModelType,
+    players: list[OsuUserId] | None = None,
+    pool: str | None = None,
+    rng: random.Random | None = None,
+) -> BeatmapMetadata | None:
+    """A beatmap from a pool (or all pools), as hard compared to the rest of
+    it as the players are compared to everyone else, give or take
+    SKILL_WINDOW. Without players, any beatmap. None if there are none."""
+    rng = rng or random.Random()
+    count = database.map_pools.count(model_type.value, pool)
+    if count == 0:
+        return None
+    if players:
+        standing = skill_percentile(ratings.rating_models[model_type], players)
+        position = rng.uniform(
+            max(standing - SKILL_WINDOW, 0), min(standing + SKILL_WINDOW, 1)
+        )
+    else:
+        position = rng.random()
+    return _from_row(
+        database.map_pools.nth(
+            model_type.value, min(int(position * count), count - 1), pool
+        )
+    )
@@ -1,63 +1,502 @@
-from asyncio import InvalidStateError, create_task, sleep
+from asyncio import (
+    Future,
+    Task,
+    create_task,
+    gather,
+    get_running_loop,
+    sleep,
+    to_thread,
+)
+from collections import deque
+from enum import Enum
+from time import time
+from typing import NamedTuple
 
-from osu import Beatmap, SoloScore, User, UserScoreType
+from osu import GameModeStr, SoloScore, UserScoreType
 from unopt import unwrap
 
+import database
+import map_pools
+import ratings
+from misc.constants import OsuUserId, RatingModelType
+from misc.users import CachedUser
 from osu_api import client as osu
+from stats_tracking import MatchType, mods_bitmask
 
 
 class MatchVoidException(Exception):
     """Exception to indicate that a match cannot be completed due to lack of scores."""
 
 
-async def _check_scores(teams: list[list[User]], beatmap: Beatmap):
-    player_scores: list[list[int]] = []
-    total_score = 0
-    everyone_finished = True
-    for team in teams:
-        team_scores: list[int] = []
-        team_score = 0
-        for player in team:
-            try:
-                scores = osu._client.get_user_scores(
-                    player.id, UserScoreType.RECENT, mode=beatmap.mode
+# the osu! API only lists scores set in the last 24 hours as recent
+RECENT_SCORES_WINDOW: int = 24 * 60 * 60
+# how often the scores of the matches being played are looked for
+SCORE_POLL_INTERVAL: float = 10
+
+
+class PlayerScore(NamedTuple):
+    score: int
+    # legacy mod bitmask, None for a player without a score
+    mods: int | None
+    score_id: int | None = None
+    # when the score was set, only known for scores fresh from the API
+    ended_at: float | None = None
+
+
+# what a player who didn't set a score gets
+NO_SCORE = PlayerScore(0, None)
+
+
+class ProcessedScores:
+    """Ids of the osu! scores already counted towards a match. Those still
+    recent enough to be listed as a recent score are kept in memory, older
+    ones are looked up in the database, which has all of them."""
+
+    db: database.ProcessedScoresDatabase
+    _recent: set[int]
+    _by_time: deque[tuple[int, int]]
+    # every id processed outside of the recent window is at most this
+    _floor: int
+
+    def __init__(self, db: database.ProcessedScoresDatabase) -> None:
+        self.db = db
+        self.reload()
+
+    def reload(self) -> None:
+        cutoff = int(time()) - RECENT_SCORES_WINDOW
+        self._by_time = deque(self.db.since(cutoff))
+        self._recent = {score_id for _, score_id in self._by_time}
+        self._floor = self.db.latest_before(cutoff)
+
+    def _expire(self, now: int) -> None:
+        cutoff = now - RECENT_SCORES_WINDOW
+        while self._by_time and self._by_time[0][0] < cutoff:
+            _, score_id = self._by_time.popleft()
+            self._recent.discard(score_id)
+            self._floor = max(self._floor, score_id)
+
+    def __contains__(self, score_id: int | None) -> bool:
+        if score_id is None:
+            return False
+        # score ids only go up, so the database only has to be asked about
+        # ids old enough to have left the recent window
+        return score_id in self._recent or (
+            score_id <= self._floor and score_id in self.db
+        )
+
+    def add(self, score_ids: list[int]) -> None:
+        now = int(time())
+        self._expire(now)
+        self.db.add(score_ids, now)
+        for score_id in score_ids:
+            if score_id not in self._recent:
+                self._recent.add(score_id)
+                self._by_time.append((now, score_id))
+
+
+processed_scores = ProcessedScores(database.processed_scores)
+# claimed scores are only added to the database along with the match they
+# count towards, so they're forgotten again if rating it fails
+database.on_rollback(processed_scores.reload)
+
+
+class MatchState(Enum):
+    proposed = 1
+    accepted = 2
+    playing = 3
+    scoring = 4
+    rated = 5
+    # declined, timed out, no scores set, or not picked up again after a
+    # restart
+    void = 6
+
+
+# states a match can still move on from
+OPEN_STATES: tuple[MatchState, ...] = (
+    MatchState.proposed,
+    MatchState.accepted,
+    MatchState.playing,
+    MatchState.scoring,
+)
+
+
+class TrackedMatch:
+    """A match started from Discord, with every change of state and every
+    score found written to the database as it happens."""
+
+    match_id: int
+    state: MatchState
+    model_type: RatingModelType
+    match_type: MatchType
+    channel_id: int
+    beatmap: map_pools.BeatmapMetadata
+    teams: list[list[CachedUser]]
+    # scores found so far by osu id
+    found: dict[int, PlayerScore]
+    # when the match ends, once it has been accepted
+    deadline: float | None
+    # when scores were last looked for, this run of the bot
+    last_poll: float
+
+    def __init__(
+        self,
+        match_id: int,
+        state: MatchState,
+        model_type: RatingModelType,
+        match_type: MatchType,
+        channel_id: int,
+        beatmap: map_pools.BeatmapMetadata,
+        teams: list[list[CachedUser]],
+        found: dict[int, PlayerScore] | None = None,
+        deadline: float | None = None,
+    ) -> None:
+        self.match_id = match_id
+        self.state = state
+        self.model_type = model_type
+        self.match_type = match_type
+        self.channel_id = channel_id
+        self.beatmap = beatmap
+        self.teams = teams
+        self.found = found or {}
+        self.deadline = deadline
+        self.last_poll = 0
+
+    def set_state(self, state: MatchState) -> None:
+        self.state = state
+        database.active_matches.set_state(self.match_id, state.value, self.deadline)
+
+    def accept(self) -> None:
+        """Accept the match, which starts the clock on it."""
+        self.deadline = time() + match_length(self.beatmap)
+        self.set_state(MatchState.accepted)
+
+    def take_scores(self, recent: dict[tuple[int, int], list[PlayerScore]]) -> bool:
+        """Give everyone without a score yet their latest one on the beatmap
+        that hasn't counted towards a match yet. Returns whether everyone has
+        finished."""
+        for team in self.teams:
+            for player in team:
+                if player.id in self.found:
+                    continue
+                score = next(
+                    (
+                        score
+                        for score in recent.get((player.id, self.beatmap.id), [])
+                        if score.score_id not in processed_scores
+                        and self._in_time(score)
+                    ),
+                    None,
                 )
-                valid_scores = [
-                    (score.total_score if isinstance(score, SoloScore) else score.score)
-                    for score in scores
-                    if (
-                        (score.beatmap_id == beatmap.id)
-                        if isinstance(score, SoloScore)
-                        else (unwrap(score.beatmap).id == beatmap.id)
-                    )
-                ]
-                score = valid_scores[0]
-            except IndexError:
-                score = 0
-                everyone_finished = False
-            team_scores.append(score)
-            team_score += score
-        player_scores.append(team_scores)
-        total_score += team_score
-    return player_scores, total_score, everyone_finished
-
-
-async def do_match(teams: list[list[User]], beatmap: Beatmap) -> list[list[int]]:
-    max_time = max(beatmap.total_length * 1.5, 60)
-    await sleep(beatmap.total_length)
-    player_scores: list[list[int]]
-    for _ in range(int((max_time - beatmap.total_length) // 10)):
-        task = create_task(_check_scores(teams, beatmap))
-        await sleep(10)
-        try:
-            player_scores, _, everyone_finished = task.result()
-        except InvalidStateError:
-            task.cancel()
-            continue
-        if everyone_finished:
-            return player_scores
-    await sleep((max_time - beatmap.total_length) % 10)
-    player_scores, total_score, _ = await _check_scores(teams, beatmap)
-    if total_score == 0:
-        raise MatchVoidException("No scores found for the given beatmap.")
-    return player_scores
+                if score is not None:
+                    self.found[player.id] = score
+        self.last_poll = time()
+        database.active_matches.set_scores(
+            self.match_id,
+            {
+                OsuUserId(osu_id): (score.score, score.mods, score.score_id)
+                for osu_id, score in self.found.items()
+            },
+        )
+        return self.everyone_finished()
+
+    def _in_time(self, score: PlayerScore) -> bool:
+        # catching up after downtime can turn up scores set after time ran out
+        return (
+            self.deadline is None
+            or score.ended_at is None
+            or score.ended_at <= self.deadline
+        )
+
+    def everyone_finished(self) -> bool:
+        return all(player.id in self.found for team in self.teams for player in team)
+
+    def first_poll(self) -> float:
+        # nobody can finish before the beatmap has been played through once
+        return (
+            unwrap(self.deadline) - match_length(self.beatmap) + self.beatmap.duration
+        )
+
+    def player_scores(self) -> list[list[PlayerScore]]:
+        return _player_scores(self.teams, self.found)
+
+
+def match_length(beatmap: map_pools.BeatmapMetadata) -> float:
+    return max(beatmap.duration * 1.5, 60)
+
+
+def propose(
+    model_type: RatingModelType,
+    match_type: MatchType,
+    channel_id: int,
+    beatmap: map_pools.BeatmapMetadata,
+    teams: list[list[CachedUser]],
+) -> TrackedMatch:
+    match_id = database.active_matches.create(
+        MatchState.proposed.value,
+        model_type.value,
+        match_type.value,
+        channel_id,
+        beatmap.id,
+        beatmap.mods,
+        beatmap.duration,
+        [[OsuUserId(player.id) for player in team] for team in teams],
+        int(time()),
+    )
+    return TrackedMatch(
+        match_id,
+        MatchState.proposed,
+        model_type,
+        match_type,
+        channel_id,
+        beatmap,
+        teams,
+    )
+
+
+def _pooled_beatmap(row: database.ActiveMatch) -> map_pools.BeatmapMetadata | None:
+    _, _, _, _, _, beatmap_id, mods, *_ = row
+    return map_pools.pooled(beatmap_id, mods)
+
+
+def _load(
+    row: database.ActiveMatch, pooled: map_pools.BeatmapMetadata | None
+) -> TrackedMatch:
+    """Only asks the osu! API for what it needs, so it can be called from
+    another thread; pooled is the match's beatmap if it's still pooled."""
+    (
+        match_id,
+        state,
+        model,
+        match_type,
+        channel_id,
+        beatmap_id,
+        mods,
+        duration,
+        teams,
+        scores,
+        deadline,
+    ) = row
+    mode = GameModeStr(model)
+    return TrackedMatch(
+        match_id,
+        MatchState(state),
+        RatingModelType(model),
+        MatchType(match_type),
+        channel_id,
+        # as it was when picked, even if the pool has changed since
+        (pooled or map_pools.fetch(beatmap_id, mods))._replace(duration=duration),
+        [[osu.users[(osu_id, mode)] for osu_id in team] for team in teams],
+        {osu_id: PlayerScore(*score) for osu_id, score in scores.items()},
+        deadline,
+    )
+
+
+async def open_matches() -> list[TrackedMatch]:
+    """Every match that hadn't been settled when the bot last stopped. Ones
+    whose players or beatmap can't be looked up anymore are voided."""
+    rows = database.active_matches.in_states([state.value for state in OPEN_STATES])
+    # the database can only be used from this thread, so only the osu! API is
+    # asked from others
+    loaded = await gather(
+        *(to_thread(_load, row, _pooled_beatmap(row)) for row in rows),
+        return_exceptions=True,
+    )
+    tracked: list[TrackedMatch] = []
+    for row, result in zip(rows, loaded):
+        if isinstance(result, Exception):
+            database.active_matches.set_state(row[0], MatchState.void.value)
+        else:
+            tracked.append(result)  # type: ignore
+    return tracked
+
+
+async def catch_up(tracked: list[TrackedMatch]) -> None:
+    """Look for the scores of every match being played, all in one go, so
+    matches that ended while the bot was down can be rated right away."""
+    await poll(
+        [
+            match
+            for match in tracked
+            if match.state in (MatchState.accepted, MatchState.playing)
+        ]
+    )
+
+
+def _recent_scores(
+    player: CachedUser, beatmap: map_pools.BeatmapMetadata
+) -> list[PlayerScore]:
+    scores = osu._client.get_user_scores(
+        player.id, UserScoreType.RECENT, mode=beatmap.mode
+    )
+    played = [
+        PlayerScore(
+            (score.total_score if isinstance(score, SoloScore) else score.score),
+            mods_bitmask(score.mods),
+            score.id,
+            (
+                score.ended_at if isinstance(score, SoloScore) else score.created_at
+            ).timestamp(),
+        )
+        for score in scores
+        if (
+            (score.beatmap_id == beatmap.id)
+            if isinstance(score, SoloScore)
+            else (unwrap(score.beatmap).id == beatmap.id)
+        )
+    ]
+    # scores without the mods the beatmap was picked with don't count
+    return [
+        score
+        for score in played
+        if map_pools.played_with(unwrap(score.mods), beatmap.mods)
+    ]
+
+
+async def _fetch_recent_scores(
+    tracked: list[TrackedMatch],
+) -> dict[tuple[int, int], list[PlayerScore]]:
+    """Recent scores on the beatmap of every player still without a score,
+    by (osu id, beatmap id), all looked up at once. Players are only asked
+    for once, however many of the matches they're in."""
+    waiting = {
+        (player.id, match.beatmap.id): (player, match.beatmap)
+        for match in tracked
+        for team in match.teams
+        for player in team
+        if player.id not in match.found
+    }
+    fetched = await gather(
+        *(
+            to_thread(_recent_scores, player, beatmap)
+            for player, beatmap in waiting.values()
+        ),
+        return_exceptions=True,
+    )
+    # players whose scores couldn't be fetched are asked for again next time
+    return {
+        key: scores
+        for key, scores in zip(waiting, fetched)
+        if not isinstance(scores, BaseException)
+    }
+
+
+async def poll(tracked: list[TrackedMatch]) -> list[bool]:
+    """Look for new scores in all the matches at once. Returns whether
+    everyone has finished, for every match."""
+    recent = await _fetch_recent_scores(tracked)
+    return [match.take_scores(recent) for match in tracked]
+
+
+def _player_scores(
+    teams: list[list[CachedUser]], found: dict[int, PlayerScore]
+) -> list[list[PlayerScore]]:
+    return [[found.get(player.id, NO_SCORE) for player in team] for team in teams]
+
+
+def claim_scores(player_scores: list[list[PlayerScore]]) -> list[list[PlayerScore]]:
+    """Mark the scores of a finished match as processed. Any that another
+    match has claimed since they were found count as no score. Meant to be
+    called inside the same database.transaction() as the rating update."""
+    claimed = [
+        [
+            (
+                NO_SCORE
+                if score.score_id is not None and score.score_id in processed_scores
+                else score
+            )
+            for score in team
+        ]
+        for team in player_scores
+    ]
+    processed_scores.add(
+        [score.score_id for team in claimed for score in team if score.score_id]
+    )
+    return claimed
+
+
+def rate(
+    match: TrackedMatch, player_scores: list[list[PlayerScore]]
+) -> tuple[list[list[PlayerScore]], list[list[ratings.RatingChange]]]:
+    """Claim a finished match's scores and rate it. The match only counts as
+    rated if its ratings were actually saved."""
+    with database.transaction():
+        player_scores = claim_scores(player_scores)
+        changes = ratings.rating_models[match.model_type].rate_match(
+            match.teams,
+            scores=[[player.score for player in team] for team in player_scores],
+            match_type=match.match_type,
+            mods=[[player.mods for player in team] for team in player_scores],
+        )
+        match.set_state(MatchState.rated)
+    return player_scores, changes
+
+
+class ScorePoller:
+    """Plays out every match being played at once: every interval, the
+    scores of all of them are looked up together, so a round of many matches
+    costs no more requests than its players."""
+
+    _playing: dict[int, tuple[TrackedMatch, Future[list[list[PlayerScore]]]]]
+    _task: Task[None] | None
+
+    def __init__(self) -> None:
+        self._playing = {}
+        self._task = None
+
+    async def play(self, match: TrackedMatch) -> list[list[PlayerScore]]:
+        future: Future[list[list[PlayerScore]]] = get_running_loop().create_future()
+        self._playing[match.match_id] = (match, future)
+        if self._task is None or self._task.done():
+            self._task = create_task(self._run())
+        return await future
+
+    def _settle(self, match: TrackedMatch) -> None:
+        _, future = self._playing.pop(match.match_id)
+        if future.done():
+            return
+        if (
+            not match.everyone_finished()
+            and sum(score.score for score in match.found.values()) == 0
+        ):
+            match.set_state(MatchState.void)
+            future.set_exception(
+                MatchVoidException("No scores found for the given beatmap.")
+            )
+        else:
+            match.set_state(MatchState.scoring)
+            future.set_result(match.player_scores())
+
+    async def _run(self) -> None:
+        while self._playing:
+            # matches already looked at after they ended (e.g. caught up on
+            # after a restart) don't need another poll
+            for match, _ in list(self._playing.values()):
+                if match.last_poll >= unwrap(match.deadline):
+                    self._settle(match)
+            await sleep(SCORE_POLL_INTERVAL)
+            now = time()
+            due = [
+                match
+                for match, future in self._playing.values()
+                if now >= match.first_poll() and not future.done()
+            ]
+            for match, everyone_finished in zip(due, await poll(due)):
+                if everyone_finished or match.last_poll >= unwrap(match.deadline):
+                    self._settle(match)
+            # matches given up on by whoever was waiting for them
+            for match, future in list(self._playing.values()):
+                if future.done():
+                    self._playing.pop(match.match_id)
+
+
+poller = ScorePoller()
+
+
+async def do_match(match: TrackedMatch) -> list[list[PlayerScore]]:
+    """Play out an accepted match, looking for scores until everyone has one
+    or the match is over. Picks up where it left off if the match was being
+    played before a restart."""
+    if match.state is MatchState.scoring:
+        return match.player_scores()
+    match.set_state(MatchState.playing)
+    return await poller.play(match)
@@ -0,0 +1,151 @@
+from time import time
+
+from openskill.models import PlackettLuceRating
+from sortedcontainers import SortedKeyList
+
+import predictions
+import ratings
+from misc.constants import DiscordUserId, OsuUserId, RatingModelType
+from misc.users import CachedUser
+
+# how far apart, in ordinal, two players may be when they first queue
+BASE_WINDOW: float = 2.0
+# how much the window widens for every second spent waiting
+WINDOW_GROWTH: float = 0.1
+MAX_WINDOW: float = 25.0
+# how many neighbours on either side are weighed up for a match
+MAX_CANDIDATES: int = 8
+
+
+class QueuedPlayer:
+    discord_id: DiscordUserId
+    osu_user: CachedUser
+    rating: PlackettLuceRating
+    ordinal: float
+    channel_id: int
+    joined: float
+
+    def __init__(
+        self,
+        discord_id: DiscordUserId,
+        osu_user: CachedUser,
+        rating: PlackettLuceRating,
+        channel_id: int,
+        joined: float,
+    ) -> None:
+        self.discord_id = discord_id
+        self.osu_user = osu_user
+        self.rating = rating
+        self.ordinal = rating.ordinal()
+        self.channel_id = channel_id
+        self.joined = joined
+
+
+class MatchmakingQueue:
+    """Players of one mode waiting for an opponent, kept sorted by ordinal so
+    the players within a skill window are found by bisection."""
+
+    model: ratings.RatingModel
+    _players: dict[DiscordUserId, QueuedPlayer]
+    _by_ordinal: SortedKeyList
+
+    def __init__(self, model: ratings.RatingModel) -> None:
+        self.model = model
+        # insertion order doubles as the order players started waiting in
+        self._players = {}
+        self._by_ordinal = SortedKeyList(key=lambda player: player.ordinal)
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+    def __contains__(self, discord_id: DiscordUserId) -> bool:
+        return discord_id in self._players
+
+    def join(
+        self,
+        discord_id: DiscordUserId,
+        osu_user: CachedUser,
+        channel_id: int,
+        now: float | None = None,
+    ) -> QueuedPlayer:
+        self.leave(discord_id)
+        player = QueuedPlayer(
+            discord_id,
+            osu_user,
+            self.model[osu_user],
+            channel_id,
+            time() if now is None else now,
+        )
+        self._players[discord_id] = player
+        self._by_ordinal.add(player)
+        return player
+
+    def leave(self, discord_id: DiscordUserId) -> bool:
+        player = self._players.pop(discord_id, None)
+        if player is None:
+            return False
+        self._by_ordinal.remove(player)
+        return True
+
+    def window(self, player: QueuedPlayer, now: float) -> float:
+        return min(BASE_WINDOW + WINDOW_GROWTH * (now - player.joined), MAX_WINDOW)
+
+    def _best_opponent(self, player: QueuedPlayer, now: float) -> QueuedPlayer | None:
+        window = self.window(player, now)
+        position = self._by_ordinal.index(player)
+        start = max(
+            self._by_ordinal.bisect_key_left(player.ordinal - window),
+            position - MAX_CANDIDATES,
+        )
+        stop = min(
+            self._by_ordinal.bisect_key_right(player.ordinal + window),
+            position + MAX_CANDIDATES + 1,
+        )
+        candidates = [
+            candidate
+            for candidate in self._by_ordinal.islice(start, stop)
+            if candidate is not player
+        ]
+        if not candidates:
+            return None
+        qualities = [
+            prediction.quality
+            for prediction in predictions.predictors[
+                self.model.model_type
+            ].predict_many(
+                [
+                    (OsuUserId(player.osu_user.id), OsuUserId(candidate.osu_user.id))
+                    for candidate in candidates
+                ]
+            )
+        ]
+        return candidates[qualities.index(max(qualities))]
+
+    def tick(self, now: float | None = None) -> list[tuple[QueuedPlayer, QueuedPlayer]]:
+        """Pair up as many players as possible, longest waiting first, and take
+        them out of the queue."""
+        now = time() if now is None else now
+        pairs: list[tuple[QueuedPlayer, QueuedPlayer]] = []
+        for player in list(self._players.values()):
+            if player.discord_id not in self._players:
+                continue
+            opponent = self._best_opponent(player, now)
+            if opponent is None:
+                continue
+            self.leave(player.discord_id)
+            self.leave(opponent.discord_id)
+            pairs.append((player, opponent))
+        return pairs
+
+
+queues: dict[RatingModelType, MatchmakingQueue] = {
+    model_type: MatchmakingQueue(model)
+    for model_type, model in ratings.rating_models.items()
+}
+
+
+def queued_model(discord_id: DiscordUserId) -> RatingModelType | None:
+    for model_type, queue in queues.items():
+        if discord_id in queue:
+            return model_type
+    return None
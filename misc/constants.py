@@ -16,6 +16,10 @@ class OsuBeatmapId(int):
     """Represents an osu! beatmap ID"""
 
 
+# (timestamp, teams, scores) of a rated match, as kept in the match log
+LoggedMatch = tuple[int, list[list[OsuUserId]], list[list[int | float]] | None]
+
+
 class IdType(Enum):
     DISCORD_ID = "discord_id"
     OSU_ID = "osu_id"
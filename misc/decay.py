@@ -0,0 +1,102 @@
+import math
+from typing import Any
+
+from openskill.models import (
+    BradleyTerryFull,
+    BradleyTerryPart,
+    PlackettLuce,
+    ThurstoneMostellerFull,
+    ThurstoneMostellerPart,
+)
+
+from misc.constants import LoggedMatch, OsuUserId
+
+# kept free of database and ratings, so matches can be replayed by worker
+# processes and against synthetic streams without loading either
+
+SECONDS_PER_DAY: int = 86400
+
+# days without a rated match before a rating starts to lose certainty
+INACTIVITY_GRACE_DAYS: int = 30
+# variance added to sigma for every inactive day after that
+SIGMA_DECAY_PER_DAY: float = 0.04
+
+OpenSkillModel = (
+    PlackettLuce
+    | BradleyTerryFull
+    | BradleyTerryPart
+    | ThurstoneMostellerFull
+    | ThurstoneMostellerPart
+)
+
+
+def decayed_sigma(sigma: float, days_inactive: int, max_sigma: float) -> float:
+    days = days_inactive - INACTIVITY_GRACE_DAYS
+    if days <= 0:
+        return sigma
+    return min(math.sqrt(sigma**2 + SIGMA_DECAY_PER_DAY * days), max(sigma, max_sigma))
+
+
+class Replay:
+    """Matches rated one after the other the way RatingModel.rate_match rates
+    them, inactivity decay included, with the ratings kept in memory."""
+
+    model: OpenSkillModel
+    ratings: dict[OsuUserId, Any]
+    last_played: dict[OsuUserId, int]
+
+    def __init__(
+        self,
+        model: OpenSkillModel,
+        ratings: dict[OsuUserId, Any] | None = None,
+        last_played: dict[OsuUserId, int] | None = None,
+    ) -> None:
+        self.model = model
+        self.ratings = ratings if ratings is not None else {}
+        self.last_played = last_played if last_played is not None else {}
+
+    def current_ratings(
+        self, teams: list[list[OsuUserId]], timestamp: int
+    ) -> list[list[Any]]:
+        """Every player's rating at the time of a match, decayed for
+        inactivity, or a new rating for players without one."""
+        day = timestamp // SECONDS_PER_DAY
+        return [
+            [
+                (
+                    self.model.create_rating(
+                        [
+                            self.ratings[osu_id].mu,
+                            decayed_sigma(
+                                self.ratings[osu_id].sigma,
+                                day - self.last_played[osu_id] // SECONDS_PER_DAY,
+                                self.model.sigma,
+                            ),
+                        ],
+                        name=str(osu_id),
+                    )
+                    if osu_id in self.ratings
+                    else self.model.rating(name=str(osu_id))
+                )
+                for osu_id in team
+            ]
+            for team in teams
+        ]
+
+    def rate(
+        self, match: LoggedMatch, teams_ratings: list[list[Any]] | None = None
+    ) -> list[list[Any]]:
+        """Rate a match and keep everyone's new rating. teams_ratings are the
+        ratings to rate it from, if current_ratings was already called for
+        them. Returns the new ratings."""
+        timestamp, teams, scores = match
+        rated = self.model.rate(
+            teams_ratings or self.current_ratings(teams, timestamp),
+            scores=[sum(team_scores) for team_scores in scores] if scores else None,
+            weights=scores,
+        )
+        for team, team_ratings in zip(teams, rated):
+            for osu_id, rating in zip(team, team_ratings):
+                self.ratings[osu_id] = rating
+                self.last_played[osu_id] = timestamp
+        return rated
@@ -0,0 +1,73 @@
+from osu import UserCompact
+
+
+class CachedUser:
+    """The parts of an osu! user the bot shows, without the rest of the API's
+    response. Full users hold their whole profile, which is far more than a
+    banner needs, so only these are kept in the cache."""
+
+    __slots__ = (
+        "id",
+        "username",
+        "avatar_url",
+        "cover_url",
+        "country_code",
+        "country_name",
+        "global_rank",
+        "pp",
+    )
+
+    id: int
+    username: str
+    avatar_url: str
+    # empty for compact users
+    cover_url: str
+    country_code: str
+    country_name: str | None
+    # None for compact users, and for players without a rank in the mode
+    global_rank: int | None
+    pp: float | None
+
+    def __init__(
+        self,
+        id: int,
+        username: str,
+        avatar_url: str,
+        cover_url: str = "",
+        country_code: str = "",
+        country_name: str | None = None,
+        global_rank: int | None = None,
+        pp: float | None = None,
+    ) -> None:
+        self.id = id
+        self.username = username
+        self.avatar_url = avatar_url
+        self.cover_url = cover_url
+        self.country_code = country_code
+        self.country_name = country_name
+        self.global_rank = global_rank
+        self.pp = pp
+
+    @classmethod
+    def from_user(cls, user: UserCompact) -> "CachedUser":
+        """Works for both full and compact users; whatever a compact user
+        doesn't have is left as None."""
+        country = getattr(user, "country", None)
+        statistics = getattr(user, "statistics", None)
+        return cls(
+            user.id,
+            user.username,
+            user.avatar_url,
+            getattr(user, "cover_url", None) or "",
+            user.country_code,
+            country.name if country is not None else None,
+            statistics.global_rank if statistics is not None else None,
+            statistics.pp if statistics is not None else None,
+        )
+
+    def __repr__(self) -> str:
+        return f"CachedUser({self.id}, {self.username!r})"
+
+
+# a user as the osu! API or the cache hands it out
+OsuUser = UserCompact | CachedUser
@@ -1,11 +1,12 @@
 import pickle
 import re
-from typing import Callable, Mapping, Never, TypeVar
+from typing import Callable, Iterable, Mapping, Never, TypeVar
 
 import osu
 from cachetools import TTLCache
 
 from misc.constants import OsuBeatmapId, OsuUserId
+from misc.users import CachedUser
 
 _SECRETS_DIR: str = "./secrets"
 
@@ -43,7 +44,8 @@ def parse_beatmap_url(url: str) -> tuple[int, osu.GameModeStr, int]:
     return (set_id, mode, diff_id)
 
 
-_K, _V = TypeVar("K"), TypeVar("V")
+_K = TypeVar("_K")
+_V = TypeVar("_V")
 
 
 class _TTLCachedDict(Mapping[_K, _V]):
@@ -51,7 +53,7 @@ class _TTLCachedDict(Mapping[_K, _V]):
     _get_func: Callable[[_K], _V]
 
     def __init__(self, maxsize: int, ttl: int, get_func: Callable[[_K], _V]) -> None:
-        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._cache = TTLCache[_K, _V](maxsize=maxsize, ttl=ttl)
         self._get_func = get_func
 
     def __getitem__(self, key: _K) -> _V:
@@ -69,6 +71,12 @@ class _TTLCachedDict(Mapping[_K, _V]):
         except KeyError:
             return False
 
+    def is_cached(self, key: _K) -> bool:
+        return key in self._cache
+
+    def store(self, key: _K, value: _V) -> None:
+        self._cache[key] = value
+
     def __iter__(self) -> Never:
         raise NotImplementedError
 
@@ -78,10 +86,20 @@ class _TTLCachedDict(Mapping[_K, _V]):
 
 class _CachedOsuClient:
     _client: osu.Client
-    users: _TTLCachedDict[tuple[OsuUserId | str, osu.GameModeStr | None], osu.User]
+    # only the parts of users the bot uses are cached, see CachedUser
+    users: _TTLCachedDict[tuple[OsuUserId | str, osu.GameModeStr | None], CachedUser]
+    compact_users: _TTLCachedDict[OsuUserId, CachedUser]
     beatmaps: _TTLCachedDict[OsuBeatmapId, osu.Beatmap]
 
-    def _get_user(self, user_id: OsuUserId | str, mode: osu.GameModeStr | None):
+    def full_user(
+        self, user_id: OsuUserId | str, mode: osu.GameModeStr | None = None
+    ) -> osu.User:
+        """Everything the osu! API has on a user. Not cached."""
+        return self._get_user(user_id, mode)
+
+    def _get_user(
+        self, user_id: OsuUserId | str, mode: osu.GameModeStr | None
+    ) -> osu.User:
         if mode:
             return self._client.get_user(
                 int(user_id) if isinstance(user_id, OsuUserId) else user_id,  # type: ignore
@@ -94,12 +112,40 @@ class _CachedOsuClient:
                 key=("id" if isinstance(user_id, OsuUserId | int) else "username"),
             )
 
+    def get_compact_users(
+        self, user_ids: Iterable[OsuUserId]
+    ) -> dict[OsuUserId, CachedUser]:
+        user_ids = list(user_ids)
+        missing = [
+            user_id for user_id in user_ids if not self.compact_users.is_cached(user_id)
+        ]
+        # the API returns at most 50 users per request
+        for i in range(0, len(missing), 50):
+            for user in self._client.get_users(missing[i : i + 50]):
+                self.compact_users.store(OsuUserId(user.id), CachedUser.from_user(user))
+        # users that no longer exist are left out
+        return {
+            user_id: self.compact_users[user_id]
+            for user_id in user_ids
+            if self.compact_users.is_cached(user_id)
+        }
+
     def __init__(self, osu_client: osu.Client):
         self._client = osu_client
+        # a rank or pp a few minutes out of date is fine on a banner, and
+        # the bigger cache only pays off if users stay in it long enough to
+        # be asked for again
         self.users = _TTLCachedDict(
-            maxsize=1000,
-            ttl=60,
-            get_func=lambda x: self._get_user(x[0], x[1]),
+            maxsize=20000,
+            ttl=60 * 10,
+            get_func=lambda x: CachedUser.from_user(self._get_user(x[0], x[1])),
+        )
+        self.compact_users = _TTLCachedDict(
+            maxsize=20000,
+            ttl=60 * 15,
+            get_func=lambda x: CachedUser.from_user(
+                self._client.get_users([int(x)])[0]
+            ),
         )
         self.beatmaps = _TTLCachedDict(
             maxsize=1000,
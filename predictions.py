@@ -0,0 +1,123 @@
+import math
+import threading
+from statistics import NormalDist
+from typing import NamedTuple
+
+from cachetools import LRUCache
+from openskill.models import PlackettLuce, PlackettLuceRating
+from unopt import unwrap
+
+import ratings
+from misc.constants import OsuUserId, RatingModelType
+
+_normal = NormalDist()
+
+
+class Prediction(NamedTuple):
+    """Predicted outcome of a 1v1, from the first player's side."""
+
+    win: float
+    loss: float
+    draw: float
+    # 1 for a perfectly even match, approaching 0 for a one-sided one
+    quality: float
+
+    def reversed(self) -> "Prediction":
+        return Prediction(self.loss, self.win, self.draw, self.quality)
+
+
+def predict_pairs(
+    model: PlackettLuce,
+    pairs: list[tuple[PlackettLuceRating, PlackettLuceRating]],
+) -> list[Prediction]:
+    """Predict a batch of 1v1s, using the closed form openskill's predict_win
+    and predict_draw reduce to for two single-player teams."""
+    beta_squared = model.beta**2
+    differences = [a.mu - b.mu for a, b in pairs]
+    spreads = [math.sqrt(2 * beta_squared + a.sigma**2 + b.sigma**2) for a, b in pairs]
+    draw_margin = math.sqrt(2) * model.beta * _normal.inv_cdf((1 + 1 / 2) / 2)
+    wins = [_normal.cdf(d / c) for d, c in zip(differences, spreads)]
+    draws = [
+        _normal.cdf((draw_margin - d) / c) - _normal.cdf((-d - draw_margin) / c)
+        for d, c in zip(differences, spreads)
+    ]
+    qualities = [
+        math.sqrt(2 * beta_squared) / c * math.exp(-(d**2) / (2 * c**2))
+        for d, c in zip(differences, spreads)
+    ]
+    return [
+        Prediction(win, 1 - win, draw, quality)
+        for win, draw, quality in zip(wins, draws, qualities)
+    ]
+
+
+_PairKey = tuple[OsuUserId, int, OsuUserId, int]
+
+
+class PredictionService:
+    """1v1 predictions for one rating model. Pairs are computed in batches and
+    memoized until either player's rating changes."""
+
+    model: ratings.RatingModel
+    _cache: LRUCache[_PairKey, Prediction]
+    _lock: threading.Lock
+
+    def __init__(self, model: ratings.RatingModel, maxsize: int = 65536) -> None:
+        self.model = model
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def _key(self, player: OsuUserId, opponent: OsuUserId) -> _PairKey:
+        return (
+            player,
+            self.model.versions.get(player, 0),
+            opponent,
+            self.model.versions.get(opponent, 0),
+        )
+
+    def _compute(self, keys: list[_PairKey]) -> list[Prediction]:
+        # players without a rating yet are predicted from a new one
+        links = self.model.osu_ratings_links
+        new = self.model.model.rating()
+        return predict_pairs(
+            self.model.model,
+            [(links.get(key[0], new), links.get(key[2], new)) for key in keys],
+        )
+
+    def predict_many(
+        self, pairs: list[tuple[OsuUserId, OsuUserId]]
+    ) -> list[Prediction]:
+        """Predict every (player, opponent) pair by their current ratings."""
+        keys = [
+            (
+                self._key(player, opponent)
+                if player <= opponent
+                else self._key(opponent, player)
+            )
+            for player, opponent in pairs
+        ]
+        with self._lock:
+            found = {key: self._cache.get(key) for key in keys}
+        missing = [key for key, prediction in found.items() if prediction is None]
+        if missing:
+            computed = dict(zip(missing, self._compute(missing)))
+            with self._lock:
+                self._cache.update(computed)
+            found.update(computed)
+        return [
+            (
+                unwrap(found[key])
+                if player <= opponent
+                else unwrap(found[key]).reversed()
+            )
+            for key, (player, opponent) in zip(keys, pairs)
+        ]
+
+    def predict(self, player: OsuUserId, opponent: OsuUserId) -> Prediction:
+        return self.predict_many([(player, opponent)])[0]
+
+
+predictors: dict[RatingModelType, PredictionService] = {
+    model_type: PredictionService(model)
+    for model_type, model in ratings.rating_models.items()
+}
@@ -1,20 +1,43 @@
-from copy import deepcopy
-from functools import reduce
+import math
+from functools import partial, reduce
 from operator import iconcat
+from time import time
+from typing import NamedTuple, Sequence
 
-import osu
 from openskill.models import PlackettLuce, PlackettLuceRating
 from sortedcollections import ValueSortedDict
+from sortedcontainers import SortedList
 from unopt import unwrap
 
 import database
+import shadow
+import stats_tracking
 from misc.constants import OsuUserId, RatingDataType, RatingModelType
+from misc.decay import INACTIVITY_GRACE_DAYS, decayed_sigma
+from misc.users import OsuUser
+from stats_tracking import MatchType
 
 
 def _ranking_key(rating: PlackettLuceRating) -> float:
     return rating.ordinal(alpha=-1)
 
 
+class RatingValue(NamedTuple):
+    mu: float
+    sigma: float
+
+
+class RatingChange(NamedTuple):
+    """A player's rating before and after a match, as plain values."""
+
+    before: RatingValue
+    after: RatingValue
+
+
+def _today() -> int:
+    return int(time()) // database.SECONDS_PER_DAY
+
+
 DefaultModelType = PlackettLuce
 
 
@@ -23,19 +46,48 @@ class RatingModel:
     osu_ratings_links: ValueSortedDict
     model_type: RatingModelType
     db: database.OsuRatingsDatabase
+    epoch: int
+    # bumped for a player every time their rating changes
+    versions: dict[OsuUserId, int]
+    # when each player last had a match rated, also sorted oldest first
+    last_played: dict[OsuUserId, int]
+    _by_last_played: SortedList
+    # stored ratings of the players whose rating in osu_ratings_links has been
+    # decayed for inactivity, and the day the decay was last brought up to date
+    _undecayed: dict[OsuUserId, PlackettLuceRating]
+    _decay_day: int
 
     def __init__(self, model: PlackettLuce, model_type: RatingModelType):
         self.model = model
         self.osu_ratings_links = ValueSortedDict(_ranking_key)
         self.model_type = model_type
         self.db = database.models[model_type]
+        self.epoch = 0
+        self.versions = {}
+        self.reload()
+
+    def reload(self) -> None:
+        """Load the ratings and when everyone last played from the database
+        again, e.g. after a transaction that changed them is rolled back."""
+        self.osu_ratings_links.clear()
+        self.epoch += 1
+        # anything cached for a version may have been worked out from ratings
+        # that were rolled back
+        for osu_id in self.versions:
+            self.versions[osu_id] += 1
+        self.last_played = database.last_played.dict(self.model_type.value)
+        self._by_last_played = SortedList(
+            (timestamp, osu_id) for osu_id, timestamp in self.last_played.items()
+        )
+        self._undecayed = {}
+        self._decay_day = -1
         self._load_ratings()
 
     def _load_ratings(self):
         ratings = self.db.dict() or {}
         buffer: dict[int, PlackettLuceRating] = {}
         for osu_id, rating in ratings.items():
-            assert not isinstance(osu_id, osu.User)
+            assert isinstance(osu_id, int)
             assert not isinstance(rating, PlackettLuceRating)
             if (
                 rating[RatingDataType.MU] is not None
@@ -51,70 +103,225 @@ class RatingModel:
         self._update(list(buffer.values()))
 
     def _update(
-        self, ratings: list[PlackettLuceRating] | dict[osu.User, PlackettLuceRating]
-    ):
-        self.osu_ratings_links.update(
-            {int(unwrap(rating.name)): rating for rating in ratings}
+        self, ratings: list[PlackettLuceRating] | dict[OsuUser, PlackettLuceRating]
+    ) -> dict[OsuUserId, PlackettLuceRating]:
+        by_id: dict[OsuUserId, PlackettLuceRating] = (
+            {OsuUserId(int(unwrap(rating.name))): rating for rating in ratings}
             if isinstance(ratings, list)
-            else ratings
+            else {OsuUserId(user.id): rating for user, rating in ratings.items()}
         )
+        self.osu_ratings_links.update(by_id)
+        for osu_id in by_id:
+            self._undecayed.pop(osu_id, None)
+        return by_id
 
     def update(
-        self, ratings: list[PlackettLuceRating] | dict[osu.User, PlackettLuceRating]
+        self, ratings: list[PlackettLuceRating] | dict[OsuUser, PlackettLuceRating]
     ):
         if len(ratings) == 0:
             return
-        self._update(ratings)
-        if isinstance(ratings, list):
-            self.db.update(
-                {OsuUserId(unwrap(rating.name)): rating for rating in ratings}
+        by_id = self._update(ratings)
+        self.epoch += 1
+        for osu_id in by_id:
+            self.versions[osu_id] = self.versions.get(osu_id, 0) + 1
+        timestamp = int(time())
+        with database.transaction():
+            self.db.update(by_id)
+            database.rating_history.append(
+                self.model_type.value,
+                [
+                    (osu_id, timestamp, rating.mu, rating.sigma)
+                    for osu_id, rating in by_id.items()
+                ],
             )
+
+    def history(self, user_id: OsuUserId, since: int) -> list[tuple[int, float, float]]:
+        """Daily (timestamp, mu, sigma) of a player's rating since a timestamp."""
+        return database.rating_history.daily(user_id, self.model_type.value, since)
+
+    def _apply_decay(self, osu_id: OsuUserId, today: int) -> bool:
+        """Bring one player's rating in osu_ratings_links in line with how
+        long they've been inactive. Returns whether it changed."""
+        stored = self._undecayed.get(osu_id) or self.osu_ratings_links[osu_id]
+        sigma = decayed_sigma(
+            stored.sigma,
+            today - self.last_played[osu_id] // database.SECONDS_PER_DAY,
+            self.model.sigma,
+        )
+        current = self.osu_ratings_links[osu_id]
+        if math.isclose(sigma, current.sigma):
+            return False
+        if math.isclose(sigma, stored.sigma):
+            self._undecayed.pop(osu_id, None)
+            self.osu_ratings_links[osu_id] = stored
         else:
-            self.db.update(ratings)
+            self._undecayed[osu_id] = stored
+            self.osu_ratings_links[osu_id] = self.model.create_rating(
+                [stored.mu, sigma], name=stored.name
+            )
+        self.versions[osu_id] = self.versions.get(osu_id, 0) + 1
+        return True
+
+    def refresh_decay(self) -> None:
+        """Decay the ratings of inactive players for the current day. Only the
+        players past the grace period are re-keyed, and only once a day; the
+        stored ratings are left untouched until they play again."""
+        today = _today()
+        if self._decay_day == today:
+            return
+        cutoff = (today - INACTIVITY_GRACE_DAYS) * database.SECONDS_PER_DAY
+        changed = False
+        for _, osu_id in self._by_last_played.irange(maximum=(cutoff, math.inf)):
+            if osu_id in self.osu_ratings_links:
+                changed |= self._apply_decay(osu_id, today)
+        if changed:
+            self.epoch += 1
+        self._decay_day = today
+
+    def mark_played(self, users: list[OsuUser], timestamp: int) -> None:
+        values = {OsuUserId(user.id): timestamp for user in users}
+        database.last_played.set(self.model_type.value, values)
+        for osu_id, timestamp in values.items():
+            if osu_id in self.last_played:
+                self._by_last_played.remove((self.last_played[osu_id], osu_id))
+            self.last_played[osu_id] = timestamp
+            self._by_last_played.add((timestamp, osu_id))
 
-    def __getitem__(self, user: osu.User) -> PlackettLuceRating:
+    def __getitem__(self, user: OsuUser) -> PlackettLuceRating:
         if user not in self:
             self.init_rating(user)
+        self.refresh_decay()
         return self.osu_ratings_links[user.id]
 
-    def __contains__(self, user: osu.User) -> bool:
+    def __contains__(self, user: OsuUser) -> bool:
         return user.id in self.osu_ratings_links
 
-    def __setitem__(self, user: osu.User, value: PlackettLuceRating) -> None:
+    def __setitem__(self, user: OsuUser, value: PlackettLuceRating) -> None:
         self.update({user: value})
 
-    def init_rating(self, user: osu.User) -> None:
+    def init_rating(self, user: OsuUser) -> None:
         rating = self.model.rating(name=str(user.id))
         self.update([rating])
 
-    def rate_match(
+    def _rate(
         self,
-        teams: list[list[osu.User]],
-        scores: list[list[int | float]] | None = None,
-        dry_run: bool = False,
-    ) -> list[list[PlackettLuceRating]]:
-        teams_ratings: list[list[PlackettLuceRating]] = [
-            [self[user] for user in team] for team in teams
+        teams: Sequence[Sequence[OsuUser]],
+        scores: list[list[int | float]] | None,
+    ) -> tuple[list[list[PlackettLuceRating]], list[list[RatingChange]]]:
+        # openskill rates copies of the ratings it's given, so the ones in
+        # osu_ratings_links are never touched, and players without a rating
+        # yet only get one stored if the match is saved
+        self.refresh_decay()
+        teams_ratings = [
+            [
+                self.osu_ratings_links.get(user.id)
+                or self.model.rating(name=str(user.id))
+                for user in team
+            ]
+            for team in teams
         ]
-        if dry_run:
-            teams_ratings = deepcopy(teams_ratings)
-
-        teams_ratings = self.model.rate(
+        rated = self.model.rate(
             teams_ratings,
             scores=[sum(team_scores) for team_scores in scores] if scores else None,
             weights=scores,
         )
-        players: list[PlackettLuceRating] = reduce(iconcat, teams_ratings, [])
-        if not dry_run:
-            self.update(players)
-        return teams_ratings
+        return rated, [
+            [
+                RatingChange(
+                    RatingValue(before.mu, before.sigma),
+                    RatingValue(after.mu, after.sigma),
+                )
+                for before, after in zip(team_before, team_after)
+            ]
+            for team_before, team_after in zip(teams_ratings, rated)
+        ]
+
+    def preview(
+        self,
+        teams: Sequence[Sequence[OsuUser]],
+        scores: list[list[int | float]] | None = None,
+    ) -> list[list[RatingChange]]:
+        """How every player's rating would change if the match was rated,
+        without changing anything."""
+        return self._rate(teams, scores)[1]
+
+    def rate_match(
+        self,
+        teams: Sequence[Sequence[OsuUser]],
+        scores: list[list[int | float]] | None = None,
+        match_type: MatchType = MatchType.one_v_one,
+        mods: Sequence[Sequence[int | None]] | None = None,
+    ) -> list[list[RatingChange]]:
+        """Rate a match and save it along with everything recorded about it.
+        mods are every player's legacy mod bitmask. Players whose mods are
+        None, e.g. because they didn't set a score, aren't counted as having
+        played with any."""
+        rated, changes = self._rate(teams, scores)
+        team_scores = [sum(team_scores) for team_scores in scores] if scores else None
+        timestamp = int(time())
+        with database.transaction():
+            self.update(reduce(iconcat, rated, []))
+            stats_tracking.global_stats.record_match(
+                self.model_type,
+                match_type,
+                {
+                    OsuUserId(user.id): result
+                    for team, result in zip(
+                        teams, stats_tracking.team_results(len(teams), team_scores)
+                    )
+                    for user in team
+                },
+                (
+                    {
+                        OsuUserId(user.id): combo
+                        for team, team_mods in zip(teams, mods)
+                        for user, combo in zip(team, team_mods)
+                        if combo is not None
+                    }
+                    if mods is not None
+                    else None
+                ),
+            )
+            stats_tracking.head_to_head.record_match(
+                self.model_type,
+                [[OsuUserId(user.id) for user in team] for team in teams],
+                team_scores,
+                timestamp,
+            )
+            match_id = database.match_log.append(
+                self.model_type.value,
+                match_type.value,
+                timestamp,
+                [[OsuUserId(user.id) for user in team] for team in teams],
+                scores,
+            )
+            self.mark_played(reduce(iconcat, teams, []), timestamp)
+        # not until the match is saved for good, as it may be part of a larger
+        # transaction that's rolled back
+        database.after_commit(
+            partial(
+                shadow.runner.submit,
+                shadow.ShadowMatch(
+                    match_id,
+                    self.model_type,
+                    timestamp,
+                    [[OsuUserId(user.id) for user in team] for team in teams],
+                    scores,
+                    self.model,
+                    [[change.before for change in team] for team in changes],
+                ),
+            )
+        )
+        return changes
 
 
 rating_models: dict[RatingModelType, RatingModel] = {
     rating_model: RatingModel(DefaultModelType(), rating_model)
     for rating_model in RatingModelType
 }
+for rating_model in rating_models.values():
+    database.on_rollback(rating_model.reload)
 
 
-def rating_exists(user: osu.User) -> bool:
+def rating_exists(user: OsuUser) -> bool:
     return any(user in rating_model for rating_model in rating_models.values())
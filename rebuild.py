@@ -0,0 +1,169 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from openskill.models import PlackettLuce
+
+import database
+from misc.constants import LoggedMatch, OsuUserId, RatingDataType, RatingModelType
+from misc.decay import Replay
+
+ReplayResult = tuple[dict[OsuUserId, tuple[float, float]], dict[OsuUserId, int]]
+# (mu, sigma, timestamp) a player had before their first logged match
+Seed = tuple[float, float, int]
+
+
+class UnloggedHistoryException(Exception):
+    """Exception to indicate that some players played matches the match log
+    doesn't have, and their rating from before it can't be found."""
+
+
+class RebuildResult(NamedTuple):
+    ratings: dict[OsuUserId, tuple[float, float]]
+    last_played: dict[OsuUserId, int]
+    # players with a stored rating but no logged match, who keep that rating
+    kept: int
+    # players who also played before the match log, replayed from their
+    # rating at the time
+    seeded: int
+
+
+def replay(
+    matches: list[LoggedMatch],
+    model: PlackettLuce,
+    seeds: dict[OsuUserId, Seed] | None = None,
+) -> ReplayResult:
+    """Rate every match again, starting from the seeded players' ratings and
+    from scratch for everyone else. Returns each player's (mu, sigma) and when
+    they last played."""
+    seeds = seeds or {}
+    replayed = Replay(
+        model,
+        {
+            osu_id: model.create_rating([mu, sigma], name=str(osu_id))
+            for osu_id, (mu, sigma, _) in seeds.items()
+        },
+        {osu_id: timestamp for osu_id, (_, _, timestamp) in seeds.items()},
+    )
+    for match in matches:
+        replayed.rate(match)
+    return (
+        {
+            osu_id: (rating.mu, rating.sigma)
+            for osu_id, rating in replayed.ratings.items()
+        },
+        replayed.last_played,
+    )
+
+
+def _seeds(
+    model_type: RatingModelType, matches: list[LoggedMatch]
+) -> tuple[dict[OsuUserId, Seed], list[OsuUserId]]:
+    """The rating every player who has played more matches than were logged
+    had before their first logged match, going by their rating history, and
+    the players it couldn't be found for."""
+    logged: Counter[OsuUserId] = Counter()
+    first_logged: dict[OsuUserId, int] = {}
+    for timestamp, teams, _ in matches:
+        for team in teams:
+            for osu_id in team:
+                logged[osu_id] += 1
+                first_logged.setdefault(osu_id, timestamp)
+    played: Counter[OsuUserId] = Counter()
+    for osu_id, model, _, wins, losses, draws in database.player_statistics.all():
+        if model == model_type.value:
+            played[osu_id] += wins + losses + draws
+
+    seeds: dict[OsuUserId, Seed] = {}
+    missing: list[OsuUserId] = []
+    for osu_id, count in logged.items():
+        if played[osu_id] <= count:
+            continue
+        before = database.rating_history.latest_before(
+            osu_id, model_type.value, first_logged[osu_id]
+        )
+        if before is None:
+            missing.append(osu_id)
+            continue
+        timestamp, mu, sigma = before
+        seeds[osu_id] = (mu, sigma, timestamp)
+    return seeds, missing
+
+
+def rebuild(
+    models: list[RatingModelType],
+    workers: int | None = None,
+    model: PlackettLuce | None = None,
+    dry_run: bool = False,
+    force: bool = False,
+) -> dict[RatingModelType, RebuildResult]:
+    """Replay the match log of every given model, each in its own process, then
+    replace their stored ratings and when everyone last played in one
+    transaction. Players with a rating but no logged match, such as those
+    whose matches were all rated before the match log existed, keep their
+    rating as it is. Players who also played before it are replayed from
+    their rating at the time. If that can't be found for someone, raises
+    UnloggedHistoryException before anything is written, unless forced to
+    replay them from scratch. The bot shouldn't be running, since it keeps
+    its own copy of the ratings in memory."""
+    logged = {
+        model_type: database.match_log.matches(model_type.value)
+        for model_type in models
+    }
+    seeds: dict[RatingModelType, dict[OsuUserId, Seed]] = {}
+    for model_type in models:
+        seeds[model_type], missing = _seeds(model_type, logged[model_type])
+        if missing and not force:
+            raise UnloggedHistoryException(
+                f"{len(missing)} {model_type.value} player(s) played matches "
+                + "missing from the match log, and their rating from before "
+                + "it isn't known"
+            )
+    with ProcessPoolExecutor(max_workers=workers or len(models)) as executor:
+        futures = {
+            model_type: executor.submit(
+                replay,
+                logged[model_type],
+                model or PlackettLuce(),
+                seeds[model_type],
+            )
+            for model_type in models
+        }
+        replayed = {
+            model_type: future.result() for model_type, future in futures.items()
+        }
+
+    results: dict[RatingModelType, RebuildResult] = {}
+    with database.transaction():
+        for model_type, (ratings, last_played) in replayed.items():
+            db = database.models[model_type]
+            kept = {
+                osu_id: rating
+                for osu_id, rating in db.dict().items()
+                if osu_id not in ratings
+            }
+            stored_last_played = database.last_played.dict(model_type.value)
+            results[model_type] = RebuildResult(
+                ratings, last_played, len(kept), len(seeds[model_type])
+            )
+            if dry_run:
+                continue
+            db.clear()
+            db.update(
+                {
+                    osu_id: {RatingDataType.MU: mu, RatingDataType.SIGMA: sigma}
+                    for osu_id, (mu, sigma) in ratings.items()
+                }
+                | kept
+            )
+            database.last_played.clear(model_type.value)
+            database.last_played.set(
+                model_type.value,
+                {
+                    osu_id: stored_last_played[osu_id]
+                    for osu_id in kept
+                    if osu_id in stored_last_played
+                }
+                | last_played,
+            )
+    return results
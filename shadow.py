@@ -0,0 +1,200 @@
+import queue
+import threading
+import traceback
+from typing import Callable, NamedTuple
+
+from openskill.models import BradleyTerryFull, PlackettLuce, ThurstoneMostellerPart
+
+import database
+import evaluation
+from misc.constants import OsuUserId, RatingModelType
+from misc.decay import OpenSkillModel, Replay
+
+# the name the models actually in use are compared under
+PRODUCTION: str = "production"
+
+# alternative models rated alongside the ones in use, by the name their
+# ratings and metrics are stored under
+SHADOW_MODELS: dict[str, Callable[[], OpenSkillModel]] = {
+    "bradley-terry-full": BradleyTerryFull,
+    "thurstone-mosteller-part": ThurstoneMostellerPart,
+}
+
+
+class ShadowMatch(NamedTuple):
+    # its id in the match log
+    match_id: int
+    model_type: RatingModelType
+    timestamp: int
+    teams: list[list[OsuUserId]]
+    scores: list[list[int | float]] | None
+    # the production model, and its (mu, sigma) of every player going into
+    # the match
+    production: PlackettLuce
+    ratings_before: list[list[tuple[float, float]]]
+
+
+class Metrics(NamedTuple):
+    matches: int = 0
+    log_loss: float = 0.0
+    brier: float = 0.0
+    correct: int = 0
+
+    def add(self, errors: tuple[float, float, bool]) -> "Metrics":
+        log_loss, brier, correct = errors
+        return Metrics(
+            self.matches + 1,
+            self.log_loss + log_loss,
+            self.brier + brier,
+            self.correct + correct,
+        )
+
+
+class ShadowRunner(threading.Thread):
+    """Rates every match again with each shadow model, on a thread and
+    database of its own so finishing a match never waits on them, and keeps
+    track of how well they predict matches compared to production."""
+
+    variants: dict[str, Callable[[], OpenSkillModel]]
+    _queue: queue.SimpleQueue[ShadowMatch | None]
+    _lock: threading.Lock
+    _metrics: dict[tuple[str, RatingModelType], Metrics]
+    # only touched from the thread itself
+    _models: dict[str, OpenSkillModel]
+    _replays: dict[tuple[str, RatingModelType], Replay]
+
+    def __init__(self, variants: dict[str, Callable[[], OpenSkillModel]]) -> None:
+        super().__init__(name="shadow-models", daemon=True)
+        self.variants = variants
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._models = {}
+        self._replays = {}
+
+    def submit(self, match: ShadowMatch) -> None:
+        # nobody would ever take them off the queue
+        if self.is_alive():
+            self._queue.put(match)
+
+    def stop(self) -> None:
+        """Finish the matches submitted so far, then stop."""
+        self._queue.put(None)
+        self.join()
+
+    def metrics(self, model_type: RatingModelType) -> dict[str, Metrics]:
+        with self._lock:
+            return {
+                variant: metrics
+                for (variant, metrics_model), metrics in self._metrics.items()
+                if metrics_model is model_type
+            }
+
+    def _load(
+        self,
+        db: database.ShadowDatabase,
+        key: tuple[str, RatingModelType],
+        match_id: int,
+    ):
+        variant, model_type = key
+        model = self._models[variant]
+        stored = db.ratings(variant, model_type.value)
+        replay = Replay(
+            model,
+            {
+                osu_id: model.create_rating([mu, sigma], name=str(osu_id))
+                for osu_id, (mu, sigma, _) in stored.items()
+            },
+            {osu_id: last_played for osu_id, (_, _, last_played) in stored.items()},
+        )
+        if not stored:
+            # a variant that's new here starts from every match logged before
+            # the one it's about to rate, rather than from scratch
+            for match in database.match_log.matches(
+                model_type.value, match_id, db.log_cur
+            ):
+                replay.rate(match)
+            db.seed(
+                variant,
+                model_type.value,
+                {
+                    osu_id: (rating.mu, rating.sigma, replay.last_played[osu_id])
+                    for osu_id, rating in replay.ratings.items()
+                },
+            )
+        self._replays[key] = replay
+
+    def _rate(self, db: database.ShadowDatabase, match: ShadowMatch) -> None:
+        production = match.production
+        errors = {
+            PRODUCTION: evaluation.prediction_errors(
+                production.predict_win(
+                    [
+                        [production.create_rating([mu, sigma]) for mu, sigma in team]
+                        for team in match.ratings_before
+                    ]
+                ),
+                match.scores,
+            )
+        }
+        for variant, model in self._models.items():
+            key = (variant, match.model_type)
+            if key not in self._replays:
+                self._load(db, key, match.match_id)
+            replay = self._replays[key]
+            teams_ratings = replay.current_ratings(match.teams, match.timestamp)
+            errors[variant] = evaluation.prediction_errors(
+                model.predict_win(teams_ratings), match.scores
+            )
+            rated = replay.rate(
+                (match.timestamp, match.teams, match.scores), teams_ratings
+            )
+            new_ratings = {
+                osu_id: rating
+                for team, team_ratings in zip(match.teams, rated)
+                for osu_id, rating in zip(team, team_ratings)
+            }
+            db.record(
+                variant,
+                match.model_type.value,
+                {
+                    osu_id: (rating.mu, rating.sigma)
+                    for osu_id, rating in new_ratings.items()
+                },
+                match.timestamp,
+                errors[variant],
+            )
+        db.record(
+            PRODUCTION, match.model_type.value, {}, match.timestamp, errors[PRODUCTION]
+        )
+        db.commit()
+
+        with self._lock:
+            for variant, variant_errors in errors.items():
+                key = (variant, match.model_type)
+                self._metrics[key] = self._metrics.get(key, Metrics()).add(
+                    variant_errors
+                )
+
+    def run(self) -> None:
+        db = database.ShadowDatabase()
+        self._models = {name: factory() for name, factory in self.variants.items()}
+        with self._lock:
+            self._metrics = {
+                (variant, RatingModelType(model)): Metrics(*totals)
+                for (variant, model), totals in db.metrics().items()
+                if variant == PRODUCTION or variant in self.variants
+            }
+        while (match := self._queue.get()) is not None:
+            try:
+                self._rate(db, match)
+            except Exception:
+                # keep going with the next match, from the ratings as stored
+                db.con.rollback()
+                self._replays.clear()
+                traceback.print_exc()
+
+
+# started by the bot, so scripts importing ratings don't start rating in the
+# background too
+runner = ShadowRunner(SHADOW_MODELS)
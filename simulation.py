@@ -0,0 +1,99 @@
+import random
+from itertools import combinations
+
+from openskill.models import PlackettLuce, PlackettLuceRating
+
+from predictions import predict_pairs
+
+
+def _win_matrix(
+    model: PlackettLuce, ratings: list[PlackettLuceRating]
+) -> list[list[float]]:
+    """chances[i][j] is how likely player i is to beat player j."""
+    pairs = list(combinations(range(len(ratings)), 2))
+    chances = [[0.5] * len(ratings) for _ in ratings]
+    for (i, j), prediction in zip(
+        pairs, predict_pairs(model, [(ratings[i], ratings[j]) for i, j in pairs])
+    ):
+        chances[i][j] = prediction.win
+        chances[j][i] = prediction.loss
+    return chances
+
+
+def bracket_order(size: int) -> list[int]:
+    """Seeds in bracket order, so that the top seeds only meet as late as
+    possible, e.g. [0, 3, 1, 2] for 4 players. size must be a power of 2."""
+    order = [0]
+    while len(order) < size:
+        order = [seed for top in order for seed in (top, 2 * len(order) - 1 - top)]
+    return order
+
+
+def single_elimination(
+    model: PlackettLuce,
+    ratings: list[PlackettLuceRating],
+    iterations: int,
+    rng: random.Random | None = None,
+) -> list[list[float]]:
+    """Play out a seeded single elimination bracket (ratings are in seed order)
+    iterations times. Returns, for every player, how likely they are to reach
+    each round, with the last column being winning the whole bracket. Missing
+    players in a bracket that isn't full are byes for the top seeds."""
+    rng = rng or random.Random()
+    chances = _win_matrix(model, ratings)
+    rounds = max(1, (len(ratings) - 1).bit_length())
+    slots: list[int | None] = [
+        seed if seed < len(ratings) else None for seed in bracket_order(2**rounds)
+    ]
+    reached = [[0] * (rounds + 1) for _ in ratings]
+
+    for _ in range(iterations):
+        alive = slots
+        for round_number in range(rounds):
+            for player in alive:
+                if player is not None:
+                    reached[player][round_number] += 1
+            alive = [
+                (
+                    b
+                    if a is None
+                    else (a if b is None else a if rng.random() < chances[a][b] else b)
+                )
+                for a, b in zip(alive[::2], alive[1::2])
+            ]
+        reached[alive[0]][rounds] += 1  # type: ignore[index]
+
+    return [[count / iterations for count in row] for row in reached]
+
+
+def round_robin(
+    model: PlackettLuce,
+    ratings: list[PlackettLuceRating],
+    iterations: int,
+    rng: random.Random | None = None,
+) -> tuple[list[float], list[list[float]]]:
+    """Play out a round robin where everyone meets once, iterations times.
+    Returns every player's average wins and how likely they are to finish in
+    each place, ties being broken at random."""
+    rng = rng or random.Random()
+    chances = _win_matrix(model, ratings)
+    pairs = list(combinations(range(len(ratings)), 2))
+    pair_chances = [chances[i][j] for i, j in pairs]
+    total_wins = [0] * len(ratings)
+    placements = [[0] * len(ratings) for _ in ratings]
+
+    for _ in range(iterations):
+        wins = [0] * len(ratings)
+        for (i, j), chance in zip(pairs, pair_chances):
+            wins[i if rng.random() < chance else j] += 1
+        standings = sorted(
+            range(len(ratings)), key=lambda player: (-wins[player], rng.random())
+        )
+        for place, player in enumerate(standings):
+            placements[player][place] += 1
+            total_wins[player] += wins[player]
+
+    return (
+        [count / iterations for count in total_wins],
+        [[count / iterations for count in row] for row in placements],
+    )
@@ -1,15 +1,23 @@
+from array import array
 from enum import Enum
-from typing import Generic, TypeVar
+from functools import reduce
+from itertools import compress
+from operator import or_
+from typing import Generic, Iterable, TypeVar
 
-from osu import Mod, Mods
+from osu import LazerMod, Mod, Mods
+from unopt import unwrap
 
 import database
+from misc.constants import OsuUserId, RatingModelType
 
 T = TypeVar("T")
 
 
 class MatchType(Enum):
     one_v_one = 1
+    team_vs = 2
+    free_for_all = 3
 
 
 class MatchStatistic(Generic[T]):
@@ -24,15 +32,17 @@ class MatchStatistic(Generic[T]):
         return self.statistic[match_type]
 
 
-class CountedMatchStatistic(MatchStatistic):
+class CountedMatchStatistic(MatchStatistic[int]):
     statistic: dict[MatchType, int]
+    overall: int
 
-    @property
-    def overall(self) -> int:
-        return sum(self.statistic.values())
+    def __init__(self, statistic: dict[MatchType, int] | None = None):
+        self.statistic = {match_type: 0 for match_type in MatchType} | (statistic or {})
+        self.overall = sum(self.statistic.values())
 
-    def __init__(self, statistic: dict[MatchType, int]):
-        self.statistic = statistic
+    def increment(self, match_type: MatchType, amount: int = 1) -> None:
+        self.statistic[match_type] += amount
+        self.overall += amount
 
 
 class MatchResult(Enum):
@@ -41,106 +51,421 @@ class MatchResult(Enum):
     draw = 0
 
 
-class ResultStatistics:
-    statistics: dict[MatchResult, CountedMatchStatistic]
+def team_results(
+    team_count: int, team_scores: list[int | float] | None
+) -> list[MatchResult]:
+    # without scores, teams are ordered from first to last place
+    if team_scores is None:
+        return [MatchResult.win] + [MatchResult.loss] * (team_count - 1)
+    best = max(team_scores)
+    tied = team_scores.count(best) > 1
+    return [
+        (
+            MatchResult.loss
+            if score < best
+            else MatchResult.draw if tied else MatchResult.win
+        )
+        for score in team_scores
+    ]
 
-    def __init__(self, statistics: dict[MatchResult, CountedMatchStatistic]):
-        self.statistics = statistics
 
-    @property
-    def matches_played(self) -> CountedMatchStatistic:
-        return CountedMatchStatistic(
+def match_type(teams: list[list[OsuUserId]]) -> MatchType:
+    if all(len(team) == 1 for team in teams):
+        return MatchType.one_v_one if len(teams) == 2 else MatchType.free_for_all
+    return MatchType.team_vs
+
+
+class ResultStatistics:
+    statistics: dict[MatchResult, CountedMatchStatistic]
+    matches_played: CountedMatchStatistic
+
+    def __init__(
+        self, statistics: dict[MatchResult, CountedMatchStatistic] | None = None
+    ):
+        self.statistics = {
+            result: (statistics or {}).get(result) or CountedMatchStatistic()
+            for result in MatchResult
+        }
+        self.matches_played = CountedMatchStatistic(
             {
                 match_type: sum(
-                    [statistic[match_type] for statistic in self.statistics.values()]
+                    statistic[match_type] for statistic in self.statistics.values()
                 )
                 for match_type in MatchType
             }
         )
 
+    def record(
+        self, result: MatchResult, match_type: MatchType, amount: int = 1
+    ) -> None:
+        self.statistics[result].increment(match_type, amount)
+        self.matches_played.increment(match_type, amount)
+
     @property
     def win_percentage(self) -> MatchStatistic[float]:
+        wins = self.statistics[MatchResult.win]
         return MatchStatistic(
             {
                 match_type: (
-                    self.statistics[MatchResult.win][match_type]
-                    / self.matches_played[match_type]
+                    wins[match_type] / self.matches_played[match_type]
                     if self.matches_played[match_type] > 0
                     else 0
                 )
                 for match_type in MatchType
             },
             (
-                self.matches_played.overall / self.matches_played.overall * 100
+                wins.overall / self.matches_played.overall
                 if self.matches_played.overall > 0
                 else 0
             ),
         )
 
 
-class PlayerStatistics:
-    match_results: ResultStatistics
-
-    mods_used: dict[Mod, CountedMatchStatistic]
-    mod_combos_used: dict[Mods, CountedMatchStatistic]
-
-
-class PlayerGlobalStatistics:
-    model_statistics: dict[str, PlayerStatistics]
-
-    @property
-    def match_results(self) -> ResultStatistics:
-        return ResultStatistics(
+# every legacy mod bit alongside its lazer counterpart
+_MOD_BITS: list[tuple[Mods, Mod]] = [(flag, Mod[unwrap(flag.name)]) for flag in Mods]
+
+
+def mods_bitmask(mods: Mods | Iterable[LazerMod] | None) -> int:
+    """Legacy mod bitmask for a score's mods. Lazer-only mods have no bit and
+    are left out."""
+    if mods is None:
+        return 0
+    if isinstance(mods, Mods):
+        return mods.value
+    return reduce(
+        or_,
+        (Mods[mod.mod.name].value for mod in mods if mod.mod.name in Mods.__members__),
+        0,
+    )
+
+
+class ModUsage:
+    """Mod combinations used, as an array of legacy mod bitmasks with a
+    parallel array of play counts per match type."""
+
+    combos: array
+    counts: dict[MatchType, array]
+    _positions: dict[int, int]
+
+    def __init__(self) -> None:
+        self.combos = array("L")
+        self.counts = {match_type: array("L") for match_type in MatchType}
+        self._positions = {}
+
+    def increment(self, combo: int, match_type: MatchType, amount: int = 1) -> None:
+        position = self._positions.get(combo)
+        if position is None:
+            position = self._positions[combo] = len(self.combos)
+            self.combos.append(combo)
+            for counts in self.counts.values():
+                counts.append(0)
+        self.counts[match_type][position] += amount
+
+    def uses(self, mods: Mods | int) -> CountedMatchStatistic:
+        """Plays with all of the given mods enabled, with or without others."""
+        mask = int(mods)
+        selected = [combo & mask == mask for combo in self.combos]
+        return CountedMatchStatistic(
             {
-                result: CountedMatchStatistic(
-                    {
-                        match_type: sum(
-                            model_statistics.match_results.statistics[result][
-                                match_type
-                            ]
-                            for model_statistics in self.model_statistics.values()
-                        )
-                        for match_type in MatchType
-                    }
-                )
-                for result in MatchResult
+                match_type: sum(compress(counts, selected))
+                for match_type, counts in self.counts.items()
             }
         )
 
     @property
     def mods_used(self) -> dict[Mod, CountedMatchStatistic]:
-        return {
-            mod: CountedMatchStatistic(
-                {
-                    match_type: sum(
-                        model_statistics.mods_used[mod][match_type]
-                        for model_statistics in self.model_statistics.values()
-                    )
-                    for match_type in MatchType
-                }
-            )
-            for mod in Mod
-        }
+        used = reduce(or_, self.combos, 0)
+        return {mod: self.uses(flag) for flag, mod in _MOD_BITS if used & flag}
 
     @property
     def mod_combos_used(self) -> dict[Mods, CountedMatchStatistic]:
         return {
-            combo: CountedMatchStatistic(
+            Mods(combo): CountedMatchStatistic(
                 {
-                    match_type: sum(
-                        model_statistics.mod_combos_used[combo][match_type]
-                        for model_statistics in self.model_statistics.values()
-                    )
-                    for match_type in MatchType
+                    match_type: counts[position]
+                    for match_type, counts in self.counts.items()
                 }
             )
-            for combo in Mods
+            for position, combo in enumerate(self.combos)
         }
 
 
+class PlayerStatistics:
+    match_results: ResultStatistics
+    mod_usage: ModUsage
+
+    def __init__(self) -> None:
+        self.match_results = ResultStatistics()
+        self.mod_usage = ModUsage()
+
+    @property
+    def mods_used(self) -> dict[Mod, CountedMatchStatistic]:
+        return self.mod_usage.mods_used
+
+    @property
+    def mod_combos_used(self) -> dict[Mods, CountedMatchStatistic]:
+        return self.mod_usage.mod_combos_used
+
+
+class PlayerGlobalStatistics:
+    model_statistics: dict[RatingModelType, PlayerStatistics]
+    # kept up to date alongside the per-model statistics
+    match_results: ResultStatistics
+    mod_usage: ModUsage
+
+    def __init__(self) -> None:
+        self.model_statistics = {model: PlayerStatistics() for model in RatingModelType}
+        self.match_results = ResultStatistics()
+        self.mod_usage = ModUsage()
+
+    def record(
+        self,
+        model: RatingModelType,
+        result: MatchResult,
+        match_type: MatchType,
+        amount: int = 1,
+    ) -> None:
+        self.model_statistics[model].match_results.record(result, match_type, amount)
+        self.match_results.record(result, match_type, amount)
+
+    def record_mods(
+        self,
+        model: RatingModelType,
+        combo: int,
+        match_type: MatchType,
+        amount: int = 1,
+    ) -> None:
+        self.model_statistics[model].mod_usage.increment(combo, match_type, amount)
+        self.mod_usage.increment(combo, match_type, amount)
+
+    @property
+    def mods_used(self) -> dict[Mod, CountedMatchStatistic]:
+        return self.mod_usage.mods_used
+
+    @property
+    def mod_combos_used(self) -> dict[Mods, CountedMatchStatistic]:
+        return self.mod_usage.mod_combos_used
+
+
 class GlobalStatistics(dict[int, PlayerGlobalStatistics]):
-    def __init__(self):
+    db: database.PlayerStatisticsDatabase
+    mods_db: database.PlayerModCombosDatabase
+
+    def __init__(
+        self,
+        db: database.PlayerStatisticsDatabase,
+        mods_db: database.PlayerModCombosDatabase,
+    ):
         super().__init__()
+        self.db = db
+        self.mods_db = mods_db
+
+    def __missing__(self, osu_id: int) -> PlayerGlobalStatistics:
+        self[osu_id] = PlayerGlobalStatistics()
+        return self[osu_id]
+
+    def load(self) -> None:
+        self.clear()
+        for osu_id, model, match_type, wins, losses, draws in self.db.all():
+            for result, amount in (
+                (MatchResult.win, wins),
+                (MatchResult.loss, losses),
+                (MatchResult.draw, draws),
+            ):
+                self[osu_id].record(
+                    RatingModelType(model), result, MatchType(match_type), amount
+                )
+        for osu_id, model, match_type, combo, count in self.mods_db.all():
+            self[osu_id].record_mods(
+                RatingModelType(model), combo, MatchType(match_type), count
+            )
+
+    def record_match(
+        self,
+        model: RatingModelType,
+        match_type: MatchType,
+        results: dict[OsuUserId, MatchResult],
+        mods: dict[OsuUserId, int] | None = None,
+    ) -> None:
+        """Count one match for every player, and the mods they played it with
+        as legacy bitmasks if known. Meant to be called inside the same
+        database.transaction() as the rating update."""
+        self.db.increment(
+            [
+                (
+                    osu_id,
+                    model.value,
+                    match_type.value,
+                    int(result == MatchResult.win),
+                    int(result == MatchResult.loss),
+                    int(result == MatchResult.draw),
+                )
+                for osu_id, result in results.items()
+            ]
+        )
+        for osu_id, result in results.items():
+            self[osu_id].record(model, result, match_type)
+        if mods is None:
+            return
+        self.mods_db.increment(
+            [
+                (osu_id, model.value, match_type.value, combo, 1)
+                for osu_id, combo in mods.items()
+            ]
+        )
+        for osu_id, combo in mods.items():
+            self[osu_id].record_mods(model, combo, match_type)
+
+
+class Rivalry:
+    """How a player has done against one opponent, from the player's side.
+    Margins are the player's team score minus the opponent's."""
+
+    wins: int
+    losses: int
+    draws: int
+    margin: int | float
+    last_margin: int | float | None
+    last_played: int | None
+
+    def __init__(
+        self,
+        wins: int = 0,
+        losses: int = 0,
+        draws: int = 0,
+        margin: int | float = 0,
+        last_margin: int | float | None = None,
+        last_played: int | None = None,
+    ) -> None:
+        self.wins = wins
+        self.losses = losses
+        self.draws = draws
+        self.margin = margin
+        self.last_margin = last_margin
+        self.last_played = last_played
+
+    @property
+    def matches_played(self) -> int:
+        return self.wins + self.losses + self.draws
+
+    @property
+    def average_margin(self) -> float:
+        return self.margin / self.matches_played if self.matches_played > 0 else 0
+
+    def record(self, result: MatchResult, margin: int | float, timestamp: int) -> None:
+        self.wins += int(result == MatchResult.win)
+        self.losses += int(result == MatchResult.loss)
+        self.draws += int(result == MatchResult.draw)
+        self.margin += margin
+        # imported matches can be older than the last one recorded
+        if self.last_played is None or timestamp >= self.last_played:
+            self.last_margin = margin
+            self.last_played = timestamp
+
+    def reversed(self) -> "Rivalry":
+        return Rivalry(
+            self.losses,
+            self.wins,
+            self.draws,
+            -self.margin,
+            -self.last_margin if self.last_margin is not None else None,
+            self.last_played,
+        )
+
+
+_RivalryKey = tuple[OsuUserId, OsuUserId, RatingModelType]
+
+
+class HeadToHead(dict[_RivalryKey, Rivalry]):
+    """Rivalries between every pair of players that have met, keyed by the
+    pair with the lower osu id first."""
+
+    db: database.HeadToHeadDatabase
+
+    def __init__(self, db: database.HeadToHeadDatabase):
+        super().__init__()
+        self.db = db
+
+    def between(
+        self, model: RatingModelType, player: OsuUserId, opponent: OsuUserId
+    ) -> Rivalry:
+        if player > opponent:
+            return self.between(model, opponent, player).reversed()
+        return self.get((player, opponent, model)) or Rivalry()
+
+    def load(self) -> None:
+        self.clear()
+        for (
+            player,
+            opponent,
+            model,
+            wins,
+            losses,
+            draws,
+            margin,
+            last_margin,
+            last_played,
+        ) in self.db.all():
+            self[(player, opponent, RatingModelType(model))] = Rivalry(
+                wins, losses, draws, margin, last_margin, last_played
+            )
+
+    def record_match(
+        self,
+        model: RatingModelType,
+        teams: list[list[OsuUserId]],
+        team_scores: list[int | float] | None,
+        timestamp: int,
+    ) -> None:
+        """Update the rivalry of every pair of players on opposing teams.
+        Without scores, teams are ordered from first to last place."""
+        records: list[tuple[OsuUserId, OsuUserId, MatchResult, int | float]] = []
+        for i, team in enumerate(teams):
+            for j in range(i + 1, len(teams)):
+                margin = team_scores[i] - team_scores[j] if team_scores else 0
+                result = (
+                    MatchResult.win
+                    if margin > 0 or team_scores is None
+                    else MatchResult.loss if margin < 0 else MatchResult.draw
+                )
+                for player in team:
+                    for opponent in teams[j]:
+                        if player < opponent:
+                            records.append((player, opponent, result, margin))
+                        else:
+                            records.append(
+                                (opponent, player, MatchResult(-result.value), -margin)
+                            )
+
+        self.db.record(
+            [
+                (
+                    player,
+                    opponent,
+                    model.value,
+                    int(result == MatchResult.win),
+                    int(result == MatchResult.loss),
+                    int(result == MatchResult.draw),
+                    margin,
+                    timestamp,
+                )
+                for player, opponent, result, margin in records
+            ]
+        )
+        for player, opponent, result, margin in records:
+            self.setdefault((player, opponent, model), Rivalry()).record(
+                result, margin, timestamp
+            )
+
+
+global_stats: GlobalStatistics = GlobalStatistics(
+    database.player_statistics, database.player_mod_combos
+)
+global_stats.load()
 
+head_to_head: HeadToHead = HeadToHead(database.head_to_head)
+head_to_head.load()
 
-global_stats: GlobalStatistics = GlobalStatistics()
+# a rolled back match has already been counted in memory
+database.on_rollback(global_stats.load)
+database.on_rollback(head_to_head.load)
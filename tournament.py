@@ -0,0 +1,85 @@
+from asyncio import gather
+from typing import NamedTuple
+
+import database
+import map_pools
+import match_tracking
+import ratings
+import simulation
+from misc.constants import RatingModelType
+from misc.users import CachedUser
+from stats_tracking import MatchType
+
+
+def seeded_pairings(players: int) -> list[tuple[int, int]]:
+    """First round of a single elimination bracket between players in seed
+    order, as pairs of seeds. Missing players are byes for the top seeds."""
+    rounds = max(1, (players - 1).bit_length())
+    order = simulation.bracket_order(2**rounds)
+    return [
+        (a, b) for a, b in zip(order[::2], order[1::2]) if a < players and b < players
+    ]
+
+
+def round_robin_pairings(players: int, round_number: int) -> list[tuple[int, int]]:
+    """One round of a round robin, as pairs of indexes into players. Over
+    rounds 1 to players - 1 (players if it's odd) everyone meets everyone
+    exactly once, with one player sitting out every round if it's odd."""
+    slots: list[int | None] = [*range(players)] + ([None] if players % 2 else [])
+    # the first slot stays put while everyone else rotates around it
+    shift = (round_number - 1) % (len(slots) - 1)
+    rest = slots[1:]
+    rotated = [slots[0]] + rest[len(rest) - shift :] + rest[: len(rest) - shift]
+    half = len(rotated) // 2
+    return [
+        (a, b)
+        for a, b in zip(rotated[:half], reversed(rotated[half:]))
+        if a is not None and b is not None
+    ]
+
+
+class RoundResult(NamedTuple):
+    match: match_tracking.TrackedMatch
+    # None if nobody set a score
+    scores: list[list[match_tracking.PlayerScore]] | None
+    changes: list[list[ratings.RatingChange]] | None
+
+
+def start_round(
+    model_type: RatingModelType,
+    channel_id: int,
+    beatmap: map_pools.BeatmapMetadata,
+    pairings: list[tuple[CachedUser, CachedUser]],
+) -> list[match_tracking.TrackedMatch]:
+    """Set up every match of a round at once, all of them already accepted
+    so they end together."""
+    with database.transaction():
+        tracked = [
+            match_tracking.propose(
+                model_type, MatchType.one_v_one, channel_id, beatmap, [[a], [b]]
+            )
+            for a, b in pairings
+        ]
+        for match in tracked:
+            match.accept()
+    return tracked
+
+
+async def finish_round(
+    tracked: list[match_tracking.TrackedMatch],
+) -> list[RoundResult]:
+    """Play out every match of a round on the shared score poller, then rate
+    them in the order they were paired."""
+    played = await gather(
+        *(match_tracking.do_match(match) for match in tracked),
+        return_exceptions=True,
+    )
+    results: list[RoundResult] = []
+    for match, player_scores in zip(tracked, played):
+        if isinstance(player_scores, match_tracking.MatchVoidException):
+            results.append(RoundResult(match, None, None))
+            continue
+        if isinstance(player_scores, BaseException):
+            raise player_scores
+        results.append(RoundResult(match, *match_tracking.rate(match, player_scores)))
+    return results